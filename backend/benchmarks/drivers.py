@@ -0,0 +1,109 @@
+import http.client
+import json
+import socket
+import threading
+import time
+
+from werkzeug.serving import make_server
+
+
+class TestClientDriver:
+  '''Sends requests through the Flask test client: the whole application stack runs, without any network or
+    server overhead.
+  '''
+  name = "test-client"
+
+  def __init__(self, app):
+    self.app = app
+
+  def start(self):
+    pass
+
+  def stop(self):
+    pass
+
+  def request(self, method, path, json_body=None, data=None, headers=None):
+    '''Send a request and return (status code, body bytes).'''
+    # The test client refuses json and data together, even when one of them is None.
+    body = { "json": json_body } if json_body is not None else { "data": data }
+    response = self.app.test_client().open(path, method=method, headers=headers, **body)
+    return response.status_code, response.get_data()
+
+
+class WSGIServerDriver:
+  '''Serves the app with a threaded werkzeug WSGI server on a local port and sends real HTTP requests to it, so
+    that request parsing and socket I/O are measured too.
+  '''
+  name = "wsgi"
+
+  def __init__(self, app):
+    self.app = app
+    self.server = None
+    self.thread = None
+
+  def start(self):
+    self.server = make_server("127.0.0.1", 0, self.app, threaded=True)
+    self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+    self.thread.start()
+
+  def stop(self):
+    self.server.shutdown()
+    self.thread.join()
+
+  @property
+  def port(self):
+    return self.server.server_port
+
+  def request(self, method, path, json_body=None, data=None, headers=None):
+    headers = dict(headers or {})
+    if json_body is not None:
+      data = json.dumps(json_body).encode("utf-8")
+      headers["Content-Type"] = "application/json"
+    connection = http.client.HTTPConnection("127.0.0.1", self.port, timeout=300)
+    try:
+      connection.request(method, path, body=data, headers=headers)
+      response = connection.getresponse()
+      return response.status, response.read()
+    finally:
+      connection.close()
+
+
+class ASGIServerDriver(WSGIServerDriver):
+  '''Serves the async entry point (flaskr.asgi) with uvicorn on a local port and sends real HTTP requests to it,
+    for comparing against the WSGI driver. Needs PostgreSQL and the optional starlette, asyncpg and uvicorn packages.
+  '''
+  name = "asgi"
+
+  def start(self):
+    import uvicorn
+    from flaskr.asgi import create_asgi_app_for
+
+    self.socket = socket.socket()
+    self.socket.bind(("127.0.0.1", 0))
+    config = uvicorn.Config(create_asgi_app_for(self.app), log_level="warning", access_log=False)
+    self.server = uvicorn.Server(config)
+    self.thread = threading.Thread(target=self.server.run, kwargs={"sockets": [self.socket]}, daemon=True)
+    self.thread.start()
+    while not self.server.started:
+      if not self.thread.is_alive():
+        raise RuntimeError("The ASGI server failed to start.")
+      time.sleep(0.01)
+
+  def stop(self):
+    self.server.should_exit = True
+    self.thread.join()
+    self.socket.close()
+
+  @property
+  def port(self):
+    return self.socket.getsockname()[1]
+
+
+DRIVERS = {
+  TestClientDriver.name: TestClientDriver,
+  WSGIServerDriver.name: WSGIServerDriver,
+  ASGIServerDriver.name: ASGIServerDriver,
+}
+
+# The ASGI driver only runs against PostgreSQL, so it is only used when asked for.
+DEFAULT_DRIVERS = (TestClientDriver.name, WSGIServerDriver.name)
@@ -0,0 +1,115 @@
+'''
+Measure the near-duplicate index: signature and build time, index size, lookup latency and how many planted
+near-duplicates it finds, and the time of the duplicate-clusters job.
+
+Run from the backend directory, for example:
+
+    python -m benchmarks.duplicates --rows 100k
+
+The questions are synthetic (as benchmarks.seed writes them) and kept in memory, so only the index is measured.
+--planted of them are copies of an earlier question with one word replaced or a typo, which the index should find.
+'''
+import argparse
+import json
+import random
+import sys
+import time
+
+from flaskr.duplicates import (DUPLICATE_THRESHOLD, LSHIndex, duplicate_clusters, jaccard, shingles, signature)
+from .run import parse_count, peak_rss_mb, percentile
+from .seed import read_sample_data, synthetic_questions
+
+
+def _questions(rows, planted, seed=0):
+  '''Return a list of (question, answer) pairs, planted of them near-duplicates of earlier ones, and a dictionary
+    of the position of each planted question to the position of its original.
+  '''
+  rng = random.Random(seed)
+  categories, sample_questions = read_sample_data()
+  questions = [(question, answer) for _, (question, answer, _, _)
+               in synthetic_questions(rows - planted, categories, sample_questions)]
+  originals = {}
+  for _ in range(planted):
+    original = rng.randrange(len(questions))
+    question, answer = questions[original]
+    words = question.split()
+    position = rng.randrange(len(words))
+    if rng.random() < 0.5:
+      words[position] = rng.choice(words)
+    else:
+      word = words[position]
+      words[position] = word[:-1] if len(word) > 3 else word + "s"
+    originals[len(questions)] = original
+    questions.append((" ".join(words), answer))
+  return questions, originals
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description="Measure the near-duplicate index.")
+  parser.add_argument("--rows", default="100k", type=parse_count, help="Questions to index (10k, 100k, 1M...).")
+  parser.add_argument("--planted", default=1000, type=int, help="Near-duplicates planted among the questions.")
+  parser.add_argument("--threshold", default=DUPLICATE_THRESHOLD, type=float, help="Similarity of duplicates.")
+  parser.add_argument("--output", help="Path of the JSON report to write.")
+  args = parser.parse_args(argv)
+
+  questions, originals = _questions(args.rows, args.planted)
+  rss_before = peak_rss_mb()
+  started = time.perf_counter()
+  signatures = [signature(shingles(question, answer)) for question, answer in questions]
+  signature_seconds = time.perf_counter() - started
+
+  started = time.perf_counter()
+  index = LSHIndex()
+  index.load(entry for question_id, question_signature in enumerate(signatures)
+             for entry in LSHIndex.entries_for(question_id, question_signature))
+  build_seconds = time.perf_counter() - started
+  rss_after = peak_rss_mb()
+
+  times = []
+  candidate_counts = []
+  found = 0
+  for position, original in originals.items():
+    question, answer = questions[position]
+    started = time.perf_counter()
+    question_shingles = shingles(question, answer)
+    candidates = index.candidates(signature(question_shingles))
+    times.append((time.perf_counter() - started) * 1000)
+    candidates.discard(position)
+    candidate_counts.append(len(candidates))
+    if original in candidates and jaccard(question_shingles, shingles(*questions[original])) >= args.threshold:
+      found += 1
+  times.sort()
+  candidate_counts.sort()
+  similar_planted = sum(jaccard(shingles(*questions[position]), shingles(*questions[original])) >= args.threshold
+                        for position, original in originals.items())
+
+  started = time.perf_counter()
+  clusters = duplicate_clusters(args.threshold, enumerate(signatures))
+  cluster_seconds = time.perf_counter() - started
+
+  report = {
+    "rows": args.rows,
+    "planted": args.planted,
+    "signature_ms_per_question": round(signature_seconds * 1000 / len(questions), 4),
+    "build_seconds": round(build_seconds, 3),
+    "index_mb": round(index.size_bytes() / 1024 / 1024, 1),
+    "peak_rss_growth_mb": round(rss_after - rss_before, 1),
+    "lookup_ms": { name: round(percentile(times, fraction), 4)
+                   for name, fraction in (("p50", 0.5), ("p95", 0.95), ("p99", 0.99)) },
+    "candidates_p50": percentile(candidate_counts, 0.5),
+    "planted_above_threshold": similar_planted,
+    "planted_found": found,
+    "cluster_seconds": round(cluster_seconds, 3),
+    "clusters": len(clusters),
+  }
+  for name, value in report.items():
+    print(f"{name:28} {value}")
+  if args.output:
+    with open(args.output, "w", encoding="utf-8") as output:
+      json.dump(report, output, indent=2, sort_keys=True)
+      output.write("\n")
+  return 0
+
+
+if __name__ == "__main__":
+  sys.exit(main())
@@ -0,0 +1,107 @@
+import os
+import random
+import re
+import time
+from collections import Counter
+from itertools import accumulate
+
+from sqlalchemy import text
+
+from models import db, Question, QuestionStat, Category
+from flaskr.bulk import QuestionImporter
+
+
+SAMPLE_DATA_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "trivia.psql")
+SEED_BATCH_SIZE = 10000
+# Distinct words of the synthetic text, about what a million real trivia questions and answers use.
+SYNTHETIC_VOCABULARY_SIZE = 100000
+# The exponent s of the word frequencies: the word of rank r is drawn with a weight of 1 / r ** s, as in natural text.
+ZIPF_EXPONENT = 1.0
+_ONSETS = ["", "b", "c", "d", "f", "g", "h", "j", "k", "l", "m", "n", "p", "r", "s", "t", "v", "w", "z", "br", "ch",
+           "cl", "dr", "fl", "gr", "pl", "pr", "sh", "st", "th", "tr"]
+_VOWELS = ["a", "e", "i", "o", "u", "ai", "ea", "ou", "y"]
+_CODAS = ["", "", "", "l", "m", "n", "r", "s", "t", "nd", "rk", "st"]
+
+
+def read_sample_data(path=SAMPLE_DATA_PATH):
+  '''Return (categories, questions) from the COPY blocks of trivia.psql: a list of (id, type) tuples and a list of
+    question dictionaries.
+  '''
+  with open(path, encoding="utf-8") as dump:
+    content = dump.read()
+
+  def copy_rows(table):
+    block = re.search(rf"COPY public\.{table} \(([^)]*)\) FROM stdin;\n(.*?)\n\\\.", content, re.S)
+    columns = [column.strip() for column in block.group(1).split(",")]
+    return [dict(zip(columns, line.split("\t"))) for line in block.group(2).split("\n")]
+
+  categories = [(int(row["id"]), row["type"]) for row in copy_rows("categories")]
+  return categories, copy_rows("questions")
+
+
+def ensure_categories(categories):
+  '''Insert the sample categories (with their ids) unless the categories table already has rows.'''
+  if Category.query.count():
+    return
+  for category_id, category_type in categories:
+    category = Category(category_type)
+    category.id = category_id
+    db.session.add(category)
+  db.session.commit()
+
+
+def synthetic_vocabulary(sample_questions, size=SYNTHETIC_VOCABULARY_SIZE, seed=0):
+  '''Return size distinct words, most frequent first: the words of the sample questions in the order of their
+    frequency there, then made-up words of one to four syllables.
+  '''
+  rng = random.Random(seed)
+  counts = Counter(word.lower() for question in sample_questions
+                   for word in re.findall(r"[A-Za-z][A-Za-z']*", f"{question['question']} {question['answer']}"))
+  words = [word for word, _ in counts.most_common()][:size]
+  seen = set(words)
+  while len(words) < size:
+    word = "".join(rng.choice(_ONSETS) + rng.choice(_VOWELS) + rng.choice(_CODAS)
+                   for _ in range(rng.choice((1, 2, 2, 3, 3, 4))))
+    if word not in seen:
+      seen.add(word)
+      words.append(word)
+  return words
+
+
+def zipf_cum_weights(size, exponent=ZIPF_EXPONENT):
+  '''The cumulative weights for random.choices of a Zipf distribution over size words ordered by frequency.'''
+  return list(accumulate(1 / rank ** exponent for rank in range(1, size + 1)))
+
+
+def synthetic_questions(count, categories, sample_questions, seed=0):
+  '''Yield count (line number, question values) pairs, as QuestionImporter.run expects. The words follow a Zipf
+    distribution over a vocabulary of SYNTHETIC_VOCABULARY_SIZE words led by those of the sample questions, so that
+    common words and search terms from the sample data match many rows, and most words only a few.
+  '''
+  rng = random.Random(seed)
+  vocabulary = synthetic_vocabulary(sample_questions, seed=seed)
+  cum_weights = zipf_cum_weights(len(vocabulary))
+  category_ids = [category_id for category_id, _ in categories]
+  for line_number in range(1, count + 1):
+    question = " ".join(rng.choices(vocabulary, cum_weights=cum_weights, k=rng.randint(6, 14))).capitalize() + "?"
+    answer = " ".join(rng.choices(vocabulary, cum_weights=cum_weights, k=rng.randint(1, 3)))
+    yield line_number, (question, answer, rng.choice(category_ids), rng.randint(1, 5))
+
+
+def seed_questions(count, seed=0, batch_size=SEED_BATCH_SIZE):
+  '''Replace the questions table with count synthetic questions spread across the sample categories and return the
+    number of seconds it took. Must run inside an application context.
+  '''
+  categories, sample_questions = read_sample_data()
+  started = time.perf_counter()
+  ensure_categories(categories)
+  db.session.execute(Question.__table__.delete())
+  db.session.execute(QuestionStat.__table__.delete())
+  db.session.commit()
+  report = QuestionImporter(batch_size).run(synthetic_questions(count, categories, sample_questions, seed))
+  if report["error_count"]:
+    raise RuntimeError(f"Seeding rejected {report['error_count']} rows: {report['errors'][:3]}")
+  if db.engine.dialect.name == "postgresql":
+    with db.engine.connect() as connection:
+      connection.execution_options(isolation_level="AUTOCOMMIT").execute(text(f"ANALYZE {Question.__tablename__}"))
+  return time.perf_counter() - started
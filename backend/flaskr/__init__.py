@@ -1,39 +1,85 @@
 import os
-from flask import Flask, request, abort, jsonify, flash
+from flask import Flask, Response, g, request, abort, flash, stream_with_context
 from flask_sqlalchemy import SQLAlchemy
 from flask_cors import CORS
 import sys
-from models import setup_db, Question, Category
-from random import randint
-
-
-QUESTIONS_PER_PAGE = 10
-
-
-def get_page_range(all_records, page):
-  '''Given a page number, return the records of all_records indexed at positions QUESTIONS_PER_PAGE * (page-1) up to
-    QUESTIONS_PER_PAGE * page - 1 inclusive. If the page < 1, raise an error. If the described page range would go
-    beyond the length of the array of all_records, return up to the end of the array (returning an empty array if
-    the page range is completely beyond the length of the array).
-  '''
-  if page < 1:
-    raise ValueError(f"Page {page} does not exist.")
-  range_start = min((page - 1) * QUESTIONS_PER_PAGE, len(all_records))
-  range_end = min(page * QUESTIONS_PER_PAGE, len(all_records))
-  return [db_question.format() for db_question in all_records[range_start:range_end]]
+from models import setup_db, Question, QuestionStat, category_registry, question_stats, read_only
+from .admission import admission_control
+from .autocomplete import AUTOCOMPLETE_LIMIT, MAX_AUTOCOMPLETE_LIMIT, autocomplete
+from .bulk import (FORMATS_BY_MIMETYPE, IMPORT_BATCH_SIZE, MAX_BULK_IDS, MIMETYPES_BY_FORMAT, QuestionImporter,
+                   delete_questions, export_questions, iter_questions, parse_rows, question_filter, read_lines,
+                   register_bulk_commands, update_questions)
+from .db_commands import register_db_commands
+from .duplicates import near_duplicates, register_duplicate_commands
+from .errors import error_payload
+from .group_commit import group_commit
+from .http_cache import conditional
+from .instrumentation import TimedJSONEncoder, finish_request, metrics_registry, record_request, start_request
+from .json_backend import create_json_backend, jsonify
+from .pagination import StreamedPage, get_page_range, parse_listing_args
+from .preload import preload
+from .quiz import QUIZ_MAX_QUESTIONS, choose_quiz_question, choose_quiz_questions, quiz_pool
+from .quiz_sessions import QUIZ_SESSION_MAX_QUESTIONS, QUIZ_SESSION_QUESTIONS, create_quiz_session_store
+from .response_cache import QUESTIONS_TAG, category_tag, listing_params, response_cache, search_params
+from .search import search_questions
+from .streaming import stream_json_response
+from .validation import (parse_question_changes, parse_question_selection, parse_quiz_request,
+                         parse_quiz_session_request, parse_search_request, validate_question)
 
 
 def create_app(test_config=None):
   # create and configure the app
   app = Flask(__name__)
   app.secret_key = os.urandom(32)
+  app.json_encoder = TimedJSONEncoder
+  if test_config is not None:
+    app.config.update(test_config)
   setup_db(app)
+  quiz_pool.ttl = app.config.get("QUIZ_POOL_TTL", quiz_pool.ttl)
+  quiz_sessions = create_quiz_session_store(app.config)
+  app.extensions['quiz_sessions'] = quiz_sessions
+  app.extensions['json_backend'] = create_json_backend(app.config)
+  response_cache.configure(app.config)
+  autocomplete.configure(app.config)
+  near_duplicates.configure(app.config)
+  group_commit.configure(app.config)
+  admission_control.configure(app.config)
+  if app.config.get("AUTOCOMPLETE_PRELOAD") and not app.config.get("PRELOAD"):
+    with app.app_context():
+      autocomplete.build()
+  # With near-duplicate checks on, the index is built now rather than by the first question added.
+  if near_duplicates.policy != "off" and not app.config.get("PRELOAD"):
+    with app.app_context():
+      near_duplicates.build()
+  register_bulk_commands(app)
+  register_db_commands(app)
+  register_duplicate_commands(app)
 
   '''
   This sets up CORS. It allows '*' for origins.
   '''
   cors = CORS(app, resources={r"/api/*": {"origins": "*"}})
 
+  '''
+  Every request is timed: SQL statements, rows and JSON encoding are
+  reported in a Server-Timing header and added to the /metrics totals.
+  Requests are then admitted or turned away with a 429 or 503 before
+  they touch the database (see admission.py); admitted requests hold
+  their endpoint's concurrency slot until the request is torn down.
+  '''
+  @app.before_request
+  def before_request():
+    start_request()
+    client = admission_control.client(request.remote_addr, request.headers)
+    endpoint = request.endpoint or "unknown"
+    rejection = admission_control.admit(endpoint, client)
+    if rejection is not None:
+      response = jsonify(error_payload(rejection.status, rejection.description()))
+      response.status_code = rejection.status
+      response.headers['Retry-After'] = str(rejection.retry_after)
+      return response
+    g.admitted_endpoint = endpoint
+
   '''
   The after_request decorator is used to set Access-Control-Allow
   '''
@@ -41,19 +87,26 @@ def create_app(test_config=None):
   def after_request(response):
     response.headers.add('Access-Control-Allow-Headers', 'Content-Ty[e, Authorization')
     response.headers.add('Access-Control-Allow-Methods', 'GET, POST, PUT, PATCH, DELETE, OPTIONS')
-    return response
+    return finish_request(response)
+
+  @app.teardown_request
+  def teardown_request(exception):
+    if 'admitted_endpoint' in g:
+      admission_control.release(g.pop('admitted_endpoint'))
+    record_request(exception)
 
   '''
   An endpoint to handle GET requests 
   for all available categories.
   '''
   @app.route('/')
+  @read_only
+  @conditional("CATEGORIES_CACHE_CONTROL")
   def retrieve_all_categories():
     try:
-      all_categories = Category.query.all()
       return jsonify({
         'message': 'HELLO WORLD',
-        'categories': [category.type for category in all_categories]
+        'categories': category_registry.types()
       })
     except:
       # print(sys.exc_info())
@@ -62,11 +115,12 @@ def create_app(test_config=None):
 
 
   @app.route('/categories')
+  @read_only
+  @conditional("CATEGORIES_CACHE_CONTROL")
   def retrieve_category_map():
     try:
-      all_categories = Category.query.all()
       return jsonify({
-        'categories': { category.id : category.type for category in all_categories }
+        'categories': category_registry.type_map()
       })
     except Exception as ex:
       # print(sys.exc_info())
@@ -84,19 +138,35 @@ def create_app(test_config=None):
   you should see questions and categories generated,
   ten questions per page and pagination at the bottom of the screen for three pages.
   Clicking on the page numbers should update the questions. 
+
+  With stream=true, the page is streamed row by row from a server-side
+  cursor, which keeps memory flat for large per_page values.
   '''
   @app.route('/questions', methods=['GET'])
+  @read_only
+  @conditional("QUESTIONS_CACHE_CONTROL")
+  @response_cache.cached(listing_params, lambda: [QUESTIONS_TAG])
   def questions():
     page = int(request.args.get("page", "1"))
+    cursor = request.args.get("cursor")
 
     try:
-      all_questions = Question.query.all()
-      range_questions = get_page_range(all_questions, page)
-      all_categories = Category.query.all()
+      per_page, streamed = parse_listing_args(request.args, app.config)
+      if streamed:
+        streamed_page = StreamedPage(Question.rows(), page, cursor, key=Question.id, per_page=per_page,
+                                     formatter=Question.format_row)
+        return stream_json_response({
+          'categories': category_registry.type_map(),
+          'total_questions': QuestionStat.total(),
+        }, 'questions', streamed_page, lambda: { 'next_cursor': streamed_page.next_cursor })
+
+      range_questions, next_cursor = get_page_range(Question.rows(), page, cursor, key=Question.id, per_page=per_page,
+                                                    formatter=Question.format_row)
       return jsonify({
         'questions': range_questions,
-        'total_questions': len(all_questions),
-        'categories': { category.id: category.type for category in all_categories },
+        'total_questions': QuestionStat.total(),
+        'categories': category_registry.type_map(),
+        'next_cursor': next_cursor,
 
         # How can the "current category" be determined?
       })
@@ -137,6 +207,12 @@ def create_app(test_config=None):
   TEST: When you submit a question on the "Add" tab, 
   the form will clear and the question will appear at the end of the last page
   of the questions list in the "List" tab.  
+
+  New questions are checked against a similarity index of the bank.
+  Depending on DUPLICATE_POLICY, near-duplicates are listed in the
+  response ("flag") or the question is rejected with a 422 ("reject"),
+  unless the request sets "allow_duplicates". With GROUP_COMMIT set,
+  concurrent requests share transactions (see group_commit.py).
   '''
 
   # A put request seemed more appropriate to me here, also to avoid collision with the already-
@@ -145,57 +221,166 @@ def create_app(test_config=None):
   def create_question():
     error_code = None
     question_id = None
+    duplicates = []
     try:
       body = request.get_json()
-      fields = ["question", "answer", "category", "difficulty"]
+      question = Question(*validate_question(body))
+      if near_duplicates.policy != "off" and not body.get("allow_duplicates"):
+        duplicates = near_duplicates.find(question.question, question.answer)
+      if duplicates and near_duplicates.policy == "reject":
+        error_code = 422
+        flash(f"The question is a near-duplicate of question {duplicates[0]['id']}.")
+      else:
+        question_id = group_commit.insert(question)
+        flash("Question successfully added.")
+    except Exception as ex:
+      error_code = 400
+      # print(sys.exc_info())
+      flash(f"An error occurred: {ex}")
 
-      for field in fields:
-        if body.get(field) is None:
-          raise ValueError(f"The request does not include a field for {field}.")
+    if error_code:
+      abort(error_code)
 
-      if not isinstance(body.get("difficulty"), int):
-        raise ValueError("The request does not include an integer-valued difficulty.")
+    return jsonify({ "success": True, "id": question_id, "duplicates": duplicates })
 
-      if not (1 <= body.get("difficulty") <= 5):
-        raise ValueError("The request difficulty is not within the allowed range of 1 to 5 inclusive.")
 
-      question = Question(body.get("question"), body.get("answer"), body.get("category"),
-                          body.get("difficulty"))
-      question.insert()
-      question_id = question.id
-      flash("Question successfully added.")
+  '''
+  Endpoints to delete or update many questions at once, selected by
+  "ids" or by a "category" and/or "difficulty" filter. Each request
+  runs one set-based statement in one transaction and reports the
+  number of questions affected. Updates change the category and/or
+  difficulty given in "set".
+  '''
+  @app.route('/questions', methods=['DELETE'])
+  def delete_question_selection():
+    try:
+      where = question_filter(*parse_question_selection(request.get_json(), MAX_BULK_IDS))
     except Exception as ex:
-      error_code = 400
-      # print(sys.exc_info())
+      flash(f"An error occurred: {ex}")
+      abort(400)
+
+    error_code = None
+    deleted = 0
+    try:
+      deleted = delete_questions(where)
+      flash(f"Questions removed: {deleted}")
+    except Exception as ex:
+      error_code = 422
       flash(f"An error occurred: {ex}")
 
     if error_code:
       abort(error_code)
+    return jsonify({ "success": True, "deleted": deleted })
 
-    return jsonify({ "success": True, "id": question_id })
+  @app.route('/questions', methods=['PATCH'])
+  def update_question_selection():
+    try:
+      body = request.get_json()
+      where = question_filter(*parse_question_selection(body, MAX_BULK_IDS))
+      changes = parse_question_changes(body)
+    except Exception as ex:
+      flash(f"An error occurred: {ex}")
+      abort(400)
+
+    error_code = None
+    updated = 0
+    try:
+      updated = update_questions(where, changes)
+      flash(f"Questions updated: {updated}")
+    except Exception as ex:
+      # For example a category that does not exist.
+      error_code = 422
+      flash(f"An error occurred: {ex}")
+
+    if error_code:
+      abort(error_code)
+    return jsonify({ "success": True, "updated": updated })
+
+
+  '''
+  An endpoint to import many questions at once from an NDJSON or CSV
+  request body (chosen by the Content-Type, or the "format" argument).
+  Rows are validated like PUT /questions, streamed from the request
+  and written batch_size at a time, one transaction per batch. The
+  response reports the rows inserted and the rows rejected.
+  '''
+  @app.route('/questions/import', methods=['POST'])
+  def import_questions():
+    try:
+      import_format = request.args.get("format") or FORMATS_BY_MIMETYPE.get(request.mimetype)
+      batch_size = int(request.args.get("batch_size", app.config.get("IMPORT_BATCH_SIZE", IMPORT_BATCH_SIZE)))
+      importer = QuestionImporter(batch_size, near_duplicates.policy)
+      rows = parse_rows(read_lines(request.stream), import_format)
+    except Exception as ex:
+      flash(f"An error occurred: {ex}")
+      abort(400)
+
+    report = importer.run(rows)
+    flash(f"Imported {report['inserted']} questions.")
+    return jsonify({ "success": report["error_count"] == 0, **report })
+
+
+  '''
+  An endpoint to export every question as NDJSON (the default) or CSV.
+  The response is streamed from a server-side cursor, so the table is
+  never loaded into memory.
+  '''
+  @app.route('/questions/export')
+  @read_only
+  def export_all_questions():
+    export_format = request.args.get("format", "ndjson")
+    if export_format not in MIMETYPES_BY_FORMAT:
+      flash(f"The export format {export_format} is not supported.")
+      abort(400)
+    return Response(stream_with_context(export_questions(export_format, iter_questions())),
+                    mimetype=MIMETYPES_BY_FORMAT[export_format])
+
+
+  '''
+  A GET endpoint for search-as-you-type. It returns up to "limit"
+  questions whose text contains every word of "term", the last word
+  possibly unfinished, from an in-memory prefix index of the question
+  text. Only the suggested rows are read from the database, and the
+  answers are left out.
+  '''
+  @app.route('/questions/autocomplete')
+  @read_only
+  def autocomplete_questions():
+    try:
+      limit = int(request.args.get("limit", AUTOCOMPLETE_LIMIT))
+      if not (1 <= limit <= app.config.get("MAX_AUTOCOMPLETE_LIMIT", MAX_AUTOCOMPLETE_LIMIT)):
+        raise ValueError(f"The limit {limit} is not an allowed number of suggestions.")
+      return jsonify({
+        'success': True,
+        'suggestions': autocomplete.suggest(request.args.get("term", ""), limit),
+      })
+    except Exception as ex:
+      flash(f"An error occurred when looking up suggestions: {ex}")
+      abort(400)
 
 
   '''
   A POST endpoint to get questions based on a search term. 
-  It returns any questions for which the search term 
-  is a substring of the question. 
+  It returns any questions whose question or answer text
+  contains every word of the search term (case-insensitive),
+  best matches first.
 
   TEST: Search by any phrase. The questions list will update to include 
   only question that include that string within their question. 
   Try using the word "title" to start. 
   '''
   @app.route('/questions', methods = ['POST'])
+  @read_only
+  @response_cache.cached(search_params, lambda: [QUESTIONS_TAG])
   def retrieve_question_search():
     try:
-      body = request.get_json()
-      page = body.get("page", 1)
-
-      if 'searchTerm' not in body:
-        raise ValueError("Improperly formatted request")
-      matching_questions = Question.query.filter(Question.question.like("%" + body["searchTerm"] + "%")).all()
+      search_term, page, cursor = parse_search_request(request.get_json())
+      matching_questions, total_questions, next_cursor = search_questions(
+        search_term, page, cursor, backend=app.config.get("SEARCH_BACKEND"))
       return jsonify({
-        'totalQuestions': len(matching_questions),
-        'questions': get_page_range(matching_questions, page),
+        'totalQuestions': total_questions,
+        'questions': matching_questions,
+        'nextCursor': next_cursor,
       })
     except Exception as ex:
       flash(f"An error occurred when attempting to fetch questions matching the search: {ex}")
@@ -210,27 +395,39 @@ def create_app(test_config=None):
   category to be shown. 
   '''
   @app.route('/categories/<category_id>/questions')
+  @read_only
+  @conditional("QUESTIONS_CACHE_CONTROL")
+  @response_cache.cached(listing_params, lambda category_id: [category_tag(category_id)])
   def retrieve_category_questions(category_id):
     try:
       page = int(request.args.get("page", "1"))
-      # all_questions = Question.query.all()
+      cursor = request.args.get("cursor")
 
-      matching_category = Category.query.filter_by(id = category_id).first()
+      matching_category_type = category_registry.get_type(category_id)
 
-      if matching_category is None:
+      if matching_category_type is None:
         raise ValueError("No matching category")
 
-      matching_category_type = matching_category.type
+      category_query = Question.rows().filter(Question.category == int(category_id))
 
-      all_questions = Question.query.filter(Question.category == category_id).all()
+      total_questions = QuestionStat.total(category_id)
 
-      total_questions = len(all_questions)
+      per_page, streamed = parse_listing_args(request.args, app.config)
+      if streamed:
+        streamed_page = StreamedPage(category_query, page, cursor, key=Question.id, per_page=per_page,
+                                     formatter=Question.format_row)
+        return stream_json_response({
+          'currentCategory': matching_category_type,
+          'totalQuestions': total_questions,
+        }, 'questions', streamed_page, lambda: { 'nextCursor': streamed_page.next_cursor })
 
-      matching_questions = get_page_range(all_questions, page)
+      matching_questions, next_cursor = get_page_range(category_query, page, cursor, key=Question.id, per_page=per_page,
+                                                       formatter=Question.format_row)
       return jsonify({
         'questions': matching_questions,
         'totalQuestions': total_questions,
         'currentCategory': matching_category_type,
+        'nextCursor': next_cursor,
       })
     except Exception as ex:
       flash(f"An error occurred when attempting to fetch the questions for the category with id {category_id}: {ex}")
@@ -242,25 +439,38 @@ def create_app(test_config=None):
   This endpoint takes a category parameter and a previous question parameter
   and returns a random question within the given category, 
   if provided, and that is not one of the previous questions. 
+  A category id of 0 stands for "All" categories. An optional
+  difficulty (or list of difficulties) narrows the choice, and in
+  adaptive mode the difficulty follows the reported answers. With
+  a count, that many questions are returned at once, so a whole
+  quiz takes one or two requests. Questions are picked from
+  in-memory buckets of ids per category and difficulty, so only
+  the chosen rows are read from the database, in one query.
 
   TEST: In the "Play" tab, after a user selects "All" or a category,
   one question at a time is displayed, the user is allowed to answer
   and shown whether they were correct or not. 
   '''
   @app.route('/quizzes', methods = ['POST'])
+  @read_only
   def retrieve_quiz_question():
     try:
-      body = request.get_json()
-      matching_question_list = Question.query.filter(Question.category == int(body["quiz_category"]["id"])).filter(Question.id.notin_(body["previous_questions"])).all()
+      category_id, previous_question_ids, difficulty_plan, count = parse_quiz_request(
+        request.get_json(), app.config.get("QUIZ_MAX_QUESTIONS", QUIZ_MAX_QUESTIONS))
+      if count is not None:
+        return jsonify({
+          'questions': [Question.format_row(question) for question in choose_quiz_questions(
+            category_id, previous_question_ids, difficulty_plan, count)],
+        })
 
-      if len(matching_question_list) == 0:
+      chosen_question = choose_quiz_question(category_id, previous_question_ids, difficulty_plan)
+      if chosen_question is None:
         return jsonify({
           'question': None
         })
       else:
-        chosen_index = randint(0, len(matching_question_list)-1)
         return jsonify({
-          'question': matching_question_list[chosen_index].format(),
+          'question': Question.format_row(chosen_question),
         })
     except Exception as ex:
       flash(f"An error occurred when selecting a new question for the quiz: {ex}")
@@ -270,39 +480,138 @@ def create_app(test_config=None):
 
 
   '''
-  Error handlers for all expected errors: 400, 404, 422, 500. 
+  Endpoints for server-side quiz sessions. Creating a session draws a
+  shuffled queue of question ids for the category once; every "next"
+  call then pops an id and reads that single question, so clients no
+  longer resend their previous questions.
+  '''
+  @app.route('/quizzes/sessions', methods = ['POST'])
+  @read_only
+  def create_quiz_session():
+    try:
+      max_questions = app.config.get("QUIZ_SESSION_MAX_QUESTIONS", QUIZ_SESSION_MAX_QUESTIONS)
+      question_ids = quiz_pool.sample(*parse_quiz_session_request(
+        request.get_json(), max_questions, QUIZ_SESSION_QUESTIONS))
+      session_id = quiz_sessions.create(question_ids)
+      return jsonify({
+        'success': True,
+        'session_id': session_id,
+        'total_questions': len(question_ids),
+      })
+    except Exception as ex:
+      flash(f"An error occurred when creating a quiz session: {ex}")
+      abort(400)
+
+
+  @app.route('/quizzes/sessions/<session_id>/next', methods = ['POST'])
+  @read_only
+  def retrieve_quiz_session_question(session_id):
+    try:
+      chosen_question = None
+      while chosen_question is None:
+        question_id = quiz_sessions.pop(session_id)
+        if question_id is None:
+          break
+        # Skip questions deleted since the session was created.
+        chosen_question = Question.rows().filter(Question.id == question_id).first()
+
+      return jsonify({
+        'question': Question.format_row(chosen_question) if chosen_question is not None else None,
+        'remaining': quiz_sessions.remaining(session_id),
+      })
+    except Exception as ex:
+      flash(f"An error occurred when selecting the next question of quiz session {session_id}: {ex}")
+      abort(404)
+
+
+  @app.route('/quizzes/sessions/<session_id>', methods = ['DELETE'])
+  def delete_quiz_session(session_id):
+    if not quiz_sessions.delete(session_id):
+      flash(f"There is no quiz session with id {session_id}.")
+      abort(404)
+    return jsonify({ "success": True })
+
+
+  '''
+  A GET endpoint returning the number of questions overall, per
+  category (broken down by difficulty) and per difficulty. The
+  counts are kept up to date with every change, so this reads a
+  few dozen rows however many questions there are.
+  '''
+  @app.route('/stats')
+  @read_only
+  @conditional("QUESTIONS_CACHE_CONTROL")
+  def retrieve_stats():
+    try:
+      stats = question_stats()
+      categories = {}
+      for category_id, category_type in category_registry.type_map().items():
+        category_stats = stats['categories'].get(category_id, { 'total_questions': 0, 'difficulties': {} })
+        categories[category_id] = { 'type': category_type, **category_stats }
+      return jsonify({
+        'total_questions': stats['total_questions'],
+        'categories': categories,
+        'difficulties': stats['difficulties'],
+      })
+    except Exception as ex:
+      flash(f"An error occurred when attempting to fetch the question statistics: {ex}.")
+      abort(422)
+
+
+  '''
+  An endpoint exporting request, SQL and serialization metrics per
+  endpoint in the Prometheus text format.
+  '''
+  @app.route('/metrics')
+  def retrieve_metrics():
+    return Response(metrics_registry.render(), mimetype='text/plain; version=0.0.4')
+
+
+  '''
+  An endpoint reporting the hit ratios of the response cache (overall
+  and per endpoint) and of the category registry.
+  '''
+  @app.route('/metrics/cache')
+  def retrieve_cache_metrics():
+    return jsonify({
+      'responses': response_cache.stats(),
+      'categories': category_registry.stats(),
+    })
+
+
+  '''
+  Error handlers for all expected errors: 400, 404, 422, 429, 500, 503. 
   '''
   @app.errorhandler(400)
   def bad_request(error):
-    return jsonify({
-      "success": False,
-      "error": 400,
-      "message": f"The request was malformed: {error}"
-    }), 400
+    return jsonify(error_payload(400, error)), 400
 
   @app.errorhandler(404)
   def not_found(error):
-    return jsonify({
-      "success": False,
-      "error": 404,
-      "message": f"The resource was not found: {error}"
-    }), 404
+    return jsonify(error_payload(404, error)), 404
 
   @app.errorhandler(422)
   def unprocessable(error):
-    return jsonify({
-      "success": False,
-      "error": 422,
-      "message": f"The request was properly formatted but it could not be processed: {error}",
-    }), 422
+    return jsonify(error_payload(422, error)), 422
+
+  @app.errorhandler(429)
+  def too_many_requests(error):
+    return jsonify(error_payload(429, error)), 429
 
   @app.errorhandler(500)
   def internal_server_error(error):
-    return jsonify({
-      "success": False,
-      "error": 500,
-      "message": f"There was an internal server error: {error}"
-    }), 500
+    return jsonify(error_payload(500, error)), 500
+
+  @app.errorhandler(503)
+  def service_unavailable(error):
+    return jsonify(error_payload(503, error)), 503
+
+  '''
+  With PRELOAD, the read-mostly data is loaded now, once, by the process
+  that will fork the workers (see preload.py).
+  '''
+  if app.config.get("PRELOAD"):
+    preload(app)
 
   return app
 
@@ -0,0 +1,193 @@
+import math
+import threading
+import time
+from collections import Counter, OrderedDict
+
+from .instrumentation import metrics_registry
+
+
+ADMISSION_QUEUE_DEPTH = 16
+ADMISSION_QUEUE_TIMEOUT = 1.0
+RATE_LIMIT_BURST = 20
+RATE_LIMIT_MAX_CLIENTS = 100000
+# Endpoints that are never limited, so that an overloaded server can still be observed.
+UNLIMITED_ENDPOINTS = frozenset(["retrieve_metrics", "retrieve_cache_metrics", "static"])
+
+
+class Rejection:
+  '''Why a request was turned away: the status code to answer with (429 or 503), the reason reported in the metrics,
+    and the seconds after which the client may retry.
+  '''
+  __slots__ = ('status', 'reason', 'retry_after')
+
+  def __init__(self, status, reason, retry_after):
+    self.status = status
+    self.reason = reason
+    self.retry_after = max(1, math.ceil(retry_after))
+
+  def description(self):
+    return f"the request was {self.reason.replace('_', ' ')}, retry after {self.retry_after} seconds."
+
+
+class ConcurrencyLimit:
+  '''At most limit requests of one endpoint at a time. Up to queue_depth more wait (for at most queue_timeout
+    seconds) for one of them to finish; beyond that, requests are shed at once, before they reach the database.
+  '''
+  def __init__(self, limit, queue_depth=ADMISSION_QUEUE_DEPTH, queue_timeout=ADMISSION_QUEUE_TIMEOUT):
+    self.limit = limit
+    self.queue_depth = queue_depth
+    self.queue_timeout = queue_timeout
+    self.active = 0
+    self.waiting = 0
+    self._condition = threading.Condition()
+
+  def acquire(self, wait=True):
+    '''Take a slot and return None, or return the Rejection of a request that cannot have one.'''
+    with self._condition:
+      if self.active < self.limit:
+        self.active += 1
+        return None
+      if not wait or self.waiting >= self.queue_depth:
+        return Rejection(503, "queue_full", self.queue_timeout)
+      self.waiting += 1
+      try:
+        deadline = time.monotonic() + self.queue_timeout
+        while self.active >= self.limit:
+          remaining = deadline - time.monotonic()
+          if remaining <= 0:
+            return Rejection(503, "queue_timeout", self.queue_timeout)
+          self._condition.wait(remaining)
+        self.active += 1
+        return None
+      finally:
+        self.waiting -= 1
+
+  def release(self):
+    with self._condition:
+      self.active -= 1
+      self._condition.notify()
+
+
+class RateLimiter:
+  '''A token bucket per client: each holds up to burst tokens, refilled at rate tokens per second, and a request
+    takes one. The buckets of the max_clients clients seen most recently are kept; a client forgotten in between
+    starts again with a full bucket.
+  '''
+  def __init__(self, rate, burst=RATE_LIMIT_BURST, max_clients=RATE_LIMIT_MAX_CLIENTS):
+    self.rate = rate
+    self.burst = burst
+    self.max_clients = max_clients
+    self._buckets = OrderedDict()
+    self._lock = threading.Lock()
+
+  def take(self, client):
+    '''Take a token from the bucket of client and return None, or return the Rejection of a client out of tokens.'''
+    now = time.monotonic()
+    with self._lock:
+      bucket = self._buckets.get(client)
+      if bucket is None:
+        bucket = self._buckets[client] = [float(self.burst), now]
+        if len(self._buckets) > self.max_clients:
+          self._buckets.popitem(last=False)
+      else:
+        self._buckets.move_to_end(client)
+        bucket[0] = min(float(self.burst), bucket[0] + (now - bucket[1]) * self.rate)
+        bucket[1] = now
+      if bucket[0] >= 1:
+        bucket[0] -= 1
+        return None
+      return Rejection(429, "rate_limited", (1 - bucket[0]) / self.rate)
+
+  def clients(self):
+    with self._lock:
+      return len(self._buckets)
+
+
+class AdmissionControl:
+  '''Turns requests away before they reach the database when the server is saturated: a per-client rate limit over
+    every endpoint (429), and per-endpoint concurrency limits whose wait queues shed requests once full or after
+    a timeout (503). Both answer with a Retry-After header. Configured from the app config:
+
+      ADMISSION_CONCURRENCY   {endpoint name: requests at a time}, such as {"retrieve_quiz_question": 8}
+      ADMISSION_QUEUE_DEPTH   requests that may wait per limited endpoint (default 16)
+      ADMISSION_QUEUE_TIMEOUT seconds a request may wait (default 1)
+      RATE_LIMIT              requests per second per client (off by default)
+      RATE_LIMIT_BURST        requests a client may send at once (default 20)
+      RATE_LIMIT_CLIENT_HEADER request header naming the client (such as X-Forwarded-For behind a proxy) instead of
+                              the remote address
+  '''
+  def __init__(self):
+    self.limits = {}
+    self.rate_limiter = None
+    self.client_header = None
+    self.admitted = Counter()
+    self.rejected = Counter()
+    self._lock = threading.Lock()
+
+  def configure(self, config):
+    queue_depth = config.get("ADMISSION_QUEUE_DEPTH", ADMISSION_QUEUE_DEPTH)
+    queue_timeout = config.get("ADMISSION_QUEUE_TIMEOUT", ADMISSION_QUEUE_TIMEOUT)
+    self.limits = { endpoint: ConcurrencyLimit(limit, queue_depth, queue_timeout)
+                    for endpoint, limit in (config.get("ADMISSION_CONCURRENCY") or {}).items() }
+    rate = config.get("RATE_LIMIT")
+    self.rate_limiter = RateLimiter(rate, config.get("RATE_LIMIT_BURST", RATE_LIMIT_BURST)) if rate else None
+    self.client_header = config.get("RATE_LIMIT_CLIENT_HEADER")
+    with self._lock:
+      self.admitted.clear()
+      self.rejected.clear()
+
+  def client(self, remote_addr, headers):
+    '''The key of the client of a request, by its remote address or RATE_LIMIT_CLIENT_HEADER.'''
+    if self.client_header:
+      forwarded = headers.get(self.client_header)
+      if forwarded:
+        return forwarded.split(",")[0].strip()
+    return remote_addr
+
+  def admit(self, endpoint, client, wait=True):
+    '''Admit a request to endpoint from client and return None, or return the Rejection of a request to turn away.
+      An admitted request to a limited endpoint holds a slot until release(endpoint). With wait false, requests
+      beyond the concurrency limit are shed instead of queued.
+    '''
+    if endpoint in UNLIMITED_ENDPOINTS:
+      return None
+    rejection = self.rate_limiter.take(client) if self.rate_limiter is not None else None
+    limit = self.limits.get(endpoint)
+    if rejection is None and limit is not None:
+      rejection = limit.acquire(wait)
+    with self._lock:
+      if rejection is None:
+        self.admitted[endpoint] += 1
+      else:
+        self.rejected[(endpoint, rejection.reason)] += 1
+    return rejection
+
+  def release(self, endpoint):
+    limit = self.limits.get(endpoint)
+    if limit is not None:
+      limit.release()
+
+  def collect(self):
+    '''The metrics of metrics_registry: requests admitted and rejected, and the state of the limits.'''
+    with self._lock:
+      admitted = sorted(self.admitted.items())
+      rejected = sorted(self.rejected.items())
+    limits = sorted(self.limits.items())
+    return [
+      ("trivia_admission_admitted_total", "counter", "Requests admitted by admission control.",
+       [([("endpoint", endpoint)], count) for endpoint, count in admitted]),
+      ("trivia_admission_rejected_total", "counter", "Requests turned away by admission control.",
+       [([("endpoint", endpoint), ("reason", reason)], count) for (endpoint, reason), count in rejected]),
+      ("trivia_admission_active", "gauge", "Requests running at limited endpoints.",
+       [([("endpoint", endpoint)], limit.active) for endpoint, limit in limits]),
+      ("trivia_admission_waiting", "gauge", "Requests waiting for a limited endpoint.",
+       [([("endpoint", endpoint)], limit.waiting) for endpoint, limit in limits]),
+      ("trivia_admission_limit", "gauge", "Requests allowed at a time at limited endpoints.",
+       [([("endpoint", endpoint)], limit.limit) for endpoint, limit in limits]),
+      ("trivia_rate_limit_clients", "gauge", "Clients with a token bucket.",
+       [([], self.rate_limiter.clients() if self.rate_limiter is not None else 0)]),
+    ]
+
+
+admission_control = AdmissionControl()
+metrics_registry.add_collector(admission_control.collect)
@@ -0,0 +1,405 @@
+import re
+import time
+from collections import namedtuple
+from contextlib import asynccontextmanager
+from functools import wraps
+
+from sqlalchemy import func
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.orm import Query
+
+from werkzeug.http import parse_date, parse_etags
+
+from models import Category, Question, QuestionStat, category_registry, content_version_query, content_versions
+from . import create_app
+from .admission import admission_control
+from .errors import error_payload
+from .http_cache import DEFAULT_CACHE_CONTROL, content_etag, not_modified, validator_headers
+from .instrumentation import RequestTiming, metrics_registry
+from .json_backend import jsonify
+from .pagination import QUESTIONS_PER_PAGE, page_query, page_result, parse_listing_args
+from .quiz import QUIZ_MAX_QUESTIONS, QuizSelection, quiz_pool
+from .quiz_sessions import QUIZ_SESSION_MAX_QUESTIONS, QUIZ_SESSION_QUESTIONS
+from .response_cache import (QUESTIONS_TAG, MemoryResponseBackend, category_tag, listing_args_params, response_cache,
+                             search_body_params)
+from .search import postgres_search_backend, tokenize
+from .validation import parse_quiz_request, parse_quiz_session_request, parse_search_request
+
+
+ASYNC_DB_POOL_MIN = 1
+ASYNC_DB_POOL_MAX = 10
+# Prepared statements asyncpg keeps per connection (its own default). Every statement of the async endpoints is
+# compiled from a handful of query shapes, so they are all prepared once per connection and then reused.
+ASYNC_DB_STATEMENT_CACHE_SIZE = 100
+
+QuestionRow = namedtuple('QuestionRow', Question.format_fields)
+
+_DIALECT = postgresql.dialect()
+_PARAMETER = re.compile(r"%\((\w+)\)s")
+
+
+def compile_query(query):
+  '''Return (sql, arguments) for running a SQLAlchemy query or statement with asyncpg, which takes $1, $2, ...
+    placeholders. Building statements with the same query objects as the Flask app keeps both apps' SQL identical.
+  '''
+  compiled = getattr(query, 'statement', query).compile(dialect=_DIALECT)
+  names = []
+
+  def placeholder(match):
+    names.append(match.group(1))
+    return f"${len(names)}"
+  sql = _PARAMETER.sub(placeholder, compiled.string).replace("%%", "%")
+  return sql, [compiled.params[name] for name in names]
+
+
+def question_rows():
+  '''Question.rows() without a session, for compiling.'''
+  return Query([getattr(Question, field) for field in Question.format_fields])
+
+
+def _connect_args(config):
+  url = make_url(config["SQLALCHEMY_DATABASE_URI"])
+  if url.get_backend_name() not in ('postgresql', 'postgres'):
+    raise ValueError(f"The async app needs a PostgreSQL database, not {url.get_backend_name()}.")
+  args = {
+    'host': url.host,
+    'port': url.port,
+    'user': url.username,
+    'password': url.password,
+    'database': url.database,
+    'min_size': config.get("ASYNC_DB_POOL_MIN", ASYNC_DB_POOL_MIN),
+    'max_size': config.get("ASYNC_DB_POOL_MAX", ASYNC_DB_POOL_MAX),
+    'statement_cache_size': config.get("ASYNC_DB_STATEMENT_CACHE_SIZE", ASYNC_DB_STATEMENT_CACHE_SIZE),
+  }
+  if config.get("DB_STATEMENT_TIMEOUT_MS"):
+    args['server_settings'] = { 'statement_timeout': str(int(config["DB_STATEMENT_TIMEOUT_MS"])) }
+  if config.get("DB_PGBOUNCER"):
+    # PgBouncer in transaction mode cannot keep prepared statements between transactions.
+    args['statement_cache_size'] = 0
+  return args
+
+
+class AsyncTrivia:
+  '''The read endpoints of the Flask app served natively on asyncio, with queries run through an asyncpg pool.
+    Request parsing, paging, SQL, error bodies, JSON encoding, validators and the response cache are the Flask
+    app's own, so responses are the same bytes with the same caching headers; only the I/O differs. Everything else (writes, import and export, streamed listings, metrics) is
+    passed to the Flask app itself.
+  '''
+  def __init__(self, flask_app, fallback):
+    self.flask_app = flask_app
+    self.config = flask_app.config
+    self.fallback = fallback
+    self.quiz_sessions = flask_app.extensions['quiz_sessions']
+    self.pool = None
+
+  async def fetch(self, request, query):
+    sql, arguments = compile_query(query)
+    timing = request.state.timing
+    started = time.perf_counter()
+    async with self.pool.acquire() as connection:
+      rows = await connection.fetch(sql, *arguments)
+    timing.query_count += 1
+    timing.db_seconds += time.perf_counter() - started
+    timing.rows += len(rows)
+    timing.statements[sql] += 1
+    return rows
+
+  async def fetch_questions(self, request, query):
+    return [QuestionRow(*row) for row in await self.fetch(request, query)]
+
+  async def total(self, request, category=None):
+    rows = await self.fetch(request, QuestionStat.total_query(Query([]), category))
+    return rows[0][0]
+
+  async def count(self, request, query):
+    rows = await self.fetch(request, query.order_by(None).with_entities(func.count(Question.id)))
+    return rows[0][0]
+
+  async def fetch_page(self, request, query, page, cursor, key=Question.id, per_page=QUESTIONS_PER_PAGE):
+    limited_query, position = page_query(query, page, cursor, key, per_page)
+    return page_result(await self.fetch_questions(request, limited_query), position, key, per_page,
+                       Question.format_row)
+
+  async def categories(self, request):
+    if category_registry.stale():
+      category_registry.load_rows(await self.fetch(request, Query([Category.id, Category.type]).order_by(Category.id)))
+    return category_registry
+
+  async def quiz_pools(self, request):
+    '''Return the quiz pool's buckets, reloaded through the asyncpg pool if they are stale. Sampling from them never
+      reaches the app's session, which needs an application context and would block the event loop.
+    '''
+    pools = quiz_pool.fresh()
+    if pools is None:
+      pools = quiz_pool.load_rows(await self.fetch(
+        request, Query([Question.id, Question.category, Question.difficulty]).order_by(Question.id)))
+    return pools
+
+  async def question(self, request, question_id):
+    rows = await self.fetch_questions(request, question_rows().filter(Question.id == question_id))
+    return rows[0] if rows else None
+
+  async def content_version(self, request):
+    current = content_versions.fresh()
+    if current is None:
+      current = content_versions.load_row((await self.fetch(request, content_version_query()))[0])
+    return current
+
+  def json(self, payload, status_code=200):
+    from starlette.responses import Response
+    with self.flask_app.app_context():
+      body = jsonify(payload).get_data()
+    return Response(body, status_code=status_code, media_type='application/json')
+
+  def view(self, endpoint, error_code):
+    '''Decorate an async view the way the Flask views are wrapped: requests pass admission control, failures become
+      the error_code JSON error, and the request is added to the /metrics totals under the Flask endpoint name.
+      Requests beyond an endpoint's concurrency limit are shed at once rather than queued, since a queue would block
+      the event loop. Requests handed over to the Flask app pass its admission control again.
+    '''
+    def decorator(handler):
+      @wraps(handler)
+      async def async_view(request):
+        request.state.timing = timing = RequestTiming()
+        client = admission_control.client(request.client.host if request.client else None, request.headers)
+        rejection = admission_control.admit(endpoint, client, wait=False)
+        if rejection is not None:
+          response = self.json(error_payload(rejection.status, rejection.description()), rejection.status)
+          response.headers['Retry-After'] = str(rejection.retry_after)
+        else:
+          try:
+            response = await handler(request)
+          except Exception:
+            response = self.json(error_payload(error_code), error_code)
+          finally:
+            admission_control.release(endpoint)
+        if response is not self.fallback:
+          metrics_registry.record(endpoint, request.method, response.status_code, timing,
+                                  time.perf_counter() - timing.started)
+        return response
+      return async_view
+    return decorator
+
+  def conditional(self, cache_control_key):
+    '''http_cache.conditional for async views: the same ETag, Last-Modified and Cache-Control headers, and 304 Not
+      Modified for requests that already have the current content.
+    '''
+    from starlette.responses import Response
+
+    def decorator(handler):
+      @wraps(handler)
+      async def conditional_view(request):
+        version, updated_at = await self.content_version(request)
+        headers = validator_headers(version, updated_at, self.config.get(cache_control_key, DEFAULT_CACHE_CONTROL))
+        if not_modified(parse_etags(request.headers.get('if-none-match')),
+                        parse_date(request.headers.get('if-modified-since')), content_etag(version), updated_at):
+          return Response(status_code=304, headers=headers)
+        response = await handler(request)
+        if response is not self.fallback and response.status_code == 200:
+          response.headers.update(headers)
+        return response
+      return conditional_view
+    return decorator
+
+  def cached(self, endpoint, params, tags):
+    '''ResponseCache.cached for async views, with the entries of the Flask views: params is awaited with the request
+      and tags is called with its path parameters. Backends other than process memory are called from the thread
+      pool, since they may wait on the network.
+    '''
+    from starlette.concurrency import run_in_threadpool
+    from starlette.responses import Response
+
+    async def call(function, *args):
+      if isinstance(response_cache.backend, MemoryResponseBackend):
+        return function(*args)
+      return await run_in_threadpool(function, *args)
+
+    def decorator(handler):
+      @wraps(handler)
+      async def cached_view(request):
+        request_params = await params(request) if response_cache.backend is not None else None
+        if request_params is None:
+          return await handler(request)
+        key, body = await call(response_cache.lookup, endpoint, request_params, tags(**request.path_params))
+        if body is not None:
+          return Response(body, media_type='application/json')
+        response = await handler(request)
+        if response is not self.fallback and response.status_code == 200:
+          await call(response_cache.store, key, response.body)
+        return response
+      return cached_view
+    return decorator
+
+  def routes(self):
+    from starlette.routing import Route
+
+    async def listing_request_params(request):
+      return listing_args_params(request.query_params)
+
+    async def search_request_params(request):
+      try:
+        return search_body_params(await request.json())
+      except ValueError:
+        return None
+
+    async def retrieve_all_categories(request):
+      registry = await self.categories(request)
+      return self.json({
+        'message': 'HELLO WORLD',
+        'categories': registry.types(),
+      })
+
+    async def retrieve_category_map(request):
+      registry = await self.categories(request)
+      return self.json({
+        'categories': registry.type_map(),
+      })
+
+    async def questions(request):
+      try:
+        page = int(request.query_params.get("page", "1"))
+      except ValueError:
+        # The Flask view reads the page outside its error handling; let it report the error its own way.
+        return self.fallback
+      per_page, streamed = parse_listing_args(request.query_params, self.config)
+      if streamed:
+        return self.fallback
+      range_questions, next_cursor = await self.fetch_page(
+        request, question_rows(), page, request.query_params.get("cursor"), per_page=per_page)
+      return self.json({
+        'questions': range_questions,
+        'total_questions': await self.total(request),
+        'categories': (await self.categories(request)).type_map(),
+        'next_cursor': next_cursor,
+      })
+
+    async def retrieve_category_questions(request):
+      category_id = request.path_params['category_id']
+      page = int(request.query_params.get("page", "1"))
+      matching_category_type = (await self.categories(request)).get_type(category_id)
+      if matching_category_type is None:
+        raise ValueError("No matching category")
+
+      per_page, streamed = parse_listing_args(request.query_params, self.config)
+      if streamed:
+        return self.fallback
+      category_query = question_rows().filter(Question.category == int(category_id))
+      matching_questions, next_cursor = await self.fetch_page(
+        request, category_query, page, request.query_params.get("cursor"), per_page=per_page)
+      return self.json({
+        'questions': matching_questions,
+        'totalQuestions': await self.total(request, category_id),
+        'currentCategory': matching_category_type,
+        'nextCursor': next_cursor,
+      })
+
+    async def retrieve_question_search(request):
+      search_term, page, cursor = parse_search_request(await request.json())
+      if not tokenize(search_term):
+        matching_questions, next_cursor = await self.fetch_page(request, question_rows(), page, cursor)
+        total_questions = await self.total(request)
+      else:
+        matching_query, ranked_query = postgres_search_backend.queries(question_rows(), search_term)
+        matching_questions, next_cursor = await self.fetch_page(request, ranked_query, page, cursor, key=None)
+        total_questions = await self.count(request, matching_query)
+      return self.json({
+        'totalQuestions': total_questions,
+        'questions': matching_questions,
+        'nextCursor': next_cursor,
+      })
+
+    async def retrieve_quiz_question(request):
+      category_id, previous_question_ids, difficulty_plan, count = parse_quiz_request(
+        await request.json(), self.config.get("QUIZ_MAX_QUESTIONS", QUIZ_MAX_QUESTIONS))
+      selection = QuizSelection(category_id, previous_question_ids, difficulty_plan, count or 1,
+                                await self.quiz_pools(request))
+      question_ids = selection.draw()
+      while question_ids:
+        rows = await self.fetch_questions(request, question_rows().filter(Question.id.in_(question_ids)))
+        selection.accept({ row.id: row for row in rows })
+        question_ids = selection.draw()
+      chosen = selection.chosen
+      if count is not None:
+        return self.json({ 'questions': [Question.format_row(question) for question in chosen] })
+      return self.json({ 'question': Question.format_row(chosen[0]) if chosen else None })
+
+    async def create_quiz_session(request):
+      max_questions = self.config.get("QUIZ_SESSION_MAX_QUESTIONS", QUIZ_SESSION_MAX_QUESTIONS)
+      category_id, length, previous_question_ids, difficulties = parse_quiz_session_request(
+        await request.json(), max_questions, QUIZ_SESSION_QUESTIONS)
+      question_ids = quiz_pool.sample(category_id, length, previous_question_ids, difficulties,
+                                      await self.quiz_pools(request))
+      session_id = self.quiz_sessions.create(question_ids)
+      return self.json({
+        'success': True,
+        'session_id': session_id,
+        'total_questions': len(question_ids),
+      })
+
+    async def retrieve_quiz_session_question(request):
+      session_id = request.path_params['session_id']
+      chosen_question = None
+      while chosen_question is None:
+        question_id = self.quiz_sessions.pop(session_id)
+        if question_id is None:
+          break
+        chosen_question = await self.question(request, question_id)
+      return self.json({
+        'question': Question.format_row(chosen_question) if chosen_question is not None else None,
+        'remaining': self.quiz_sessions.remaining(session_id),
+      })
+
+    categories_conditional = self.conditional("CATEGORIES_CACHE_CONTROL")
+    questions_conditional = self.conditional("QUESTIONS_CACHE_CONTROL")
+    return [
+      Route('/', self.view('retrieve_all_categories', 500)(categories_conditional(retrieve_all_categories))),
+      Route('/categories', self.view('retrieve_category_map', 422)(categories_conditional(retrieve_category_map))),
+      Route('/questions', self.view('questions', 422)(questions_conditional(
+        self.cached('questions', listing_request_params, lambda: [QUESTIONS_TAG])(questions))), methods=['GET']),
+      Route('/questions', self.view('retrieve_question_search', 404)(
+        self.cached('retrieve_question_search', search_request_params, lambda: [QUESTIONS_TAG])(
+          retrieve_question_search)), methods=['POST']),
+      Route('/categories/{category_id}/questions', self.view('retrieve_category_questions', 404)(questions_conditional(
+        self.cached('retrieve_category_questions', listing_request_params,
+                    lambda category_id: [category_tag(category_id)])(retrieve_category_questions)))),
+      Route('/quizzes', self.view('retrieve_quiz_question', 404)(retrieve_quiz_question), methods=['POST']),
+      Route('/quizzes/sessions', self.view('create_quiz_session', 400)(create_quiz_session), methods=['POST']),
+      Route('/quizzes/sessions/{session_id}/next',
+            self.view('retrieve_quiz_session_question', 404)(retrieve_quiz_session_question), methods=['POST']),
+    ]
+
+  @asynccontextmanager
+  async def lifespan(self, app):
+    import asyncpg
+    self.pool = await asyncpg.create_pool(**_connect_args(self.config))
+    try:
+      yield
+    finally:
+      await self.pool.close()
+
+
+def create_asgi_app_for(flask_app):
+  '''Wrap an app made by create_app in an ASGI app; see create_asgi_app.'''
+  from starlette.applications import Starlette
+  from starlette.middleware.wsgi import WSGIMiddleware
+  from starlette.routing import Mount
+
+  fallback = WSGIMiddleware(flask_app)
+  trivia = AsyncTrivia(flask_app, fallback)
+  app = Starlette(routes=trivia.routes() + [Mount('/', app=fallback)], lifespan=trivia.lifespan)
+  app.state.flask_app = flask_app
+  return app
+
+
+def create_asgi_app(test_config=None):
+  '''Create the trivia API as an ASGI app, to be served by an ASGI server such as uvicorn:
+
+      uvicorn --factory flaskr.asgi:create_asgi_app
+
+    The read endpoints (categories, question listings, search and quizzes) run on asyncio with an asyncpg
+    connection pool of ASYNC_DB_POOL_MIN to ASYNC_DB_POOL_MAX connections, so a worker can wait on many queries
+    at once. Every other request is handled by the Flask app from create_app(test_config) in a thread pool. Needs
+    PostgreSQL and the optional starlette and asyncpg packages.
+  '''
+  return create_asgi_app_for(create_app(test_config))
@@ -0,0 +1,321 @@
+import bisect
+import logging
+import threading
+import time
+from array import array
+
+from models import db, Question, observe_questions
+from .search import tokenize
+
+
+logger = logging.getLogger(__name__)
+
+AUTOCOMPLETE_LIMIT = 5
+MAX_AUTOCOMPLETE_LIMIT = 20
+AUTOCOMPLETE_MAX_BYTES = 256 * 1024 * 1024
+# Question ids looked at per lookup at most, so that a one-letter prefix stays fast on a large table.
+MAX_SCANNED_IDS = 20000
+# Checking the text of a question costs about as much as scanning this many ids.
+TEXT_CHECK_COST = 50
+# Rough bytes per distinct token besides its ids: the string, the array header and the dictionary and list slots.
+TOKEN_OVERHEAD = 150
+# Bytes per question entry besides its text: its id, text offset, length and category.
+ENTRY_BYTES = 24
+# The stored category of a question without one.
+NO_CATEGORY = -1
+BUILD_BATCH_SIZE = 10000
+
+
+def _contains(posting, question_id):
+  index = bisect.bisect_left(posting, question_id)
+  return index < len(posting) and posting[index] == question_id
+
+
+class PrefixIndex:
+  '''Sorted tokens of question text (not answers, which suggestions must not give away), each with the ascending
+    ids of the questions containing it, and the text and category of every question, so that suggestions are
+    answered from memory alone. A prefix is looked up by bisecting the tokens, so a lookup costs a binary search
+    plus the ids it returns.
+
+    The entries are kept in arrays ordered by id, with the UTF-8 text of all the questions in one buffer: a few
+    bytes per question besides its text, where a tuple per question would take hundreds. A removed question only
+    leaves a gap in the buffer until the index is rebuilt. Categories are stored as integers, whatever type they
+    arrive as (question records carry them as the client sent them), with NO_CATEGORY for None.
+
+    The index keeps an estimate of its size. Once it grows beyond max_bytes, the longest id lists (those of the
+    most common words) are cut down to posting_cap ids, which only thins out suggestions for those words.
+  '''
+  def __init__(self, max_bytes=AUTOCOMPLETE_MAX_BYTES):
+    self.max_bytes = max_bytes
+    self.tokens = []
+    self.postings = {}
+    self.posting_cap = None
+    self.size_bytes = 0
+    self.ids = array('q')
+    self.starts = array('q')
+    self.lengths = array('i')
+    self.categories = array('i')
+    self.text = bytearray()
+    self._bulk = False
+
+  def _posting(self, token):
+    posting = self.postings.get(token)
+    if posting is None:
+      posting = self.postings[token] = array('q')
+      # While building, the tokens are sorted once at the end (see extend).
+      if not self._bulk:
+        bisect.insort(self.tokens, token)
+      self.size_bytes += TOKEN_OVERHEAD + len(token)
+    return posting
+
+  def _position(self, question_id):
+    position = bisect.bisect_left(self.ids, question_id)
+    if position < len(self.ids) and self.ids[position] == question_id and self.lengths[position] >= 0:
+      return position
+    return None
+
+  def entry(self, question_id):
+    '''Return the text and category of question question_id, or None if it is not in the index.'''
+    position = self._position(question_id)
+    if position is None:
+      return None
+    start = self.starts[position]
+    text = self.text[start:start + self.lengths[position]].decode('utf-8')
+    category = self.categories[position]
+    return text, None if category == NO_CATEGORY else category
+
+  def _set_entry(self, question_id, text, category):
+    data = text.encode('utf-8')
+    category = NO_CATEGORY if category is None else int(category)
+    # Ids mostly arrive in ascending order (always while building), so this is usually an append.
+    position = len(self.ids)
+    if self.ids and self.ids[-1] >= question_id:
+      position = bisect.bisect_left(self.ids, question_id)
+    if position < len(self.ids) and self.ids[position] == question_id:
+      self.starts[position] = len(self.text)
+      self.lengths[position] = len(data)
+      self.categories[position] = category
+    else:
+      self.ids.insert(position, question_id)
+      self.starts.insert(position, len(self.text))
+      self.lengths.insert(position, len(data))
+      self.categories.insert(position, category)
+      self.size_bytes += ENTRY_BYTES
+    self.text += data
+    self.size_bytes += len(data)
+
+  def add(self, question_id, text, category):
+    '''Add question question_id, or replace its text and category if it is in the index already.'''
+    if self._position(question_id) is not None:
+      self.remove(question_id)
+    self._set_entry(question_id, text, category)
+    for token in set(tokenize(text)):
+      posting = self._posting(token)
+      if self.posting_cap is not None and len(posting) >= self.posting_cap:
+        continue
+      if not posting or posting[-1] < question_id:
+        posting.append(question_id)
+      else:
+        index = bisect.bisect_left(posting, question_id)
+        if posting[index] == question_id:
+          continue
+        posting.insert(index, question_id)
+      self.size_bytes += posting.itemsize
+    if self.size_bytes > self.max_bytes:
+      self.enforce_cap()
+
+  def extend(self, rows):
+    '''Add (id, text, category) rows, as a build does. The new tokens are sorted once at the end rather than
+      inserted in order one at a time, which would cost a list insertion each.
+    '''
+    self._bulk = True
+    try:
+      for question_id, text, category in rows:
+        self.add(question_id, text, category)
+    finally:
+      self._bulk = False
+      self.tokens = sorted(self.postings)
+
+  def remove(self, question_id):
+    position = self._position(question_id)
+    if position is None:
+      return
+    text, _ = self.entry(question_id)
+    self.lengths[position] = -1
+    for token in set(tokenize(text)):
+      posting = self.postings.get(token)
+      if posting is None:
+        continue
+      index = bisect.bisect_left(posting, question_id)
+      if index < len(posting) and posting[index] == question_id:
+        del posting[index]
+        self.size_bytes -= posting.itemsize
+      if not posting:
+        del self.postings[token]
+        if not self._bulk:
+          del self.tokens[bisect.bisect_left(self.tokens, token)]
+        self.size_bytes -= TOKEN_OVERHEAD + len(token)
+
+  def enforce_cap(self):
+    '''Cut the longest id lists to the largest common length that brings the index within 90% of max_bytes, which
+      leaves room for the questions added afterwards.
+    '''
+    lengths = sorted((len(posting) for posting in self.postings.values()), reverse=True)
+    fixed_bytes = len(lengths) * TOKEN_OVERHEAD + sum(len(token) for token in self.postings) + \
+                  len(self.ids) * ENTRY_BYTES + len(self.text)
+    budget = max(0, int(self.max_bytes * 0.9) - fixed_bytes) // array('q').itemsize
+    low, high = 1, lengths[0] if lengths else 1
+    while low < high:
+      cap = (low + high + 1) // 2
+      if sum(min(length, cap) for length in lengths) <= budget:
+        low = cap
+      else:
+        high = cap - 1
+    self.posting_cap = low
+    for token, posting in self.postings.items():
+      if len(posting) > low:
+        self.postings[token] = posting[:low]
+    self.size_bytes = fixed_bytes + sum(len(posting) for posting in self.postings.values()) * array('q').itemsize
+    logger.warning("The autocomplete index reached %d bytes; common words now keep %d question ids each.",
+                   self.max_bytes, low)
+
+  def _prefix_ids(self, prefix, required, limit):
+    # The rarest word is checked first, through a set when it is small enough to be converted cheaply; the others
+    # are bisected.
+    rarest = set(required[0]) if required and len(required[0]) <= MAX_SCANNED_IDS else None
+    others = required[1:] if rarest is not None else required
+    question_ids = []
+    seen = set()
+    scanned = 0
+    position = bisect.bisect_left(self.tokens, prefix)
+    while position < len(self.tokens) and self.tokens[position].startswith(prefix):
+      for question_id in self.postings[self.tokens[position]]:
+        scanned += 1
+        if question_id not in seen and (rarest is None or question_id in rarest) and \
+            all(_contains(posting, question_id) for posting in others):
+          seen.add(question_id)
+          question_ids.append(question_id)
+          if len(question_ids) == limit:
+            return question_ids
+        if scanned >= MAX_SCANNED_IDS:
+          return question_ids
+      position += 1
+    return question_ids
+
+  def _prefix_size(self, prefix, at_most):
+    '''Return the number of ids of the tokens starting with prefix, counting no further than at_most.'''
+    size = 0
+    position = bisect.bisect_left(self.tokens, prefix)
+    while position < len(self.tokens) and self.tokens[position].startswith(prefix) and size <= at_most:
+      size += len(self.postings[self.tokens[position]])
+      position += 1
+    return size
+
+  def _word_ids(self, prefix, words, rarest, limit):
+    # Every question with the rarest word is a candidate; it matches if its text has the other words and the prefix.
+    # It is ranked by its first token with the prefix, which is the prefix itself for an exact match, as
+    # _prefix_ids would have found it.
+    ranked = []
+    for question_id in rarest:
+      text, _ = self.entry(question_id)
+      question_tokens = set(tokenize(text))
+      if words <= question_tokens:
+        completions = [token for token in question_tokens if token.startswith(prefix)]
+        if completions:
+          ranked.append((min(completions), question_id))
+    ranked.sort()
+    return [question_id for _, question_id in ranked[:limit]]
+
+  def lookup(self, tokens, limit):
+    '''Return up to limit ids of questions that contain every token of tokens but the last, and a token starting
+      with the last. Questions whose token matches the prefix exactly come first, then the other tokens in
+      alphabetical order, and ids in ascending order within a token.
+
+      With several tokens, a common prefix after a rare word would scan up to MAX_SCANNED_IDS ids for a handful of
+      matches. When checking the text of the few questions with the rarest word is cheaper, that is done instead.
+    '''
+    *words, prefix = tokens
+    words = set(words)
+    required = sorted((self.postings.get(word) for word in words), key=lambda posting: len(posting or ()))
+    if any(posting is None for posting in required):
+      return []
+    if required:
+      text_checks = len(required[0]) * TEXT_CHECK_COST
+      if text_checks < MAX_SCANNED_IDS and text_checks < self._prefix_size(prefix, text_checks):
+        return self._word_ids(prefix, words, required[0], limit)
+    return self._prefix_ids(prefix, required, limit)
+
+
+class Autocomplete:
+  '''The prefix index of the questions table behind /questions/autocomplete. It is built with one pass over the
+    table on first use (or at startup with AUTOCOMPLETE_PRELOAD), follows this process' commits through the
+    question change observers, and is rebuilt after ttl seconds to pick up changes made by other processes.
+  '''
+  def __init__(self, ttl=3600, max_bytes=AUTOCOMPLETE_MAX_BYTES):
+    self.ttl = ttl
+    self.max_bytes = max_bytes
+    self.index = None
+    self._built_at = 0
+    self._lock = threading.Lock()
+    self._build_lock = threading.Lock()
+
+  def configure(self, config):
+    self.ttl = config.get("AUTOCOMPLETE_TTL", self.ttl)
+    self.max_bytes = config.get("AUTOCOMPLETE_MAX_BYTES", self.max_bytes)
+    self.index = None
+
+  def build(self):
+    '''Build the index from the questions table and return it. Must run inside an application context.'''
+    index = PrefixIndex(self.max_bytes)
+    index.extend(db.session.query(Question.id, Question.question, Question.category).order_by(Question.id)
+                 .execution_options(stream_results=True).yield_per(BUILD_BATCH_SIZE))
+    with self._lock:
+      self.index = index
+      self._built_at = time.monotonic()
+    return index
+
+  def _fresh_index(self):
+    with self._lock:
+      if self.index is not None and time.monotonic() - self._built_at <= self.ttl:
+        return self.index
+    return None
+
+  def _current_index(self):
+    index = self._fresh_index()
+    if index is None:
+      # One request builds the index while the others wait for it.
+      with self._build_lock:
+        index = self._fresh_index() or self.build()
+    return index
+
+  def on_question_change(self, event_name, records):
+    with self._lock:
+      if self.index is None:
+        return
+      if event_name == 'reset':
+        self.index = None
+        return
+      for record in records:
+        if event_name == 'delete':
+          self.index.remove(record['id'])
+        else:
+          self.index.add(record['id'], record['question'], record['category'])
+
+  def suggest(self, term, limit=AUTOCOMPLETE_LIMIT):
+    '''Return up to limit questions whose text contains every word of term, the last one possibly unfinished, as
+      dictionaries of their id, question and category. The index holds all three, so no query is made.
+    '''
+    tokens = tokenize(term)
+    if not tokens:
+      return []
+    index = self._current_index()
+    suggestions = []
+    with self._lock:
+      for question_id in index.lookup(tokens, limit):
+        question, category = index.entry(question_id)
+        suggestions.append({ 'id': question_id, 'question': question, 'category': category })
+    return suggestions
+
+
+autocomplete = Autocomplete()
+observe_questions(autocomplete.on_question_change)
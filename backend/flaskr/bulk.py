@@ -0,0 +1,389 @@
+import csv
+import io
+import json
+from collections import Counter
+
+import click
+from sqlalchemy import and_, select, text
+
+from models import (db, Question, QuestionStat, MAX_NOTIFIED_CHANGES, adjust_question_stats, bump_content_version,
+                    notify_question_observers)
+from .duplicates import DUPLICATE_POLICIES, ImportDuplicates, near_duplicates
+from .streaming import chunked
+from .validation import QUESTION_FIELDS, validate_question
+
+
+IMPORT_BATCH_SIZE = 1000
+MAX_REPORTED_ERRORS = 1000
+MAX_BULK_IDS = 10000
+EXPORT_FIELDS = ["id"] + QUESTION_FIELDS
+FORMATS_BY_MIMETYPE = {
+  "application/x-ndjson": "ndjson",
+  "application/jsonlines": "ndjson",
+  "text/csv": "csv",
+}
+MIMETYPES_BY_FORMAT = {
+  "ndjson": "application/x-ndjson",
+  "csv": "text/csv",
+}
+
+
+class UndecodableLine(str):
+  '''Stands in for a line that is not valid in the encoding of its import: it reads as a blank line, and the
+    parsers report its error instead.
+  '''
+  def __new__(cls, encoding):
+    line = super().__new__(cls, "\n")
+    line.error = ValueError(f"The line is not valid {encoding.upper()}.")
+    return line
+
+
+def read_lines(stream, encoding="utf-8"):
+  '''Yield the decoded lines of a binary stream one at a time, without reading all of it into memory. A line that
+    cannot be decoded is yielded as an UndecodableLine, so that it is reported like any other invalid line.
+  '''
+  for raw_line in iter(stream.readline, b""):
+    try:
+      yield raw_line.decode(encoding)
+    except UnicodeDecodeError:
+      yield UndecodableLine(encoding)
+
+
+def parse_ndjson(lines):
+  '''Yield (line number, question values) for every non-blank line of newline-delimited JSON. The values are
+    those returned by validate_question, or the ValueError explaining why the line is not a valid question.
+  '''
+  for line_number, line in enumerate(lines, 1):
+    if isinstance(line, UndecodableLine):
+      yield line_number, line.error
+      continue
+    if not line.strip():
+      continue
+    try:
+      yield line_number, validate_question(json.loads(line))
+    except ValueError as ex:
+      yield line_number, ex
+
+
+def parse_csv(lines):
+  '''Like parse_ndjson, for CSV with a header row naming (at least) the question, answer, category and difficulty
+    columns.
+  '''
+  undecodable = []
+
+  def checked_lines():
+    # Undecodable lines read as blank lines, which the reader skips; their errors come before the next row.
+    for line_number, line in enumerate(lines, 1):
+      if isinstance(line, UndecodableLine):
+        undecodable.append((line_number, line.error))
+      yield line
+
+  reader = csv.DictReader(checked_lines())
+  for row in reader:
+    yield from undecodable
+    undecodable.clear()
+    try:
+      body = { field: row.get(field) or None for field in QUESTION_FIELDS }
+      for field in ("category", "difficulty"):
+        if body[field] is not None:
+          body[field] = int(body[field])
+      yield reader.line_num, validate_question(body)
+    except ValueError as ex:
+      yield reader.line_num, ex
+  yield from undecodable
+
+
+def parse_rows(lines, import_format):
+  if import_format == "ndjson":
+    return parse_ndjson(lines)
+  if import_format == "csv":
+    return parse_csv(lines)
+  raise ValueError(f"The import format {import_format} is not supported.")
+
+
+def write_question_rows(rows):
+  '''Insert rows of question values (in QUESTION_FIELDS order) in the current transaction with one statement:
+    COPY on PostgreSQL, a single executemany elsewhere. The content version and question counts are updated in the
+    same transaction. On PostgreSQL the ids are drawn from the id sequence up front, and the inserted questions are
+    returned as formatted records; elsewhere their ids are not known and None is returned.
+  '''
+  bump_content_version(db.session)
+  adjust_question_stats(db.session, Counter(QuestionStat.key(category, difficulty)
+                                            for _, _, category, difficulty in rows))
+  connection = db.session.connection()
+  if connection.dialect.name == "postgresql":
+    question_ids = connection.execute(text("SELECT nextval(pg_get_serial_sequence(:table, 'id')) "
+                                           "FROM generate_series(1, :count)"),
+                                      table=Question.__tablename__, count=len(rows)).fetchall()
+    rows = [(question_id, *row) for (question_id,), row in zip(question_ids, rows)]
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows(rows)
+    buffer.seek(0)
+    cursor = connection.connection.cursor()
+    cursor.copy_expert(f"COPY {Question.__tablename__} ({', '.join(EXPORT_FIELDS)}) FROM STDIN WITH (FORMAT csv)",
+                       buffer)
+    return [dict(zip(EXPORT_FIELDS, row)) for row in rows]
+  connection.execute(Question.__table__.insert(), [dict(zip(QUESTION_FIELDS, row)) for row in rows])
+  return None
+
+
+class QuestionImporter:
+  '''Streams parsed rows into the questions table, committing once per batch_size valid rows. Invalid rows are
+    reported and skipped. If the database rejects a batch (for example a row naming a category that does not
+    exist), the batch is retried row by row so that only the offending rows are reported.
+
+    With a duplicate_policy of 'flag' or 'reject', every row is checked against the stored questions and the rows
+    imported before it: near-duplicates are reported, and with 'reject' they are skipped like invalid rows. Rows that
+    are skipped or fail to be written are not held against the rows after them.
+  '''
+  def __init__(self, batch_size=IMPORT_BATCH_SIZE, duplicate_policy="off"):
+    if batch_size < 1:
+      raise ValueError(f"The batch size {batch_size} is not a positive integer.")
+    self.batch_size = batch_size
+    self.duplicate_policy = duplicate_policy
+    self.duplicates = ImportDuplicates(near_duplicates) if duplicate_policy != "off" else None
+    self.inserted = 0
+    self.error_count = 0
+    self.errors = []
+    self.duplicate_rows = []
+    self._reset_needed = False
+
+  def _is_rejected_duplicate(self, line_number, values):
+    question_ids, line_numbers = self.duplicates.check(line_number, values[0], values[1])
+    if not (question_ids or line_numbers):
+      return False
+    if self.duplicate_policy == "reject":
+      self.duplicates.forget(line_number)
+      self._error(line_number, ValueError(
+        "The question is a near-duplicate of " + (f"question {question_ids[0]}." if question_ids
+                                                   else f"line {line_numbers[0]}.")))
+      return True
+    if len(self.duplicate_rows) < MAX_REPORTED_ERRORS:
+      self.duplicate_rows.append({ "line": line_number, "questions": question_ids, "lines": line_numbers })
+    return False
+
+  def _error(self, line_number, ex):
+    self.error_count += 1
+    if len(self.errors) < MAX_REPORTED_ERRORS:
+      message = str(getattr(ex, "orig", ex)).strip().split("\n")[0]
+      self.errors.append({ "line": line_number, "message": message })
+
+  def _committed(self, records):
+    # The rows bypassed the ORM, so the change observers are told here. When their ids are not known, caches built
+    # from the questions table are rebuilt from scratch once the import is over.
+    if records is None:
+      self._reset_needed = True
+      return
+    notify_question_observers('insert', records)
+    if self.duplicates is not None:
+      self.duplicates.imported(record["id"] for record in records)
+
+  def _write(self, batch):
+    try:
+      records = write_question_rows([values for _, values in batch])
+      db.session.commit()
+      self.inserted += len(batch)
+      self._committed(records)
+      return
+    except Exception:
+      db.session.rollback()
+
+    for line_number, values in batch:
+      try:
+        records = write_question_rows([values])
+        db.session.commit()
+        self.inserted += 1
+        self._committed(records)
+      except Exception as ex:
+        db.session.rollback()
+        self._error(line_number, ex)
+        if self.duplicates is not None:
+          self.duplicates.forget(line_number)
+
+  def run(self, parsed_rows):
+    '''Import parsed_rows (as yielded by parse_ndjson or parse_csv) and return a report of the rows inserted and
+      the errors found.
+    '''
+    batch = []
+    try:
+      for line_number, values in parsed_rows:
+        if isinstance(values, Exception):
+          self._error(line_number, values)
+          continue
+        if self.duplicates is not None and self._is_rejected_duplicate(line_number, values):
+          continue
+        batch.append((line_number, values))
+        if len(batch) >= self.batch_size:
+          self._write(batch)
+          batch = []
+      if batch:
+        self._write(batch)
+    finally:
+      if self._reset_needed:
+        notify_question_observers('reset', [])
+
+    return {
+      "inserted": self.inserted,
+      "error_count": self.error_count,
+      "errors": sorted(self.errors, key=lambda error: error["line"]),
+      "duplicates": self.duplicate_rows,
+    }
+
+
+def question_filter(ids=None, category_id=None, difficulties=None):
+  '''The where clause selecting the questions with the given ids, category and difficulties (the parts that are not
+    None), as returned by parse_question_selection.
+  '''
+  table = Question.__table__
+  clauses = []
+  if ids is not None:
+    clauses.append(table.c.id.in_(ids))
+  if category_id is not None:
+    clauses.append(table.c.category == category_id)
+  if difficulties is not None:
+    clauses.append(table.c.difficulty.in_(sorted(difficulties)))
+  return and_(*clauses)
+
+
+def _change_questions(where, statement, changes=None):
+  '''Run statement (a delete or update of the questions table) on the questions matching where in the current
+    transaction, with the question counts and content version updated in the same transaction, and return the
+    changed questions as formatted records (as they were before a delete, or after an update). On PostgreSQL the
+    statement returns the rows it changes. Elsewhere they are read first; SQLite runs one write transaction at a
+    time, so the rows cannot change in between.
+  '''
+  table = Question.__table__
+  columns = [table.c[field] for field in Question.format_fields]
+  connection = db.session.connection()
+  bump_content_version(db.session)
+  if connection.dialect.name == "postgresql":
+    if changes is None:
+      statement = statement.where(where).returning(*columns, table.c.category.label("old_category"),
+                                                   table.c.difficulty.label("old_difficulty"))
+    else:
+      # The old values of updated rows are only visible through a join, which also locks them before the update.
+      old = select([table.c.id, table.c.category, table.c.difficulty]).where(where).with_for_update().alias("old")
+      statement = statement.where(table.c.id == old.c.id).returning(
+        *columns, old.c.category.label("old_category"), old.c.difficulty.label("old_difficulty"))
+    rows = connection.execute(statement).fetchall()
+  else:
+    rows = connection.execute(select([*columns, table.c.category.label("old_category"),
+                                      table.c.difficulty.label("old_difficulty")]).where(where)).fetchall()
+    connection.execute(statement.where(where))
+    if changes is not None:
+      rows = [(*(changes.get(field, value) for field, value in zip(Question.format_fields, row[:-2])), *row[-2:])
+              for row in rows]
+
+  records = []
+  deltas = Counter()
+  for row in rows:
+    record = Question.format_row(row[:-2])
+    deltas[QuestionStat.key(*row[-2:])] -= 1
+    if changes is not None:
+      deltas[QuestionStat.key(record["category"], record["difficulty"])] += 1
+    records.append(record)
+  adjust_question_stats(db.session, deltas)
+  return records
+
+
+def _commit_change(where, statement, changes=None):
+  try:
+    records = _change_questions(where, statement, changes)
+    db.session.commit()
+  except Exception:
+    db.session.rollback()
+    raise
+  # The rows bypassed the ORM, so the change observers are told here. Past MAX_NOTIFIED_CHANGES questions, caches
+  # built from the questions table are rebuilt from scratch instead of following the questions one by one.
+  if len(records) > MAX_NOTIFIED_CHANGES:
+    notify_question_observers('reset', [])
+  elif records:
+    notify_question_observers('delete' if changes is None else 'update', records)
+  return len(records)
+
+
+def delete_questions(where):
+  '''Delete the questions matching where (see question_filter) with one statement, in one transaction, and return
+    the number deleted.
+  '''
+  return _commit_change(where, Question.__table__.delete())
+
+
+def update_questions(where, changes):
+  '''Set the columns of changes (as returned by parse_question_changes) on the questions matching where with one
+    statement, in one transaction, and return the number updated.
+  '''
+  return _commit_change(where, Question.__table__.update().values(**changes), changes)
+
+
+def iter_questions(query=None, batch_size=IMPORT_BATCH_SIZE):
+  '''Yield every question of query (a Question.rows() query, all questions by default) as a formatted dictionary,
+    ordered by id. Rows are read through a server-side cursor batch_size at a time, so the table is never held in
+    memory.
+  '''
+  if query is None:
+    query = Question.rows()
+  query = query.order_by(Question.id).execution_options(stream_results=True).yield_per(batch_size)
+  for row in query:
+    yield Question.format_row(row)
+
+
+def _ndjson_lines(records):
+  for record in records:
+    yield json.dumps(record) + "\n"
+
+
+def _csv_lines(records):
+  buffer = io.StringIO()
+  writer = csv.writer(buffer)
+  writer.writerow(EXPORT_FIELDS)
+  for record in records:
+    writer.writerow([record[field] for field in EXPORT_FIELDS])
+    yield buffer.getvalue()
+    buffer.seek(0)
+    buffer.truncate()
+  yield buffer.getvalue()
+
+
+def export_questions(export_format, records):
+  '''Yield records serialized in export_format ('ndjson' or 'csv') in chunks suitable for a streamed response.'''
+  if export_format == "ndjson":
+    return chunked(_ndjson_lines(records))
+  if export_format == "csv":
+    return chunked(_csv_lines(records))
+  raise ValueError(f"The export format {export_format} is not supported.")
+
+
+def register_bulk_commands(app):
+  '''Add the import-questions and export-questions commands to the flask command line.'''
+  @app.cli.command("import-questions")
+  @click.argument("path", type=click.Path(exists=True, dir_okay=False))
+  @click.option("--format", "import_format", type=click.Choice(sorted(MIMETYPES_BY_FORMAT)),
+                help="Defaults to csv for .csv files and ndjson otherwise.")
+  @click.option("--batch-size", default=IMPORT_BATCH_SIZE, show_default=True, help="Rows per transaction.")
+  @click.option("--duplicates", type=click.Choice(DUPLICATE_POLICIES),
+                help="Report (flag) or skip (reject) near-duplicate questions. Defaults to DUPLICATE_POLICY.")
+  def import_questions_command(path, import_format, batch_size, duplicates):
+    '''Import questions from an NDJSON or CSV file.'''
+    import_format = import_format or ("csv" if path.endswith(".csv") else "ndjson")
+    with open(path, "rb") as stream:
+      report = QuestionImporter(batch_size, duplicates or near_duplicates.policy).run(
+        parse_rows(read_lines(stream), import_format))
+    for error in report["errors"]:
+      click.echo(f"line {error['line']}: {error['message']}", err=True)
+    for duplicate in report["duplicates"]:
+      similar = [f"question {question_id}" for question_id in duplicate["questions"]]
+      similar += [f"line {line}" for line in duplicate["lines"]]
+      click.echo(f"line {duplicate['line']}: near-duplicate of {', '.join(similar)}", err=True)
+    click.echo(f"Imported {report['inserted']} questions, {report['error_count']} rows rejected.")
+
+  @app.cli.command("export-questions")
+  @click.argument("path", type=click.Path(dir_okay=False, writable=True))
+  @click.option("--format", "export_format", type=click.Choice(sorted(MIMETYPES_BY_FORMAT)),
+                help="Defaults to csv for .csv files and ndjson otherwise.")
+  def export_questions_command(path, export_format):
+    '''Export every question to an NDJSON or CSV file.'''
+    export_format = export_format or ("csv" if path.endswith(".csv") else "ndjson")
+    with open(path, "w", encoding="utf-8", newline="") as output:
+      for chunk in export_questions(export_format, iter_questions()):
+        output.write(chunk)
@@ -0,0 +1,43 @@
+import time
+
+import click
+
+from migrations import MIGRATIONS, applied_migrations, migrate
+from models import db, init_db, reconcile_question_stats
+
+
+def register_db_commands(app):
+  '''Add the init-db, migrate and reconcile-stats commands to the flask command line.'''
+  @app.cli.command("init-db")
+  def init_db_command():
+    '''Create the tables that are missing and apply the pending migrations.'''
+    for migration_id in init_db():
+      click.echo(f"Applied {migration_id}.")
+    click.echo("Initialized the database.")
+
+  @app.cli.command("migrate")
+  @click.option("--list", "list_only", is_flag=True, help="List the migrations and whether they are applied.")
+  def migrate_command(list_only):
+    '''Apply the pending schema migrations.'''
+    if list_only:
+      applied = applied_migrations(db.engine)
+      for migration_id, _ in MIGRATIONS:
+        click.echo(f"{migration_id}  {applied[migration_id].isoformat(timespec='seconds') if migration_id in applied else 'pending'}")
+      return
+    for migration_id in migrate(db.engine):
+      click.echo(f"Applied {migration_id}.")
+    click.echo("The database is up to date.")
+
+  @app.cli.command("reconcile-stats")
+  @click.option("--interval", type=float, help="Keep running, reconciling every INTERVAL seconds.")
+  def reconcile_stats_command(interval):
+    '''Recount the questions and repair the question counts that drifted from the table.'''
+    while True:
+      drift = reconcile_question_stats(db.session)
+      db.session.commit()
+      for category, difficulty, stored, actual in drift:
+        click.echo(f"Category {category!r}, difficulty {difficulty}: {stored} counted, {actual} found.")
+      click.echo(f"Reconciled the question counts ({len(drift)} fixed).")
+      if interval is None:
+        return
+      time.sleep(interval)
@@ -0,0 +1,377 @@
+import bisect
+import threading
+import time
+import zlib
+from array import array
+from collections import Counter
+from itertools import chain
+
+import click
+
+from models import db, Question, observe_questions
+from .search import tokenize
+
+
+SHINGLE_SIZE = 5
+SIGNATURE_SIZE = 32
+BANDS = 8
+ROWS_PER_BAND = SIGNATURE_SIZE // BANDS
+# Questions at least this similar (the Jaccard similarity of their shingles) are near-duplicates. With 8 bands of
+# 4 rows, a pair this similar becomes a candidate with a probability of about 98.5%.
+DUPLICATE_THRESHOLD = 0.8
+DUPLICATE_POLICIES = ("off", "flag", "reject")
+DEFAULT_DUPLICATE_POLICY = "off"
+BUILD_BATCH_SIZE = 10000
+# Candidates verified per lookup at most, so that a question with thousands of near-copies stays cheap to check.
+MAX_CANDIDATES = 100
+# Pending entries are merged into the sorted entries once they reach this number, or an eighth of the entries, and
+# removed entries are compacted away at the same point.
+MIN_MERGE_SIZE = 4096
+
+_BIN_BITS = SIGNATURE_SIZE.bit_length() - 1
+_BIN_MASK = SIGNATURE_SIZE - 1
+_EMPTY = 1 << (32 - _BIN_BITS)
+_ID_BITS = 32
+_ID_MASK = (1 << _ID_BITS) - 1
+
+
+def shingles(question, answer):
+  '''Return the set of overlapping SHINGLE_SIZE-character pieces of the normalized question and answer text.'''
+  text = " ".join(tokenize(f"{question} {answer}"))
+  if len(text) <= SHINGLE_SIZE:
+    return { text }
+  return { text[start:start + SHINGLE_SIZE] for start in range(len(text) - SHINGLE_SIZE + 1) }
+
+
+def signature(shingle_set):
+  '''Return the MinHash signature of a set of shingles by one-permutation hashing: each shingle's CRC32 picks one
+    of SIGNATURE_SIZE bins (its low bits) and the signature keeps the smallest rest of the hash per bin. Empty bins
+    borrow the value of the next bin that is not empty, offset by the distance. Two signatures agree in about the
+    same share of bins as the Jaccard similarity of their sets, for one hash per shingle instead of one per bin.
+  '''
+  minimums = [_EMPTY] * SIGNATURE_SIZE
+  for shingle in shingle_set:
+    value = zlib.crc32(shingle.encode("utf-8"))
+    position = value & _BIN_MASK
+    value >>= _BIN_BITS
+    if value < minimums[position]:
+      minimums[position] = value
+  if _EMPTY in minimums:
+    filled = list(minimums)
+    for position in range(SIGNATURE_SIZE):
+      distance = 1
+      while filled[position] == _EMPTY:
+        borrowed = minimums[(position + distance) % SIGNATURE_SIZE]
+        if borrowed != _EMPTY:
+          filled[position] = borrowed + distance * _EMPTY
+        distance += 1
+    minimums = filled
+  return tuple(minimums)
+
+
+def band_keys(question_signature):
+  '''Return one 32-bit key per band of the signature; questions sharing any key are candidate duplicates.'''
+  return [hash((band,) + question_signature[band * ROWS_PER_BAND:(band + 1) * ROWS_PER_BAND]) & _ID_MASK
+          for band in range(BANDS)]
+
+
+def jaccard(first, second):
+  return len(first & second) / len(first | second) if first or second else 1.0
+
+
+def estimated_similarity(first_signature, second_signature):
+  return sum(first == second for first, second in zip(first_signature, second_signature)) / SIGNATURE_SIZE
+
+
+class LSHIndex:
+  '''Locality-sensitive hashing index of MinHash signatures. Every question has one entry per band, a band key and
+    its id packed into a 64-bit integer, so the entries fit one sorted array (64 bytes per question) and the
+    questions of a key are found by bisecting it. New entries wait in a small dictionary until they are merged in,
+    and removed entries are only marked as such (deleting from the array would move everything after them) until
+    enough have piled up to compact the array in one pass.
+  '''
+  def __init__(self):
+    self.entries = array('Q')
+    self.pending = {}
+    self.pending_count = 0
+    self.removed = set()
+
+  def load(self, entries):
+    '''Replace the index with unsorted packed entries, as returned by entries_for.'''
+    self.entries = array('Q', sorted(entries))
+    self.pending = {}
+    self.pending_count = 0
+    self.removed = set()
+
+  def _batch_size(self):
+    return max(MIN_MERGE_SIZE, len(self.entries) // 8)
+
+  @staticmethod
+  def entries_for(question_id, question_signature):
+    return [(key << _ID_BITS) | question_id for key in band_keys(question_signature)]
+
+  def add(self, question_id, question_signature):
+    for key in band_keys(question_signature):
+      entry = (key << _ID_BITS) | question_id
+      if entry in self.removed:
+        # The entry is still in the array.
+        self.removed.discard(entry)
+        continue
+      self.pending.setdefault(key, []).append(question_id)
+      self.pending_count += 1
+    if self.pending_count >= self._batch_size():
+      self._merge()
+
+  def _merge(self):
+    if not self.pending:
+      return
+    pending = sorted((key << _ID_BITS) | question_id
+                     for key, question_ids in self.pending.items() for question_id in question_ids)
+    # Both runs are sorted already, which sorted() merges in linear time.
+    self.entries = array('Q', sorted(chain(self.entries, pending)))
+    self.pending = {}
+    self.pending_count = 0
+
+  def _compact(self):
+    if not self.removed:
+      return
+    removed = self.removed
+    self.entries = array('Q', (entry for entry in self.entries if entry not in removed))
+    self.removed = set()
+
+  def remove(self, question_id, question_signature):
+    for key in band_keys(question_signature):
+      entry = (key << _ID_BITS) | question_id
+      question_ids = self.pending.get(key)
+      if question_ids and question_id in question_ids:
+        question_ids.remove(question_id)
+        self.pending_count -= 1
+      position = bisect.bisect_left(self.entries, entry)
+      if position < len(self.entries) and self.entries[position] == entry:
+        self.removed.add(entry)
+    if len(self.removed) >= self._batch_size():
+      self._compact()
+
+  def candidates(self, question_signature, limit=None):
+    '''Return the set of ids of the questions sharing a band key with the signature. Past limit, only the ids
+      sharing the most band keys (the likeliest to be similar) are kept.
+    '''
+    found = Counter()
+    for key in band_keys(question_signature):
+      start = bisect.bisect_left(self.entries, key << _ID_BITS)
+      end = bisect.bisect_left(self.entries, (key + 1) << _ID_BITS, start)
+      if self.removed:
+        found.update(entry & _ID_MASK for entry in self.entries[start:end] if entry not in self.removed)
+      else:
+        found.update(entry & _ID_MASK for entry in self.entries[start:end])
+      found.update(self.pending.get(key, ()))
+    if limit is None or len(found) <= limit:
+      return set(found)
+    return { question_id for question_id, _ in found.most_common(limit) }
+
+  def buckets(self):
+    '''Yield the ids of every band key shared by more than one question.'''
+    self._merge()
+    self._compact()
+    start = 0
+    while start < len(self.entries):
+      key = self.entries[start] >> _ID_BITS
+      end = bisect.bisect_left(self.entries, (key + 1) << _ID_BITS, start)
+      if end - start > 1:
+        yield [entry & _ID_MASK for entry in self.entries[start:end]]
+      start = end
+
+  def size_bytes(self):
+    return self.entries.itemsize * len(self.entries) + 100 * (self.pending_count + len(self.removed))
+
+
+def _question_signatures(batch_size=BUILD_BATCH_SIZE):
+  rows = (db.session.query(Question.id, Question.question, Question.answer).order_by(Question.id)
+          .execution_options(stream_results=True).yield_per(batch_size))
+  for question_id, question, answer in rows:
+    yield question_id, signature(shingles(question, answer))
+
+
+class NearDuplicates:
+  '''The similarity index of the questions table, consulted when questions are added. It is built with one pass
+    over the table when the app starts (if the policy is not 'off') or on first use, follows this process' commits through the question change observers, and is
+    rebuilt after ttl seconds to pick up changes made by other processes. Candidates are confirmed against their
+    current text, so entries left behind by updated questions do no harm.
+  '''
+  def __init__(self, ttl=3600, threshold=DUPLICATE_THRESHOLD, policy=DEFAULT_DUPLICATE_POLICY):
+    self.ttl = ttl
+    self.threshold = threshold
+    self.policy = policy
+    self.index = None
+    self._built_at = 0
+    self._lock = threading.Lock()
+    self._build_lock = threading.Lock()
+
+  def configure(self, config):
+    self.ttl = config.get("DUPLICATE_INDEX_TTL", self.ttl)
+    self.threshold = config.get("DUPLICATE_THRESHOLD", DUPLICATE_THRESHOLD)
+    self.policy = config.get("DUPLICATE_POLICY", DEFAULT_DUPLICATE_POLICY)
+    if self.policy not in DUPLICATE_POLICIES:
+      raise ValueError(f"Unknown duplicate policy {self.policy}.")
+    self.index = None
+
+  def build(self):
+    '''Build the index from the questions table and return it. Must run inside an application context.'''
+    entries = array('Q')
+    for question_id, question_signature in _question_signatures():
+      entries.extend(LSHIndex.entries_for(question_id, question_signature))
+    index = LSHIndex()
+    index.load(entries)
+    with self._lock:
+      self.index = index
+      self._built_at = time.monotonic()
+    return index
+
+  def _fresh_index(self):
+    with self._lock:
+      if self.index is not None and time.monotonic() - self._built_at <= self.ttl:
+        return self.index
+    return None
+
+  def _current_index(self):
+    index = self._fresh_index()
+    if index is None:
+      with self._build_lock:
+        index = self._fresh_index() or self.build()
+    return index
+
+  def on_question_change(self, event_name, records):
+    with self._lock:
+      if self.index is None:
+        return
+      if event_name == 'reset':
+        self.index = None
+        return
+      for record in records:
+        question_signature = signature(shingles(record['question'], record['answer']))
+        if event_name == 'delete':
+          self.index.remove(record['id'], question_signature)
+        else:
+          self.index.add(record['id'], question_signature)
+
+  def find(self, question, answer, exclude_id=None):
+    '''Return the stored questions at least threshold similar to question and answer, as dictionaries of their id
+      and similarity, most similar first. Only candidates sharing a band key are read from the database, at most
+      MAX_CANDIDATES of them.
+    '''
+    question_shingles = shingles(question, answer)
+    index = self._current_index()
+    with self._lock:
+      candidate_ids = index.candidates(signature(question_shingles), MAX_CANDIDATES)
+    candidate_ids.discard(exclude_id)
+    if not candidate_ids:
+      return []
+    duplicates = []
+    rows = db.session.query(Question.id, Question.question, Question.answer).filter(Question.id.in_(candidate_ids))
+    for candidate_id, candidate_question, candidate_answer in rows:
+      similarity = jaccard(question_shingles, shingles(candidate_question, candidate_answer))
+      if similarity >= self.threshold:
+        duplicates.append({ "id": candidate_id, "similarity": round(similarity, 3) })
+    return sorted(duplicates, key=lambda duplicate: (-duplicate["similarity"], duplicate["id"]))
+
+
+class ImportDuplicates:
+  '''Near-duplicate checks for one import: rows are compared with the stored questions and with the rows imported
+    before them, by line number and signature. The questions the import has committed already are left out of the
+    stored questions, so that they are reported once, as lines.
+  '''
+  def __init__(self, near_duplicates):
+    self.near_duplicates = near_duplicates
+    self.index = LSHIndex()
+    self.signatures = {}
+    self.imported_ids = set()
+
+  def imported(self, question_ids):
+    '''Note the ids of questions the import has committed.'''
+    self.imported_ids.update(question_ids)
+
+  def check(self, line_number, question, answer):
+    '''Return (duplicate question ids, duplicate line numbers) for a row, and remember it for the rows after it.
+      A row that is not imported after all must be forgotten, so that it does not count against later rows.
+    '''
+    question_signature = signature(shingles(question, answer))
+    question_ids = [duplicate["id"] for duplicate in self.near_duplicates.find(question, answer)
+                    if duplicate["id"] not in self.imported_ids]
+    line_numbers = sorted(line for line in self.index.candidates(question_signature, MAX_CANDIDATES)
+                          if estimated_similarity(question_signature, self.signatures[line])
+                          >= self.near_duplicates.threshold)
+    self.index.add(line_number, question_signature)
+    self.signatures[line_number] = question_signature
+    return question_ids, line_numbers
+
+  def forget(self, line_number):
+    '''Drop a row checked earlier, because it was rejected or could not be written.'''
+    question_signature = self.signatures.pop(line_number, None)
+    if question_signature is not None:
+      self.index.remove(line_number, question_signature)
+
+
+def duplicate_clusters(threshold=DUPLICATE_THRESHOLD, question_signatures=None):
+  '''Group every question of the table with its near-duplicates and return the groups of more than one question,
+    largest first, as sorted lists of ids. Pairs sharing a band key are compared by their signatures: each question
+    of a bucket against the first and the previous one, so large buckets cost linear time. question_signatures
+    may give (id, signature) pairs in id order instead of reading the table, which needs an application context.
+  '''
+  index = LSHIndex()
+  entries = array('Q')
+  # The signatures of all questions, one after the other in id order, at 4 bytes per value.
+  question_ids = array('q')
+  signatures = array('I')
+  for question_id, question_signature in question_signatures or _question_signatures():
+    entries.extend(LSHIndex.entries_for(question_id, question_signature))
+    question_ids.append(question_id)
+    signatures.extend(question_signature)
+  index.load(entries)
+
+  def signature_of(question_id):
+    start = bisect.bisect_left(question_ids, question_id) * SIGNATURE_SIZE
+    return signatures[start:start + SIGNATURE_SIZE]
+
+  parents = {}
+
+  def root(question_id):
+    while parents.get(question_id, question_id) != question_id:
+      question_id = parents[question_id]
+    return question_id
+
+  for bucket in index.buckets():
+    for position in range(1, len(bucket)):
+      question_signature = signature_of(bucket[position])
+      for other in { bucket[0], bucket[position - 1] }:
+        if estimated_similarity(question_signature, signature_of(other)) >= threshold:
+          first, second = root(bucket[position]), root(other)
+          if first != second:
+            # The smaller id becomes the root, which keeps the trees shallow.
+            parents[max(first, second)] = min(first, second)
+
+  clusters = {}
+  for question_id in parents:
+    clusters.setdefault(root(question_id), set()).add(question_id)
+  for cluster_root, members in clusters.items():
+    members.add(cluster_root)
+  return sorted((sorted(members) for members in clusters.values()), key=lambda cluster: (-len(cluster), cluster[0]))
+
+
+near_duplicates = NearDuplicates()
+observe_questions(near_duplicates.on_question_change)
+
+
+def register_duplicate_commands(app):
+  '''Add the duplicate-clusters command to the flask command line.'''
+  @app.cli.command("duplicate-clusters")
+  @click.option("--threshold", default=DUPLICATE_THRESHOLD, show_default=True,
+                help="Estimated similarity from which questions are near-duplicates.")
+  def duplicate_clusters_command(threshold):
+    '''List the groups of near-duplicate questions.'''
+    clusters = duplicate_clusters(threshold)
+    first_ids = [cluster[0] for cluster in clusters]
+    texts = dict(db.session.query(Question.id, Question.question).filter(Question.id.in_(first_ids))) if first_ids else {}
+    for cluster in clusters:
+      click.echo(f"{len(cluster)} questions ({', '.join(map(str, cluster))}): {texts.get(cluster[0])}")
+    click.echo(f"Found {len(clusters)} groups of near-duplicates, "
+               f"{sum(len(cluster) for cluster in clusters)} questions in all.")
@@ -0,0 +1,24 @@
+from werkzeug.exceptions import default_exceptions
+
+
+ERROR_MESSAGES = {
+  400: "The request was malformed",
+  404: "The resource was not found",
+  422: "The request was properly formatted but it could not be processed",
+  429: "Too many requests",
+  500: "There was an internal server error",
+  503: "The server is too busy to handle the request",
+}
+
+
+def error_payload(code, error=None):
+  '''The JSON body of an error response with the given status code. error is the exception being reported; it
+    defaults to the standard HTTP exception for code, so that apps without werkzeug errors describe them the same way.
+  '''
+  if error is None:
+    error = default_exceptions[code]()
+  return {
+    "success": False,
+    "error": code,
+    "message": f"{ERROR_MESSAGES[code]}: {error}",
+  }
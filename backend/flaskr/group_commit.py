@@ -0,0 +1,115 @@
+import threading
+
+from models import db, Question
+from .instrumentation import metrics_registry
+
+
+GROUP_COMMIT_MAX_BATCH = 100
+
+
+class _PendingInsert:
+  __slots__ = ('question', 'question_id', 'error', 'done')
+
+  def __init__(self, question):
+    self.question = question
+    self.question_id = None
+    self.error = None
+    self.done = False
+
+
+class GroupCommit:
+  '''Combines concurrent question inserts into shared transactions, so that a burst of writes costs a few commits
+    (and fsyncs) instead of one each. Every writer queues its question and takes the commit lock; whoever holds it
+    inserts all the queued questions (up to max_batch) in one transaction, and the writers that queued while that
+    commit ran find their questions written or share the next one. A lone writer commits straight away, so nothing
+    waits for a batch to fill up.
+
+    If a shared transaction fails (for example on a question naming a category that does not exist), its questions
+    are inserted again one transaction each, so that only the writer at fault gets the error.
+  '''
+  def __init__(self, enabled=False, max_batch=GROUP_COMMIT_MAX_BATCH):
+    self.enabled = enabled
+    self.max_batch = max_batch
+    self.commits = 0
+    self.writes = 0
+    self._queue = []
+    self._queue_lock = threading.Lock()
+    self._commit_lock = threading.Lock()
+
+  def configure(self, config):
+    self.enabled = config.get("GROUP_COMMIT", False)
+    self.max_batch = config.get("GROUP_COMMIT_MAX_BATCH", GROUP_COMMIT_MAX_BATCH)
+
+  def insert(self, question):
+    '''Insert question and return its id once committed, raising the exception of a failed insert. Must run inside
+      an application context.
+    '''
+    if not self.enabled:
+      question.insert()
+      self._count(1)
+      return question.id
+    pending = _PendingInsert(question)
+    with self._queue_lock:
+      self._queue.append(pending)
+    while not pending.done:
+      with self._commit_lock:
+        if pending.done:
+          break
+        with self._queue_lock:
+          batch, self._queue = self._queue[:self.max_batch], self._queue[self.max_batch:]
+        self._commit(batch)
+    if pending.error is not None:
+      raise pending.error
+    return pending.question_id
+
+  def _commit(self, batch):
+    try:
+      db.session.add_all(pending.question for pending in batch)
+      # Ids are read before the commit expires the questions, which belong to other threads.
+      db.session.flush()
+      question_ids = [pending.question.id for pending in batch]
+      db.session.commit()
+      for pending, question_id in zip(batch, question_ids):
+        pending.question_id = question_id
+      self._count(len(batch))
+    except Exception as ex:
+      db.session.rollback()
+      if len(batch) == 1:
+        batch[0].error = ex
+      else:
+        for pending in batch:
+          self._commit_alone(pending)
+    finally:
+      for pending in batch:
+        pending.done = True
+
+  def _commit_alone(self, pending):
+    question = pending.question
+    question = Question(question.question, question.answer, question.category, question.difficulty)
+    try:
+      db.session.add(question)
+      db.session.flush()
+      pending.question_id = question.id
+      db.session.commit()
+      self._count(1)
+    except Exception as ex:
+      db.session.rollback()
+      pending.error = ex
+
+  def _count(self, writes):
+    with self._queue_lock:
+      self.commits += 1
+      self.writes += writes
+
+  def collect(self):
+    '''The metrics of metrics_registry: the commits made and the questions they wrote.'''
+    return [
+      ("trivia_question_commits_total", "counter", "Transactions committed to insert questions.",
+       [([], self.commits)]),
+      ("trivia_question_commit_writes_total", "counter", "Questions inserted by those transactions.",
+       [([], self.writes)]),
+    ]
+
+
+group_commit = GroupCommit()
+metrics_registry.add_collector(group_commit.collect)
@@ -0,0 +1,61 @@
+from functools import wraps
+
+from flask import current_app, make_response, request
+from werkzeug.http import http_date, quote_etag
+
+from models import content_versions
+
+
+DEFAULT_CACHE_CONTROL = "no-cache"
+
+
+def content_etag(version):
+  return f"v{version}"
+
+
+def not_modified(if_none_match, if_modified_since, etag, last_modified):
+  '''Whether a request with the given If-None-Match (werkzeug ETags) and If-Modified-Since (a datetime, or None)
+    already has the representation of the content at etag and last_modified.
+  '''
+  if if_none_match:
+    return if_none_match.contains_weak(etag)
+  if if_modified_since:
+    # HTTP dates have a resolution of one second.
+    return last_modified.replace(microsecond=0) <= if_modified_since.replace(tzinfo=None)
+  return False
+
+
+def validator_headers(version, updated_at, cache_control):
+  '''The ETag, Last-Modified and Cache-Control headers of a conditional response for the content version.'''
+  return {
+    'ETag': quote_etag(content_etag(version)),
+    'Last-Modified': http_date(updated_at),
+    'Cache-Control': cache_control,
+  }
+
+
+def conditional(cache_control_key):
+  '''Decorate a GET view whose response depends only on the request URL and the trivia content (questions and
+    categories). Successful responses carry a strong ETag and a Last-Modified date derived from the content version,
+    and the Cache-Control value configured under cache_control_key (DEFAULT_CACHE_CONTROL if unset). A request whose
+    If-None-Match or If-Modified-Since still matches is answered with 304 Not Modified without running the view.
+  '''
+  def decorator(view):
+    @wraps(view)
+    def conditional_view(*args, **kwargs):
+      # Read the version before the content, so a concurrent change can only make the ETag older than the body
+      # (and cause one extra download), never newer.
+      version, updated_at = content_versions.current()
+      headers = validator_headers(version, updated_at,
+                                  current_app.config.get(cache_control_key, DEFAULT_CACHE_CONTROL))
+      if not_modified(request.if_none_match, request.if_modified_since, content_etag(version), updated_at):
+        response = current_app.response_class(status=304)
+      else:
+        response = make_response(view(*args, **kwargs))
+        if response.status_code != 200:
+          return response
+      for name, value in headers.items():
+        response.headers[name] = value
+      return response
+    return conditional_view
+  return decorator
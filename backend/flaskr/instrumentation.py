@@ -0,0 +1,207 @@
+import logging
+import threading
+import time
+from collections import Counter
+
+from flask import current_app, g, has_app_context, json, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+
+logger = logging.getLogger(__name__)
+
+SLOW_QUERY_MS = 100
+N_PLUS_ONE_THRESHOLD = 10
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class RequestTiming:
+  '''What one request spent its time on: the SQL statements it ran (how many, how long, how many rows they
+    returned or changed) and JSON serialization.
+  '''
+  def __init__(self):
+    self.started = time.perf_counter()
+    self.query_count = 0
+    self.db_seconds = 0.0
+    self.rows = 0
+    self.serialize_seconds = 0.0
+    self.statements = Counter()
+    self.status = None
+    self.response_bytes = 0
+
+
+def _current_timing():
+  if has_app_context():
+    return g.get('request_timing')
+  return None
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+  # The start time belongs to the statement's execution context, so a statement that fails (and never reaches
+  # after_cursor_execute) leaves nothing behind on the connection.
+  if context is not None:
+    context.query_started = time.perf_counter()
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+  started = getattr(context, 'query_started', None)
+  timing = _current_timing()
+  if started is None or timing is None:
+    return
+  elapsed = time.perf_counter() - started
+  timing.query_count += 1
+  timing.db_seconds += elapsed
+  # The row count of a SELECT is only known up front for buffered cursors; -1 means unknown.
+  timing.rows += max(cursor.rowcount, 0)
+  timing.statements[statement] += 1
+  if elapsed * 1000 >= current_app.config.get("SLOW_QUERY_MS", SLOW_QUERY_MS):
+    logger.warning("Slow query (%.1f ms) in %s %s: %s", elapsed * 1000, request.method, request.path, statement)
+
+
+def add_serialize_time(started):
+  '''Add the time since started (a time.perf_counter() reading) to the current request's JSON encoding time.'''
+  timing = _current_timing()
+  if timing is not None:
+    timing.serialize_seconds += time.perf_counter() - started
+
+
+class TimedJSONEncoder(json.JSONEncoder):
+  '''The app's JSON encoder, adding the time spent encoding to the current request's timing.'''
+  def encode(self, o):
+    started = time.perf_counter()
+    try:
+      return super().encode(o)
+    finally:
+      add_serialize_time(started)
+
+
+class MetricsRegistry:
+  '''Per-endpoint totals of request timings, rendered in the Prometheus text exposition format, followed by the
+    metrics of the collectors added with add_collector.
+  '''
+  def __init__(self):
+    self._lock = threading.Lock()
+    self.collectors = []
+    self.requests = Counter()
+    self.durations = {}
+    self.queries = Counter()
+    self.db_seconds = Counter()
+    self.rows = Counter()
+    self.serialize_seconds = Counter()
+    self.response_bytes = Counter()
+
+  def add_collector(self, collector):
+    '''Add a callable returning metrics to render, as (name, type, description, samples) tuples where samples is a
+      list of (labels, value) pairs and labels a list of (name, value) pairs.
+    '''
+    self.collectors.append(collector)
+    return collector
+
+  def record(self, endpoint, method, status, timing, duration):
+    with self._lock:
+      self.requests[(endpoint, method, status)] += 1
+      buckets = self.durations.setdefault(endpoint, [[0] * len(DURATION_BUCKETS), 0, 0.0])
+      for index, bound in enumerate(DURATION_BUCKETS):
+        if duration <= bound:
+          buckets[0][index] += 1
+      buckets[1] += 1
+      buckets[2] += duration
+      self.queries[endpoint] += timing.query_count
+      self.db_seconds[endpoint] += timing.db_seconds
+      self.rows[endpoint] += timing.rows
+      self.serialize_seconds[endpoint] += timing.serialize_seconds
+      self.response_bytes[endpoint] += timing.response_bytes
+
+  def render(self):
+    lines = []
+
+    def counter(name, description, values, label_names):
+      lines.append(f"# HELP {name} {description}")
+      lines.append(f"# TYPE {name} counter")
+      for labels, value in sorted(values.items()):
+        labels = labels if isinstance(labels, tuple) else (labels,)
+        lines.append(f"{name}{{{_labels(zip(label_names, labels))}}} {value}")
+
+    with self._lock:
+      counter("trivia_requests_total", "Requests handled.", self.requests, ("endpoint", "method", "status"))
+      lines.append("# HELP trivia_request_duration_seconds Time to handle a request.")
+      lines.append("# TYPE trivia_request_duration_seconds histogram")
+      for endpoint, (bucket_counts, count, total) in sorted(self.durations.items()):
+        for bound, bucket_count in zip(DURATION_BUCKETS, bucket_counts):
+          lines.append(f"trivia_request_duration_seconds_bucket{{{_labels([('endpoint', endpoint), ('le', bound)])}}} "
+                       f"{bucket_count}")
+        lines.append(f"trivia_request_duration_seconds_bucket{{{_labels([('endpoint', endpoint), ('le', '+Inf')])}}} "
+                     f"{count}")
+        lines.append(f"trivia_request_duration_seconds_sum{{{_labels([('endpoint', endpoint)])}}} {total}")
+        lines.append(f"trivia_request_duration_seconds_count{{{_labels([('endpoint', endpoint)])}}} {count}")
+      counter("trivia_db_queries_total", "SQL statements executed.", self.queries, ("endpoint",))
+      counter("trivia_db_seconds_total", "Time spent executing SQL statements.", self.db_seconds, ("endpoint",))
+      counter("trivia_db_rows_total", "Rows returned or changed by SQL statements, where known.", self.rows,
+              ("endpoint",))
+      counter("trivia_serialization_seconds_total", "Time spent encoding JSON.", self.serialize_seconds,
+              ("endpoint",))
+      counter("trivia_response_bytes_total", "Response body bytes, where known.", self.response_bytes,
+              ("endpoint",))
+    for collector in self.collectors:
+      for name, metric_type, description, samples in collector():
+        lines.append(f"# HELP {name} {description}")
+        lines.append(f"# TYPE {name} {metric_type}")
+        for labels, value in samples:
+          lines.append(f"{name}{{{_labels(labels)}}} {value}" if labels else f"{name} {value}")
+    return "\n".join(lines) + "\n"
+
+
+def _labels(pairs):
+  def escape(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+  return ",".join(f'{name}="{escape(value)}"' for name, value in pairs)
+
+
+metrics_registry = MetricsRegistry()
+
+
+def start_request():
+  '''Start timing the current request. Call from before_request.'''
+  if current_app.config.get("INSTRUMENTATION", True):
+    g.request_timing = RequestTiming()
+
+
+def finish_request(response):
+  '''Add a Server-Timing header describing the current request to response. Call from after_request.'''
+  timing = _current_timing()
+  if timing is None:
+    return response
+  timing.status = response.status_code
+  timing.response_bytes = response.calculate_content_length() or 0
+  total_ms = (time.perf_counter() - timing.started) * 1000
+  db_ms = timing.db_seconds * 1000
+  serialize_ms = timing.serialize_seconds * 1000
+  if current_app.config.get("SERVER_TIMING", True):
+    response.headers['Server-Timing'] = ", ".join([
+      f'db;dur={db_ms:.2f};desc="{timing.query_count} queries, {timing.rows} rows"',
+      f'serialize;dur={serialize_ms:.2f}',
+      f'app;dur={max(total_ms - db_ms - serialize_ms, 0):.2f}',
+      f'total;dur={total_ms:.2f}',
+    ])
+  return response
+
+
+def record_request(exception=None):
+  '''Add the current request's timing to metrics_registry and log repeated statements. Call from
+    teardown_request, which for streamed responses runs once the body has been sent.
+  '''
+  timing = _current_timing()
+  if timing is None:
+    return
+  g.pop('request_timing')
+  endpoint = request.endpoint or "unknown"
+  status = timing.status if timing.status is not None else 500
+  metrics_registry.record(endpoint, request.method, status, timing, time.perf_counter() - timing.started)
+
+  threshold = current_app.config.get("N_PLUS_ONE_THRESHOLD", N_PLUS_ONE_THRESHOLD)
+  for statement, count in timing.statements.items():
+    if count >= threshold:
+      logger.warning("Possible N+1 query in %s %s: statement ran %d times: %s", request.method, request.path, count,
+                     statement)
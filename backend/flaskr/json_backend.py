@@ -0,0 +1,94 @@
+import re
+import time
+
+import flask
+from flask import current_app, json
+
+from .instrumentation import add_serialize_time
+
+
+# orjson writes the floats below 1e-4 differently from the json module (0.00001 for 1e-05, 1e-7 for 1e-07), and no
+# other number: in its output they are the only digits followed by '.0000', or by 'e-' and a single digit. The
+# substring tests rule most pages out much faster than the regular expression alone.
+_SMALL_FLOAT = re.compile(rb'[0-9](?:\.0000|e-[0-9](?![0-9]))')
+
+
+def _has_small_float(body):
+  return (b'.0000' in body or b'e-' in body) and _SMALL_FLOAT.search(body) is not None
+
+
+class StdlibJSONBackend:
+  '''Flask's own encoding: the json module with app.json_encoder and the JSON_* settings.'''
+  name = "json"
+
+  def dumps(self, value):
+    return json.dumps(value, separators=(',', ':')).encode('utf-8')
+
+
+class OrjsonJSONBackend(StdlibJSONBackend):
+  '''Encodes with orjson, which is several times faster than the json module on question pages, and writes the
+    same bytes. Values that orjson writes differently are encoded again by the json module: floats below 1e-4,
+    non-ASCII text (escaped under JSON_AS_ASCII), DEL characters, dictionary keys that are not strings (the json
+    module sorts them by value, orjson by their text) and integers beyond 64 bits. The responses of the API key
+    their objects by strings, so only unusual payloads take that path. Dates and other values neither encoder
+    knows are passed to app.json_encoder.
+  '''
+  name = "orjson"
+
+  def __init__(self, sort_keys=True, ascii_only=True):
+    import orjson
+    self._orjson = orjson
+    self._options = orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_PASSTHROUGH_DATACLASS
+    if sort_keys:
+      self._options |= orjson.OPT_SORT_KEYS
+    self.ascii_only = ascii_only
+
+  @staticmethod
+  def _default(value):
+    return current_app.json_encoder().default(value)
+
+  def dumps(self, value):
+    started = time.perf_counter()
+    try:
+      body = self._orjson.dumps(value, default=self._default, option=self._options)
+    except TypeError:
+      body = None
+    finally:
+      add_serialize_time(started)
+    if body is None or (self.ascii_only and not body.isascii()) or b'\x7f' in body or _has_small_float(body):
+      return super().dumps(value)
+    return body
+
+
+def create_json_backend(config):
+  '''Build the JSON backend selected by the app config: JSON_BACKEND is 'auto' (the default, orjson when it is
+    installed), 'orjson' or 'json'.
+  '''
+  kind = config.get("JSON_BACKEND", "auto")
+  if kind == "json":
+    return StdlibJSONBackend()
+  if kind in ("auto", "orjson"):
+    try:
+      return OrjsonJSONBackend(config.get("JSON_SORT_KEYS", True), config.get("JSON_AS_ASCII", True))
+    except ImportError:
+      if kind == "orjson":
+        raise
+      return StdlibJSONBackend()
+  raise ValueError(f"Unknown JSON backend {kind}.")
+
+
+def json_body(payload):
+  '''Encode payload as jsonify does, with the current app's JSON backend.'''
+  return current_app.extensions['json_backend'].dumps(payload) + b'\n'
+
+
+def jsonify(*args, **kwargs):
+  '''flask.jsonify, encoded by the app's JSON backend. Pretty-printed responses (in debug mode or with
+    JSONIFY_PRETTYPRINT_REGULAR) are left to Flask.
+  '''
+  if current_app.config['JSONIFY_PRETTYPRINT_REGULAR'] or current_app.debug:
+    return flask.jsonify(*args, **kwargs)
+  if args and kwargs:
+    raise TypeError('jsonify() behavior undefined when passed both args and kwargs')
+  payload = args[0] if len(args) == 1 else args or kwargs
+  return current_app.response_class(json_body(payload), mimetype=current_app.config['JSONIFY_MIMETYPE'])
@@ -0,0 +1,107 @@
+import threading
+import time
+from collections import deque
+
+
+def _to_bytes(value):
+  if isinstance(value, bytes):
+    return value
+  if isinstance(value, str):
+    return value.encode('utf-8')
+  if isinstance(value, (int, float)):
+    return str(value).encode('ascii')
+  raise TypeError(f"Cannot store a value of type {type(value).__name__}.")
+
+
+class LocalRedis:
+  '''A small in-process stand-in for a Redis client, implementing the handful of commands the trivia API uses
+    (strings, counters, lists and key expiry) with redis-py's method names and return values. It lets the
+    Redis-backed stores run in development and tests without a Redis server; it is not shared between processes.
+  '''
+  def __init__(self):
+    self._data = {}
+    self._expires_at = {}
+    self._lock = threading.RLock()
+
+  def _live(self, key):
+    expires_at = self._expires_at.get(key)
+    if expires_at is not None and expires_at <= time.monotonic():
+      self._data.pop(key, None)
+      self._expires_at.pop(key, None)
+    return key in self._data
+
+  def get(self, key):
+    with self._lock:
+      return self._data[key] if self._live(key) else None
+
+  def mget(self, keys):
+    with self._lock:
+      return [self.get(key) for key in keys]
+
+  def set(self, key, value, ex=None):
+    with self._lock:
+      self._data[key] = _to_bytes(value)
+      self._expires_at.pop(key, None)
+      if ex is not None:
+        self._expires_at[key] = time.monotonic() + ex
+      return True
+
+  def incr(self, key, amount=1):
+    with self._lock:
+      value = int(self._data[key]) + amount if self._live(key) else amount
+      self._data[key] = _to_bytes(value)
+      return value
+
+  def delete(self, *keys):
+    with self._lock:
+      deleted = 0
+      for key in keys:
+        if self._live(key):
+          del self._data[key]
+          self._expires_at.pop(key, None)
+          deleted += 1
+      return deleted
+
+  def exists(self, *keys):
+    with self._lock:
+      return sum(1 for key in keys if self._live(key))
+
+  def expire(self, key, seconds):
+    with self._lock:
+      if not self._live(key):
+        return False
+      self._expires_at[key] = time.monotonic() + seconds
+      return True
+
+  def rpush(self, key, *values):
+    with self._lock:
+      if not self._live(key):
+        self._data[key] = deque()
+      self._data[key].extend(_to_bytes(value) for value in values)
+      return len(self._data[key])
+
+  def lpop(self, key):
+    with self._lock:
+      if not self._live(key):
+        return None
+      values = self._data[key]
+      value = values.popleft()
+      if not values:
+        # Like Redis, an emptied list no longer exists.
+        del self._data[key]
+        self._expires_at.pop(key, None)
+      return value
+
+  def llen(self, key):
+    with self._lock:
+      return len(self._data[key]) if self._live(key) else 0
+
+
+def redis_client(url=None):
+  '''Return a Redis client for url, or a LocalRedis stand-in when no url is configured. redis-py is only needed
+    when a url is given.
+  '''
+  if url is None:
+    return LocalRedis()
+  import redis
+  return redis.Redis.from_url(url)
@@ -0,0 +1,142 @@
+import base64
+import json
+
+from sqlalchemy import func
+
+
+QUESTIONS_PER_PAGE = 10
+MAX_QUESTIONS_PER_PAGE = 100
+MAX_STREAMED_QUESTIONS_PER_PAGE = 1000000
+
+
+def encode_cursor(position):
+  '''Turn a position dictionary (either {"after": <last id>} or {"offset": <row offset>}) into an opaque,
+    URL-safe cursor token that can be handed back to the client.
+  '''
+  raw = json.dumps(position, separators=(',', ':'), sort_keys=True).encode('utf-8')
+  return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+
+def decode_cursor(token):
+  '''Inverse of encode_cursor. Raise a ValueError if the token was not produced by encode_cursor.'''
+  try:
+    padded = token + '=' * (-len(token) % 4)
+    position = json.loads(base64.urlsafe_b64decode(padded.encode('ascii')).decode('utf-8'))
+  except Exception:
+    raise ValueError(f"Cursor {token} is not valid.")
+
+  if not isinstance(position, dict) or len(position) != 1:
+    raise ValueError(f"Cursor {token} is not valid.")
+  (kind, value), = position.items()
+  if kind not in ("after", "offset") or not isinstance(value, int) or value < 0:
+    raise ValueError(f"Cursor {token} is not valid.")
+  return position
+
+
+def count_rows(query, key):
+  '''Return the number of rows matched by query with a single COUNT(*) round trip, without loading any rows.
+    key is a column of the queried table (usually the primary key) used to anchor the FROM clause.
+  '''
+  return query.order_by(None).with_entities(func.count(key)).scalar()
+
+
+def parse_listing_args(args, config):
+  '''Return (per_page, streamed) for a listing request from its "per_page" and "stream" arguments. Streamed
+    responses are produced row by row, so they may use much larger pages (MAX_STREAMED_QUESTIONS_PER_PAGE instead of
+    MAX_QUESTIONS_PER_PAGE, both overridable in the app config). Raise a ValueError for a page size out of bounds.
+  '''
+  streamed = args.get("stream", "false").lower() in ("1", "true", "yes")
+  if streamed:
+    limit = config.get("MAX_STREAMED_QUESTIONS_PER_PAGE", MAX_STREAMED_QUESTIONS_PER_PAGE)
+  else:
+    limit = config.get("MAX_QUESTIONS_PER_PAGE", MAX_QUESTIONS_PER_PAGE)
+  per_page = int(args.get("per_page", QUESTIONS_PER_PAGE))
+  if not (1 <= per_page <= limit):
+    raise ValueError(f"The page size {per_page} is not within the allowed range of 1 to {limit} inclusive.")
+  return per_page, streamed
+
+
+def page_query(query, page, cursor, key, per_page):
+  '''Return query limited to the requested page (plus one row, to tell whether a next page exists) and the
+    position it starts from.
+  '''
+  if cursor is not None:
+    position = decode_cursor(cursor)
+    if "after" in position and key is None:
+      raise ValueError(f"Cursor {cursor} is not valid for this listing.")
+  else:
+    if page < 1:
+      raise ValueError(f"Page {page} does not exist.")
+    position = {"offset": (page - 1) * per_page}
+
+  if key is not None:
+    query = query.order_by(key)
+  if "after" in position:
+    query = query.filter(key > position["after"])
+  else:
+    query = query.offset(position["offset"])
+  return query.limit(per_page + 1), position
+
+
+def _next_cursor(last_record, position, key, per_page):
+  if key is not None:
+    return encode_cursor({"after": getattr(last_record, key.key)})
+  return encode_cursor({"offset": position.get("offset", 0) + per_page})
+
+
+def _format(record):
+  return record.format()
+
+
+def get_page_range(query, page=1, cursor=None, key=None, per_page=QUESTIONS_PER_PAGE, formatter=_format):
+  '''Run query for a single page of records and return a tuple (records, next_cursor), where records are the
+    formatted records of the page and next_cursor is an opaque token for the following page (None if this is
+    the last page).
+
+    If key is given (a unique, indexed column such as the primary key), results are ordered by key. A cursor then
+    pages by keyset (key > last seen value) so deep pages cost the same as the first one. Otherwise the query
+    keeps its own ordering and cursors encode a plain row offset.
+
+    Without a cursor, the page number selects rows QUESTIONS_PER_PAGE * (page-1) up to QUESTIONS_PER_PAGE * page - 1
+    inclusive through LIMIT/OFFSET. If the page < 1, raise an error. A page beyond the last record is empty.
+
+    Records are formatted with formatter, by default their format method. Pass Question.format_row for a query of
+    Question.rows().
+  '''
+  limited_query, position = page_query(query, page, cursor, key, per_page)
+  return page_result(limited_query.all(), position, key, per_page, formatter)
+
+
+def page_result(records, position, key=None, per_page=QUESTIONS_PER_PAGE, formatter=_format):
+  '''Return (records, next_cursor) as get_page_range does, given the records fetched by a query built with
+    page_query (which asks for one row more than the page holds) and the position it returned.
+  '''
+  next_cursor = _next_cursor(records[per_page - 1], position, key, per_page) if len(records) > per_page else None
+  return [formatter(record) for record in records[:per_page]], next_cursor
+
+
+class StreamedPage:
+  '''A page of records like the one get_page_range returns, read lazily through a server-side cursor batch_size
+    rows at a time instead of all at once, so that large pages can be streamed with flat memory. Iterating yields
+    the formatted records; next_cursor is set once iteration is over. Arguments are checked on creation.
+  '''
+  def __init__(self, query, page=1, cursor=None, key=None, per_page=QUESTIONS_PER_PAGE, batch_size=1000,
+               formatter=_format):
+    self._query, self._position = page_query(query, page, cursor, key, per_page)
+    self._key = key
+    self._per_page = per_page
+    self._batch_size = batch_size
+    self._formatter = formatter
+    self.next_cursor = None
+
+  def __iter__(self):
+    rows = self._query.execution_options(stream_results=True).yield_per(self._batch_size)
+    count = 0
+    last_record = None
+    for record in rows:
+      if count == self._per_page:
+        self.next_cursor = _next_cursor(last_record, self._position, self._key, self._per_page)
+        break
+      count += 1
+      last_record = record
+      yield self._formatter(record)
@@ -0,0 +1,42 @@
+import gc
+
+from models import db, category_registry
+from .autocomplete import autocomplete
+from .duplicates import near_duplicates
+from .quiz import quiz_pool
+from .search import memory_search_backend
+
+
+def preload(app):
+  '''Warm start for servers that build the app once and fork workers from it (gunicorn with preload_app, see
+    gunicorn.conf.py). Loads the read-mostly data every worker would otherwise load on its first requests: the
+    categories, the quiz id pools, the autocomplete and near-duplicate indexes, and the in-memory search index
+    where PostgreSQL full-text search is not available. The first connection also runs the dialect's startup
+    queries (server version, string settings), which forked workers then skip.
+
+    The connections opened meanwhile are closed, so that no worker inherits another's socket, and the objects
+    built so far are moved out of the garbage collector's reach with gc.freeze: collections in the workers then
+    never write to their memory, which stays shared copy-on-write between all the workers.
+  '''
+  with app.app_context():
+    category_registry.load()
+    quiz_pool.load()
+    autocomplete.build()
+    if near_duplicates.policy != "off":
+      near_duplicates.build()
+    if db.engine.dialect.name != "postgresql":
+      memory_search_backend.build()
+    db.session.remove()
+  dispose_connections(app)
+  gc.collect()
+  gc.freeze()
+
+
+def dispose_connections(app):
+  '''Close the pooled connections of app's engines; run it in every worker right after the fork as well, in case
+    the master used the database again after preload.
+  '''
+  db.get_engine(app).dispose()
+  replicas = app.extensions.get('replicas')
+  if replicas is not None:
+    replicas.dispose()
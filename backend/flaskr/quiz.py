@@ -0,0 +1,210 @@
+import random
+import threading
+import time
+from array import array
+
+from models import db, Question, observe_questions
+
+
+ALL_CATEGORIES = 0
+# The largest count of questions one /quizzes request may ask for.
+QUIZ_MAX_QUESTIONS = 50
+
+
+class QuizPool:
+  '''In-process buckets of question ids per (category, difficulty), kept in compact arrays. A quiz question is
+    picked by sampling an id from the buckets of the requested category (ALL_CATEGORIES for every category) and
+    difficulties and fetching only that row, instead of loading every eligible question. The buckets are loaded
+    with a single (id, category, difficulty) query on first use, follow this process' commits through the question
+    change observers, and are reloaded after ttl seconds to pick up changes made by other processes.
+  '''
+  def __init__(self, ttl=300):
+    self.ttl = ttl
+    self._pools = None
+    self._loaded_at = 0
+    self._lock = threading.Lock()
+
+  def _load(self):
+    self._load_rows(db.session.query(Question.id, Question.category, Question.difficulty).order_by(Question.id))
+
+  def _load_rows(self, rows):
+    pools = {}
+    for question_id, category, difficulty in rows:
+      self._bucket(pools, category, difficulty).append(question_id)
+    self._pools = pools
+    self._loaded_at = time.monotonic()
+    return pools
+
+  @staticmethod
+  def _bucket(pools, category, difficulty):
+    # Questions without a category are only drawn for ALL_CATEGORIES.
+    category = int(category) if category is not None else None
+    return pools.setdefault(category, {}).setdefault(difficulty, array('q'))
+
+  def _current(self):
+    if self.stale():
+      self._load()
+    return self._pools
+
+  def stale(self):
+    '''Whether the next pick will reload the buckets.'''
+    return self._pools is None or time.monotonic() - self._loaded_at > self.ttl
+
+  def fresh(self):
+    '''Return the buckets if they are loaded and within their TTL, else None.'''
+    pools = self._pools
+    return None if self.stale() else pools
+
+  def load(self):
+    '''Load the buckets from the questions table. Must run inside an application context.'''
+    with self._lock:
+      self._load()
+
+  def load_rows(self, rows):
+    '''Replace the buckets with (id, category, difficulty) rows ordered by id, however they were read, and return
+      them.
+    '''
+    with self._lock:
+      return self._load_rows(rows)
+
+  def _remove(self, question_id):
+    # Buckets do not overlap, and an update may have moved the question out of the bucket its record names.
+    for buckets in self._pools.values():
+      for bucket in buckets.values():
+        if question_id in bucket:
+          bucket.remove(question_id)
+          return
+
+  def on_question_change(self, event_name, records):
+    with self._lock:
+      if self._pools is None:
+        return
+      if event_name == 'reset':
+        self._pools = None
+        return
+      for record in records:
+        if event_name != 'insert':
+          self._remove(record['id'])
+        if event_name != 'delete':
+          self._bucket(self._pools, record['category'], record['difficulty']).append(record['id'])
+
+  def discard(self, question_id):
+    '''Drop an id that turned out to be gone from the database.'''
+    with self._lock:
+      if self._pools is not None:
+        self._remove(question_id)
+
+  def _buckets(self, category_id, difficulties, pools=None):
+    if pools is None:
+      pools = self._current()
+    if int(category_id) == ALL_CATEGORIES:
+      categories = pools.values()
+    else:
+      categories = [pools.get(int(category_id), {})]
+    return [bucket for buckets in categories for difficulty, bucket in buckets.items()
+            if bucket and (difficulties is None or difficulty in difficulties)]
+
+  @staticmethod
+  def _at(buckets, index):
+    # The index-th id of the buckets taken end to end, so every id is equally likely without copying them.
+    for bucket in buckets:
+      if index < len(bucket):
+        return bucket[index]
+      index -= len(bucket)
+    raise IndexError(index)
+
+  def sample(self, category_id, count, excluded_ids=(), difficulties=None, pools=None):
+    '''Return up to count distinct random question ids of the category with one of the difficulties (None for any
+      difficulty) that are not in excluded_ids. They are drawn from pools (as returned by fresh or load_rows) if
+      given; otherwise the buckets are reloaded through the app's session if they are stale.
+    '''
+    excluded_ids = excluded_ids if isinstance(excluded_ids, (set, frozenset)) else set(excluded_ids)
+    with self._lock:
+      buckets = self._buckets(category_id, difficulties, pools)
+      total = sum(len(bucket) for bucket in buckets)
+      candidates = [self._at(buckets, index)
+                    for index in random.sample(range(total), min(total, count + len(excluded_ids)))]
+    return [question_id for question_id in candidates if question_id not in excluded_ids][:count]
+
+
+quiz_pool = QuizPool()
+observe_questions(quiz_pool.on_question_change)
+
+
+class QuizSelection:
+  '''The drawing of up to count distinct random questions of the category (ALL_CATEGORIES for any category) that
+    are not among the previous questions; fewer once the category runs out. The difficulty plan (see
+    parse_quiz_request) lists the sets of difficulties to draw from in order of preference. The ids are drawn from
+    the quiz pool (from pools if given, see QuizPool.sample), and the caller reads their rows however it reads the
+    database, so the Flask and async endpoints pick questions alike:
+
+      question_ids = selection.draw()
+      while question_ids:
+        selection.accept(rows of question_ids by id)
+        question_ids = selection.draw()
+
+    The chosen rows are then in selection.chosen.
+  '''
+  def __init__(self, category_id, previous_question_ids, difficulty_plan=(None,), count=1, pools=None):
+    self.category_id = category_id
+    self.count = count
+    self.pools = pools
+    self.chosen = []
+    self._excluded_ids = set(previous_question_ids)
+    self._plan = list(difficulty_plan)
+    self._drawn = []
+
+  def draw(self):
+    '''Return the ids whose rows are needed next, or an empty list once the selection is complete.'''
+    while self._plan and len(self.chosen) < self.count:
+      self._drawn = quiz_pool.sample(self.category_id, self.count - len(self.chosen), self._excluded_ids,
+                                     self._plan[0], self.pools)
+      if self._drawn:
+        return self._drawn
+      # The difficulties of this step have run out; fall back to the next ones.
+      self._plan.pop(0)
+    return []
+
+  def accept(self, rows):
+    '''Take the rows (a dictionary by id) read for the ids last drawn.'''
+    self.chosen.extend(accept_quiz_rows(self._drawn, rows, self.category_id, self._plan[0]))
+    self._excluded_ids.update(self._drawn)
+
+
+def choose_quiz_questions(category_id, previous_question_ids, difficulty_plan=(None,), count=1):
+  '''Return up to count questions as rows of Question.rows(), chosen as described in QuizSelection. The rows of
+    each draw are read with a single query.
+  '''
+  selection = QuizSelection(category_id, previous_question_ids, difficulty_plan, count)
+  question_ids = selection.draw()
+  while question_ids:
+    selection.accept({ row.id: row for row in Question.rows().filter(Question.id.in_(question_ids)) })
+    question_ids = selection.draw()
+  return selection.chosen
+
+
+def choose_quiz_question(category_id, previous_question_ids, difficulty_plan=(None,)):
+  '''Return a single question as choose_quiz_questions does, or None if every question has been asked.'''
+  chosen = choose_quiz_questions(category_id, previous_question_ids, difficulty_plan)
+  return chosen[0] if chosen else None
+
+
+def accept_quiz_rows(question_ids, rows, category_id, difficulties):
+  '''Return the rows (a dictionary by id) of the drawn question ids that still match the category and
+    difficulties, in the order they were drawn. Ids without a row were deleted by another process since the pool
+    was loaded and are dropped from it.
+  '''
+  accepted = []
+  for question_id in question_ids:
+    row = rows.get(question_id)
+    if row is None:
+      quiz_pool.discard(question_id)
+    elif quiz_question_matches(row, category_id, difficulties):
+      accepted.append(row)
+  return accepted
+
+
+def quiz_question_matches(question, category_id, difficulties):
+  '''Whether a question row still has the category and difficulty it was picked for.'''
+  return ((int(category_id) == ALL_CATEGORIES or question.category == int(category_id))
+          and (difficulties is None or question.difficulty in difficulties))
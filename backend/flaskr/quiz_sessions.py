@@ -0,0 +1,121 @@
+import secrets
+import threading
+import time
+from array import array
+from collections import OrderedDict
+
+from .local_redis import redis_client
+
+
+QUIZ_SESSION_QUESTIONS = 20
+QUIZ_SESSION_MAX_QUESTIONS = 100
+
+
+class MemoryQuizSessionStore:
+  '''Keeps each quiz session's queue of remaining question ids in a compact array in process memory. Sessions
+    expire ttl seconds after their last use, and once max_sessions are alive the least recently used one is evicted,
+    so memory stays bounded however many players start a quiz.
+  '''
+  def __init__(self, ttl=3600, max_sessions=100000):
+    self.ttl = ttl
+    self.max_sessions = max_sessions
+    self._sessions = OrderedDict()
+    self._lock = threading.Lock()
+
+  def _evict(self, now):
+    # Every use moves a session to the end, so the front holds the sessions that expire first.
+    while self._sessions:
+      session_id, (expires_at, _) = next(iter(self._sessions.items()))
+      if expires_at > now and len(self._sessions) < self.max_sessions:
+        break
+      del self._sessions[session_id]
+
+  def _touch(self, session_id, now):
+    entry = self._sessions[session_id]
+    if entry[0] <= now:
+      del self._sessions[session_id]
+      raise KeyError(session_id)
+    entry[0] = now + self.ttl
+    self._sessions.move_to_end(session_id)
+    return entry[1]
+
+  def create(self, question_ids):
+    session_id = secrets.token_urlsafe(16)
+    now = time.monotonic()
+    with self._lock:
+      self._evict(now)
+      self._sessions[session_id] = [now + self.ttl, array('q', question_ids)]
+    return session_id
+
+  def pop(self, session_id):
+    '''Return the next question id of the session, or None once the queue is empty. Raise a KeyError for an
+      unknown or expired session.
+    '''
+    with self._lock:
+      queue = self._touch(session_id, time.monotonic())
+      return queue.pop() if queue else None
+
+  def remaining(self, session_id):
+    with self._lock:
+      return len(self._touch(session_id, time.monotonic()))
+
+  def delete(self, session_id):
+    with self._lock:
+      return self._sessions.pop(session_id, None) is not None
+
+
+class RedisQuizSessionStore:
+  '''Keeps each quiz session's queue as a Redis list (plus a small marker key, since Redis drops emptied lists),
+    so that sessions are shared by every worker. client is a redis-py client or a LocalRedis stand-in.
+  '''
+  def __init__(self, client, ttl=3600, prefix="trivia:quiz:"):
+    self.client = client
+    self.ttl = ttl
+    self.prefix = prefix
+
+  def _keys(self, session_id):
+    return f"{self.prefix}{session_id}", f"{self.prefix}{session_id}:total"
+
+  def create(self, question_ids):
+    session_id = secrets.token_urlsafe(16)
+    queue_key, marker_key = self._keys(session_id)
+    self.client.set(marker_key, len(question_ids), ex=self.ttl)
+    if question_ids:
+      self.client.rpush(queue_key, *question_ids)
+      self.client.expire(queue_key, self.ttl)
+    return session_id
+
+  def pop(self, session_id):
+    '''Return the next question id of the session, or None once the queue is empty. Raise a KeyError for an
+      unknown or expired session.
+    '''
+    queue_key, marker_key = self._keys(session_id)
+    if not self.client.expire(marker_key, self.ttl):
+      raise KeyError(session_id)
+    question_id = self.client.lpop(queue_key)
+    if question_id is None:
+      return None
+    self.client.expire(queue_key, self.ttl)
+    return int(question_id)
+
+  def remaining(self, session_id):
+    queue_key, marker_key = self._keys(session_id)
+    if not self.client.exists(marker_key):
+      raise KeyError(session_id)
+    return self.client.llen(queue_key)
+
+  def delete(self, session_id):
+    return self.client.delete(*self._keys(session_id)) > 0
+
+
+def create_quiz_session_store(config):
+  '''Build the quiz session store selected by the app config: QUIZ_SESSION_STORE is 'memory' (the default) or
+    'redis'. The Redis store connects to REDIS_URL, or uses an in-process LocalRedis when it is not set.
+  '''
+  kind = config.get("QUIZ_SESSION_STORE", "memory")
+  ttl = config.get("QUIZ_SESSION_TTL", 3600)
+  if kind == "memory":
+    return MemoryQuizSessionStore(ttl, config.get("QUIZ_SESSION_MAX", 100000))
+  if kind == "redis":
+    return RedisQuizSessionStore(redis_client(config.get("REDIS_URL")), ttl)
+  raise ValueError(f"Unknown quiz session store {kind}.")
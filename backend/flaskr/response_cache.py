@@ -0,0 +1,251 @@
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+from urllib.parse import urlencode
+
+from flask import current_app, make_response, request
+
+from models import observe_categories, observe_questions
+from .local_redis import redis_client
+
+
+ALL_TAG = "*"
+QUESTIONS_TAG = "questions"
+
+
+def category_tag(category_id):
+  try:
+    return f"category:{int(category_id)}"
+  except (TypeError, ValueError):
+    return f"category:{category_id}"
+
+
+class MemoryResponseBackend:
+  '''Keeps cached response bodies in process memory, evicting the least recently used ones once more than
+    max_entries responses or max_bytes of bodies are held. Entries also expire ttl seconds after they are stored,
+    which bounds how long changes committed by other processes can go unnoticed.
+  '''
+  def __init__(self, max_entries=10000, max_bytes=64 * 1024 * 1024, ttl=5):
+    self.max_entries = max_entries
+    self.max_bytes = max_bytes
+    self.ttl = ttl
+    self.size = 0
+    self._entries = OrderedDict()
+    self._generations = {}
+    self._lock = threading.Lock()
+
+  def generations(self, tags):
+    with self._lock:
+      return [self._generations.get(tag, 0) for tag in tags]
+
+  def bump(self, tags):
+    with self._lock:
+      for tag in tags:
+        self._generations[tag] = self._generations.get(tag, 0) + 1
+
+  def get(self, key):
+    with self._lock:
+      entry = self._entries.get(key)
+      if entry is None:
+        return None
+      expires_at, value = entry
+      if expires_at <= time.monotonic():
+        self._remove(key)
+        return None
+      self._entries.move_to_end(key)
+      return value
+
+  def set(self, key, value):
+    if len(value) > self.max_bytes:
+      return
+    with self._lock:
+      if key in self._entries:
+        self._remove(key)
+      self._entries[key] = (time.monotonic() + self.ttl, value)
+      self.size += len(value)
+      while len(self._entries) > self.max_entries or self.size > self.max_bytes:
+        self._remove(next(iter(self._entries)))
+
+  def _remove(self, key):
+    _, value = self._entries.pop(key)
+    self.size -= len(value)
+
+  def entries(self):
+    return len(self._entries)
+
+
+class RedisResponseBackend:
+  '''Keeps cached response bodies and tag generations in Redis, so that every worker shares the cache and sees
+    invalidations made by the others at once. client is a redis-py client or a LocalRedis stand-in.
+  '''
+  def __init__(self, client, ttl=300, prefix="trivia:response:"):
+    self.client = client
+    self.ttl = ttl
+    self.prefix = prefix
+
+  def generations(self, tags):
+    return [int(generation or 0) for generation in self.client.mget([f"{self.prefix}gen:{tag}" for tag in tags])]
+
+  def bump(self, tags):
+    for tag in tags:
+      self.client.incr(f"{self.prefix}gen:{tag}")
+
+  def get(self, key):
+    return self.client.get(self.prefix + key)
+
+  def set(self, key, value):
+    self.client.set(self.prefix + key, value, ex=self.ttl)
+
+  def entries(self):
+    return None
+
+
+def create_response_backend(config):
+  '''Build the response cache backend selected by the app config: RESPONSE_CACHE is 'memory' (the default),
+    'redis' or 'none'. The Redis backend connects to REDIS_URL, or uses an in-process LocalRedis when it is not set.
+  '''
+  kind = config.get("RESPONSE_CACHE", "memory")
+  if kind == "none":
+    return None
+  if kind == "memory":
+    return MemoryResponseBackend(config.get("RESPONSE_CACHE_MAX_ENTRIES", 10000),
+                                 config.get("RESPONSE_CACHE_MAX_BYTES", 64 * 1024 * 1024),
+                                 config.get("RESPONSE_CACHE_TTL", 5))
+  if kind == "redis":
+    return RedisResponseBackend(redis_client(config.get("REDIS_URL")), config.get("RESPONSE_CACHE_TTL", 300))
+  raise ValueError(f"Unknown response cache {kind}.")
+
+
+class ResponseCache:
+  '''Caches the bodies of successful JSON responses, keyed by endpoint and normalized request parameters.
+
+    Every entry depends on tags: ALL_TAG, plus QUESTIONS_TAG for responses built from all questions, or the tag of
+    a category for responses built from the questions of that category. Each tag has a generation number that is
+    part of the key, so invalidating a tag is a single increment and stale entries simply stop being found (and
+    age out of the backend). Question changes invalidate only the tags of the categories they touch. Category changes
+    invalidate everything, since every listing carries the category names.
+  '''
+  def __init__(self):
+    self.backend = None
+    self.hits = {}
+    self.misses = {}
+    self._lock = threading.Lock()
+
+  def configure(self, config):
+    self.backend = create_response_backend(config)
+    with self._lock:
+      self.hits.clear()
+      self.misses.clear()
+
+  def invalidate(self, tags):
+    if self.backend is not None:
+      self.backend.bump(tags)
+
+  def on_question_change(self, event_name, records):
+    if event_name in ('insert', 'delete'):
+      self.invalidate([QUESTIONS_TAG] + sorted({ category_tag(record['category']) for record in records }))
+    else:
+      # An update may have moved a question out of a category it no longer names.
+      self.invalidate([ALL_TAG])
+
+  def on_category_change(self):
+    self.invalidate([ALL_TAG])
+
+  def _count(self, counts, endpoint):
+    with self._lock:
+      counts[endpoint] = counts.get(endpoint, 0) + 1
+
+  def _key(self, endpoint, params, tags):
+    tags = [ALL_TAG] + tags
+    generations = self.backend.generations(tags)
+    versions = ",".join(f"{tag}={generation}" for tag, generation in zip(tags, generations))
+    return f"{endpoint}?{urlencode(sorted(params.items()))}#{versions}"
+
+  def cached(self, params, tags):
+    '''Decorate a view whose response is determined by the request parameters returned by params() (a dictionary
+      of normalized values, or None if the request should not be cached) and the data behind the tags returned by
+      tags(**view_args).
+    '''
+    def decorator(view):
+      @wraps(view)
+      def cached_view(*args, **kwargs):
+        request_params = params() if self.backend is not None else None
+        if request_params is None:
+          return view(*args, **kwargs)
+
+        key, body = self.lookup(request.endpoint, request_params, tags(**kwargs))
+        if body is not None:
+          return current_app.response_class(body, mimetype='application/json')
+
+        response = make_response(view(*args, **kwargs))
+        if response.status_code == 200 and not response.is_streamed and response.mimetype == 'application/json':
+          self.store(key, response.get_data())
+        return response
+      return cached_view
+    return decorator
+
+  def lookup(self, endpoint, params, tags):
+    '''Return (key, body) for a request to endpoint with the normalized params, whose response depends on the data
+      behind tags, and count the hit or miss; body is None on a miss, and the response is then stored under key.
+    '''
+    key = self._key(endpoint, params, tags)
+    body = self.backend.get(key)
+    self._count(self.misses if body is None else self.hits, endpoint)
+    return key, body
+
+  def store(self, key, body):
+    self.backend.set(key, body)
+
+  def stats(self):
+    with self._lock:
+      endpoints = {}
+      for endpoint in sorted(set(self.hits) | set(self.misses)):
+        hits = self.hits.get(endpoint, 0)
+        misses = self.misses.get(endpoint, 0)
+        endpoints[endpoint] = { 'hits': hits, 'misses': misses, 'hit_ratio': hits / (hits + misses) }
+      hits = sum(self.hits.values())
+      misses = sum(self.misses.values())
+    return {
+      'backend': type(self.backend).__name__ if self.backend is not None else None,
+      'entries': self.backend.entries() if self.backend is not None else 0,
+      'hits': hits,
+      'misses': misses,
+      'hit_ratio': hits / (hits + misses) if hits + misses else None,
+      'endpoints': endpoints,
+    }
+
+
+response_cache = ResponseCache()
+observe_questions(response_cache.on_question_change)
+observe_categories(response_cache.on_category_change)
+
+
+def listing_params():
+  '''Normalized parameters of the current question listing request, or None for a streamed one.'''
+  return listing_args_params(request.args)
+
+
+def listing_args_params(args):
+  '''Normalized parameters of a question listing request with the query string args, or None for a streamed one.'''
+  if args.get("stream", "false").lower() in ("1", "true", "yes"):
+    return None
+  return { name: args[name] for name in ("page", "cursor", "per_page") if name in args }
+
+
+def search_params():
+  '''Normalized parameters of the current search request.'''
+  return search_body_params(request.get_json(silent=True))
+
+
+def search_body_params(body):
+  '''Normalized parameters of a search request with the JSON body (None if it is not valid JSON). Search ignores
+    case and spacing, so the term is normalized to lowercase words separated by single spaces.
+  '''
+  if not isinstance(body, dict) or not isinstance(body.get("searchTerm"), str):
+    return None
+  params = { "searchTerm": " ".join(body["searchTerm"].lower().split()) }
+  for name in ("page", "cursor"):
+    if body.get(name) is not None:
+      params[name] = body[name]
+  return params
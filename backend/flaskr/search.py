@@ -0,0 +1,152 @@
+import re
+import threading
+from collections import Counter
+
+from sqlalchemy import func, literal_column
+
+from models import db, Question, QuestionStat, SEARCH_CONFIG, SEARCH_VECTOR_COLUMN, observe_questions
+from .pagination import QUESTIONS_PER_PAGE, count_rows, decode_cursor, encode_cursor, get_page_range
+
+
+TOKEN_PATTERN = re.compile(r"\w+")
+
+
+def tokenize(text):
+  '''Split text into lowercase word tokens.'''
+  return TOKEN_PATTERN.findall((text or "").lower())
+
+
+class InvertedIndex:
+  '''In-process inverted index over question and answer text: maps every token to the ids of the questions
+    containing it, together with how often it occurs there.
+  '''
+  def __init__(self):
+    self.postings = {}
+    self.doc_tokens = {}
+
+  def add(self, question_id, text):
+    self.remove(question_id)
+    counts = Counter(tokenize(text))
+    self.doc_tokens[question_id] = tuple(counts)
+    for token, count in counts.items():
+      self.postings.setdefault(token, {})[question_id] = count
+
+  def remove(self, question_id):
+    for token in self.doc_tokens.pop(question_id, ()):
+      posting = self.postings.get(token)
+      if posting is not None:
+        posting.pop(question_id, None)
+        if not posting:
+          del self.postings[token]
+
+  def search(self, tokens):
+    '''Return the ids of questions containing every token, best matches (most occurrences) first.'''
+    postings = [self.postings.get(token, {}) for token in set(tokens)]
+    if not postings:
+      return []
+    postings.sort(key=len)
+    scores = {}
+    for question_id in postings[0]:
+      if all(question_id in posting for posting in postings[1:]):
+        scores[question_id] = sum(posting[question_id] for posting in postings)
+    return sorted(scores, key=lambda question_id: (-scores[question_id], question_id))
+
+
+class MemorySearchBackend:
+  '''Search backend for databases without full-text search (SQLite, test setups). The index is built from the
+    questions table on first use and then follows it through the question change observers.
+  '''
+  def __init__(self):
+    self.index = None
+    self._lock = threading.Lock()
+
+  def on_question_change(self, event_name, records):
+    with self._lock:
+      if self.index is None:
+        return
+      if event_name == 'reset':
+        self.index = None
+      elif event_name == 'delete':
+        for record in records:
+          self.index.remove(record['id'])
+      else:
+        for record in records:
+          self.index.add(record['id'], f"{record['question']} {record['answer']}")
+
+  @staticmethod
+  def _build():
+    index = InvertedIndex()
+    for question_id, question, answer in db.session.query(Question.id, Question.question, Question.answer):
+      index.add(question_id, f"{question} {answer}")
+    return index
+
+  def build(self):
+    '''Build the index from the questions table. Must run inside an application context.'''
+    with self._lock:
+      self.index = self._build()
+
+  def _current_index(self):
+    with self._lock:
+      if self.index is None:
+        self.index = self._build()
+      return self.index
+
+  def search(self, term, page=1, cursor=None):
+    ranked_ids = self._current_index().search(tokenize(term))
+    if cursor is not None:
+      position = decode_cursor(cursor)
+      if "offset" not in position:
+        raise ValueError(f"Cursor {cursor} is not valid for this listing.")
+      start = position["offset"]
+    else:
+      if page < 1:
+        raise ValueError(f"Page {page} does not exist.")
+      start = (page - 1) * QUESTIONS_PER_PAGE
+
+    page_ids = ranked_ids[start:start + QUESTIONS_PER_PAGE]
+    by_id = { row.id: row for row in Question.rows().filter(Question.id.in_(page_ids)) } if page_ids else {}
+    records = [Question.format_row(by_id[question_id]) for question_id in page_ids if question_id in by_id]
+    next_cursor = None
+    if start + QUESTIONS_PER_PAGE < len(ranked_ids):
+      next_cursor = encode_cursor({"offset": start + QUESTIONS_PER_PAGE})
+    return records, len(ranked_ids), next_cursor
+
+
+class PostgresSearchBackend:
+  '''Search backend using the tsvector column and GIN index added by the search index migration. Matching,
+    ranking and paging all happen inside the database.
+  '''
+  def queries(self, query, term):
+    '''Return (matching, ranked): query (of questions) narrowed to the matches of term, unordered and best matches
+      first.
+    '''
+    search_vector = literal_column(f"{Question.__tablename__}.{SEARCH_VECTOR_COLUMN}")
+    search_query = func.plainto_tsquery(SEARCH_CONFIG, term)
+    matching_query = query.filter(search_vector.op('@@')(search_query))
+    return matching_query, matching_query.order_by(func.ts_rank(search_vector, search_query).desc(), Question.id)
+
+  def search(self, term, page=1, cursor=None):
+    matching_query, ranked_query = self.queries(Question.rows(), term)
+    records, next_cursor = get_page_range(ranked_query, page, cursor, formatter=Question.format_row)
+    return records, count_rows(matching_query, Question.id), next_cursor
+
+
+memory_search_backend = MemorySearchBackend()
+observe_questions(memory_search_backend.on_question_change)
+postgres_search_backend = PostgresSearchBackend()
+
+
+def search_questions(term, page=1, cursor=None, backend=None):
+  '''Search question and answer text for every word of term and return a tuple (records, total, next_cursor) for
+    the requested page, best matches first. backend is 'postgresql' or 'memory'; by default PostgreSQL full-text
+    search is used whenever the database supports it. A term without any words matches every question.
+  '''
+  if not tokenize(term):
+    records, next_cursor = get_page_range(Question.rows(), page, cursor, key=Question.id, formatter=Question.format_row)
+    return records, QuestionStat.total(), next_cursor
+
+  if backend is None:
+    backend = 'postgresql' if db.engine.dialect.name == 'postgresql' else 'memory'
+  if backend == 'postgresql':
+    return postgres_search_backend.search(term, page, cursor)
+  return memory_search_backend.search(term, page, cursor)
@@ -0,0 +1,56 @@
+import json
+
+from flask import Response, stream_with_context
+
+
+STREAM_CHUNK_SIZE = 64 * 1024
+
+
+def dumps(value):
+  '''Serialize value to compact JSON with sorted keys, as jsonify does outside debug mode.'''
+  return json.dumps(value, sort_keys=True, separators=(',', ':'))
+
+
+def chunked(pieces, chunk_size=STREAM_CHUNK_SIZE):
+  '''Join small string pieces into chunks of about chunk_size characters, so a streamed response isn't written
+    one tiny piece at a time.
+  '''
+  chunk = []
+  size = 0
+  for piece in pieces:
+    chunk.append(piece)
+    size += len(piece)
+    if size >= chunk_size:
+      yield "".join(chunk)
+      chunk = []
+      size = 0
+  if chunk:
+    yield "".join(chunk)
+
+
+def stream_json_object(fields, list_key, items, trailing_fields=None):
+  '''Yield the JSON encoding of an object piece by piece: first the entries of the fields dictionary, then
+    list_key holding the items of the iterable items (encoded one at a time as they are produced), then the entries
+    returned by trailing_fields, a callable run once the items are exhausted (for values such as a next-page cursor
+    that are only known at the end). Only one item is held in memory at any time.
+  '''
+  yield '{'
+  for name, value in fields.items():
+    yield f'{dumps(name)}:{dumps(value)},'
+  yield f'{dumps(list_key)}:['
+  separator = ''
+  for item in items:
+    yield separator + dumps(item)
+    separator = ','
+  yield ']'
+  for name, value in (trailing_fields() if trailing_fields is not None else {}).items():
+    yield f',{dumps(name)}:{dumps(value)}'
+  yield '}\n'
+
+
+def stream_json_response(fields, list_key, items, trailing_fields=None):
+  '''Return a streamed application/json response built by stream_json_object. The request context stays
+    available while the body is produced, so items may read from the database lazily.
+  '''
+  return Response(stream_with_context(chunked(stream_json_object(fields, list_key, items, trailing_fields))),
+                  mimetype='application/json')
@@ -0,0 +1,150 @@
+QUESTION_FIELDS = ["question", "answer", "category", "difficulty"]
+MIN_DIFFICULTY = 1
+MAX_DIFFICULTY = 5
+# The first question of an adaptive quiz that does not give a difficulty.
+DEFAULT_DIFFICULTY = 3
+
+
+def validate_question(body):
+  '''Check that body (a dictionary, such as a parsed request) describes a valid question and return the values of
+    QUESTION_FIELDS in order. Raise a ValueError describing the first problem otherwise.
+  '''
+  if not isinstance(body, dict):
+    raise ValueError("The request is not a JSON object.")
+
+  for field in QUESTION_FIELDS:
+    if body.get(field) is None:
+      raise ValueError(f"The request does not include a field for {field}.")
+
+  if not isinstance(body.get("difficulty"), int):
+    raise ValueError("The request does not include an integer-valued difficulty.")
+
+  if not (MIN_DIFFICULTY <= body.get("difficulty") <= MAX_DIFFICULTY):
+    raise ValueError("The request difficulty is not within the allowed range of 1 to 5 inclusive.")
+
+  return [body.get(field) for field in QUESTION_FIELDS]
+
+
+def _parse_difficulty(value):
+  if isinstance(value, bool) or not isinstance(value, int) or not (MIN_DIFFICULTY <= value <= MAX_DIFFICULTY):
+    raise ValueError(f"The difficulty {value!r} is not within the allowed range of 1 to 5 inclusive.")
+  return value
+
+
+def _parse_difficulties(body):
+  '''The set of difficulties named by the "difficulty" of a request, as one integer or a list of them, or None
+    for any difficulty.
+  '''
+  difficulty = body.get("difficulty")
+  if difficulty is None:
+    return None
+  if isinstance(difficulty, list) and difficulty:
+    return { _parse_difficulty(value) for value in difficulty }
+  return { _parse_difficulty(difficulty) }
+
+
+def _parse_difficulty_plan(body):
+  '''The sets of difficulties to draw a quiz question from, in order of preference. With "adaptive" set, the
+    "difficulty" is that of the last question asked (DEFAULT_DIFFICULTY for the first) and "correct" tells whether
+    it was answered correctly: the next question is one level harder after a correct answer and one level easier
+    after a wrong one, falling back to the nearest difficulties (easier first) when that level has run out.
+  '''
+  if not body.get("adaptive"):
+    return [_parse_difficulties(body)]
+  current = _parse_difficulty(body.get("difficulty", DEFAULT_DIFFICULTY))
+  correct = body.get("correct")
+  if correct is not None and not isinstance(correct, bool):
+    raise ValueError("The request correct field is not a boolean.")
+  if correct is not None:
+    current = min(max(current + (1 if correct else -1), MIN_DIFFICULTY), MAX_DIFFICULTY)
+  levels = sorted(range(MIN_DIFFICULTY, MAX_DIFFICULTY + 1), key=lambda level: (abs(level - current), level))
+  return [{ level } for level in levels]
+
+
+def parse_question_selection(body, max_ids):
+  '''Return (ids, category id, difficulties) from the body of a bulk question request, which selects questions
+    either by "ids" (a list of at most max_ids question ids) or by a filter on "category" and/or "difficulty" (one
+    integer or a list of them). The parts not given are None. Raise a ValueError if the request selects nothing, or
+    mixes ids with a filter, so that a malformed request can never select the whole table.
+  '''
+  if not isinstance(body, dict):
+    raise ValueError("The request is not a JSON object.")
+  ids = body.get("ids")
+  category_id = body.get("category")
+  if ids is not None:
+    if category_id is not None or body.get("difficulty") is not None:
+      raise ValueError("The request selects questions both by id and by filter.")
+    if not isinstance(ids, list) or not ids or len(ids) > max_ids:
+      raise ValueError(f"The request ids are not a list of 1 to {max_ids} question ids.")
+    if any(isinstance(question_id, bool) or not isinstance(question_id, int) for question_id in ids):
+      raise ValueError("The request ids are not all integers.")
+    return sorted(set(ids)), None, None
+  if category_id is not None and (isinstance(category_id, bool) or not isinstance(category_id, int)):
+    raise ValueError("The request category is not an integer id.")
+  difficulties = _parse_difficulties(body)
+  if category_id is None and difficulties is None:
+    raise ValueError("The request does not select questions by ids, category or difficulty.")
+  return None, category_id, difficulties
+
+
+def parse_question_changes(body):
+  '''Return the column values to set from the "set" object of a bulk update request, which may change the
+    "category" and the "difficulty" of the selected questions. Raise a ValueError if it changes nothing, or
+    anything else.
+  '''
+  changes = body.get("set") if isinstance(body, dict) else None
+  if not isinstance(changes, dict) or not changes:
+    raise ValueError("The request does not include the values to set.")
+  unknown = sorted(set(changes) - {"category", "difficulty"})
+  if unknown:
+    raise ValueError(f"The request sets {', '.join(unknown)}, which bulk updates cannot change.")
+  if "category" in changes and (isinstance(changes["category"], bool) or not isinstance(changes["category"], int)):
+    raise ValueError("The request category is not an integer id.")
+  if "difficulty" in changes:
+    _parse_difficulty(changes["difficulty"])
+  return dict(changes)
+
+
+def parse_quiz_request(body, max_count):
+  '''Return (category id, previous question ids, difficulty plan, count) from the body of a quiz question request.
+    The difficulty plan lists the sets of difficulties to draw from in order of preference ([None] for any
+    difficulty). Count is the number of questions asked for, between 1 and max_count inclusive, or None for a single
+    question in the original response format. Raise a ValueError if the category or previous questions are missing,
+    or if anything is malformed.
+  '''
+  try:
+    category_id, previous_question_ids = int(body["quiz_category"]["id"]), list(body["previous_questions"])
+    count = body.get("count")
+    if count is not None and (isinstance(count, bool) or not isinstance(count, int) or not (1 <= count <= max_count)):
+      raise ValueError("The request count is not an allowed number of questions.")
+    return category_id, previous_question_ids, _parse_difficulty_plan(body), count
+  except (KeyError, TypeError, ValueError) as ex:
+    raise ValueError(f"The request does not describe a quiz question: {ex!r}.")
+
+
+def parse_quiz_session_request(body, max_length, default_length):
+  '''Return (category id, number of questions, previous question ids, difficulties) from the body of a quiz
+    session request. The number of questions defaults to default_length and must be between 1 and max_length
+    inclusive, and difficulties is a set of difficulties or None for any. Raise a ValueError otherwise.
+  '''
+  if not isinstance(body, dict):
+    raise ValueError("The request is not a JSON object.")
+  length = body.get("length", default_length)
+  if not isinstance(length, int) or not (1 <= length <= max_length):
+    raise ValueError("The request length is not an allowed number of questions.")
+  if body.get("adaptive"):
+    raise ValueError("Quiz sessions draw their questions up front and cannot adapt their difficulty.")
+  try:
+    return (int(body["quiz_category"]["id"]), length, list(body.get("previous_questions", [])),
+            _parse_difficulties(body))
+  except (KeyError, TypeError, ValueError) as ex:
+    raise ValueError(f"The request does not describe a quiz category: {ex!r}.")
+
+
+def parse_search_request(body):
+  '''Return (search term, page, cursor) from the body of a search request. Raise a ValueError if there is no
+    search term.
+  '''
+  if not isinstance(body, dict) or 'searchTerm' not in body:
+    raise ValueError("Improperly formatted request")
+  return body["searchTerm"], body.get("page", 1), body.get("cursor")
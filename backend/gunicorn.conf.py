@@ -0,0 +1,24 @@
+'''
+Gunicorn settings for serving the API with several worker processes. From the backend directory:
+
+    pip install gunicorn
+    gunicorn
+
+The app is built once, in the master, with PRELOAD: categories, quiz pools and the search indexes are loaded
+there and shared copy-on-write by every worker, which starts serving without a cold cache (see flaskr/preload.py).
+Workers are forked with no open database connections, and close any the master opened since, as soon as they
+start. Set WEB_CONCURRENCY for the number of workers and BIND for the address.
+'''
+import multiprocessing
+import os
+
+
+wsgi_app = "flaskr:create_app({'PRELOAD': True})"
+preload_app = True
+bind = os.environ.get("BIND", "127.0.0.1:5000")
+workers = int(os.environ.get("WEB_CONCURRENCY", multiprocessing.cpu_count() * 2 + 1))
+
+
+def post_fork(server, worker):
+  from flaskr.preload import dispose_connections
+  dispose_connections(server.app.wsgi())
@@ -0,0 +1,201 @@
+import logging
+from datetime import datetime
+
+from sqlalchemy import Column, DateTime, Integer, MetaData, String, Table, inspect, select, text
+from sqlalchemy.orm import Session
+
+from models import (CONTENT_VERSION_NAME, SEARCH_CONFIG, SEARCH_VECTOR_COLUMN, ContentChange, ContentVersion, Question,
+                    QuestionStat, reconcile_question_stats)
+
+
+logger = logging.getLogger(__name__)
+
+'''
+schema_migrations
+    the ids of the migrations applied to the database, with when they were applied.
+'''
+schema_migrations = Table(
+    'schema_migrations', MetaData(),
+    Column('id', String, primary_key=True),
+    Column('applied_at', DateTime, nullable=False),
+)
+
+# Serializes migrations run by several processes at once on PostgreSQL (an arbitrary advisory lock key).
+MIGRATION_LOCK_ID = 7411
+
+
+def _add_search_index(connection):
+    '''The full-text search column over question and answer text, its GIN index and the trigger that keeps it
+    current. PostgreSQL only; search falls back to an in-process index elsewhere.
+    '''
+    if connection.dialect.name != "postgresql":
+        return
+    trigger_name = f"questions_{SEARCH_VECTOR_COLUMN}_update"
+    # Databases set up before migrations existed may have everything in place already.
+    installed = connection.execute(
+        text("SELECT 1 FROM pg_trigger WHERE tgname = :name AND tgrelid = 'questions'::regclass"),
+        name=trigger_name).first()
+    if installed:
+        return
+    for statement in [
+        f"ALTER TABLE questions ADD COLUMN IF NOT EXISTS {SEARCH_VECTOR_COLUMN} tsvector",
+        f"""UPDATE questions
+            SET {SEARCH_VECTOR_COLUMN} = to_tsvector('{SEARCH_CONFIG}', coalesce(question, '') || ' ' || coalesce(answer, ''))
+            WHERE {SEARCH_VECTOR_COLUMN} IS NULL""",
+        f"CREATE INDEX IF NOT EXISTS questions_{SEARCH_VECTOR_COLUMN}_idx ON questions USING GIN ({SEARCH_VECTOR_COLUMN})",
+        f"""CREATE TRIGGER {trigger_name}
+            BEFORE INSERT OR UPDATE OF question, answer ON questions
+            FOR EACH ROW EXECUTE PROCEDURE
+            tsvector_update_trigger({SEARCH_VECTOR_COLUMN}, '{SEARCH_CONFIG}', question, answer)""",
+    ]:
+        connection.execute(text(statement))
+
+
+def _add_content_version(connection):
+    '''The content version row, and the table of changes to questions and categories counted on top of it.'''
+    table = ContentVersion.__table__
+    table.create(connection, checkfirst=True)
+    _add_content_changes(connection)
+    if connection.execute(select([table.c.name]).where(table.c.name == CONTENT_VERSION_NAME)).first() is None:
+        connection.execute(table.insert().values(name=CONTENT_VERSION_NAME, version=1, updated_at=datetime.utcnow()))
+
+
+def _add_content_changes(connection):
+    '''The content_changes table, so that writers no longer update (and lock) the content version row.'''
+    ContentChange.__table__.create(connection, checkfirst=True)
+
+
+def _count_questions(connection):
+    '''The question_stats table, filled in from the questions table. Questions whose categories are still strings
+    are counted once 0004_category_integer_fk has turned them into ids.
+    '''
+    QuestionStat.__table__.create(connection, checkfirst=True)
+    if _category_is_integer(connection, 'questions'):
+        _reconcile(connection)
+
+
+def _category_is_integer(connection, table_name):
+    columns = inspect(connection).get_columns(table_name)
+    return isinstance(next(column['type'] for column in columns if column['name'] == 'category'), Integer)
+
+
+def _make_question_stats_category_integer_fk(connection):
+    '''Turn question_stats.category into an integer foreign key to categories.id. Its rows can all be recounted, so
+    a table from an older model is dropped and created again, and filled in by the reconcile that follows.
+    '''
+    if not _category_is_integer(connection, 'question_stats'):
+        QuestionStat.__table__.drop(connection)
+        QuestionStat.__table__.create(connection)
+
+
+def _reconcile(connection):
+    session = Session(bind=connection)
+    try:
+        reconcile_question_stats(session)
+        session.commit()
+    finally:
+        session.close()
+
+
+def _make_category_integer_fk(connection):
+    '''Turn questions.category into an integer foreign key to categories.id. Tables created from an older model
+    store categories as strings: numeric strings become ids, category names are looked up, and anything else (or an
+    id without a category) is set to NULL, as deleting a category does. question_stats.category becomes an integer
+    foreign key as well.
+    '''
+    _make_question_stats_category_integer_fk(connection)
+    if connection.dialect.name != "postgresql":
+        # SQLite cannot change a column's type. Its text affinity makes category = 4 match '4', and it does not
+        # enforce foreign keys by default, so there is nothing to backfill.
+        _reconcile(connection)
+        return
+    inspector = inspect(connection)
+    if not _category_is_integer(connection, 'questions'):
+        connection.execute(text("""
+            UPDATE questions SET category = categories.id::text
+            FROM categories
+            WHERE questions.category !~ '^\\s*[0-9]+\\s*$' AND lower(trim(questions.category)) = lower(categories.type)"""))
+        unknown = connection.execute(text("""
+            UPDATE questions SET category = NULL
+            WHERE category !~ '^\\s*[0-9]+\\s*$'""")).rowcount
+        if unknown:
+            logger.warning("Cleared the category of %d questions whose category was not an id or a name.", unknown)
+        connection.execute(text("ALTER TABLE questions ALTER COLUMN category TYPE integer USING trim(category)::integer"))
+
+    if not any(foreign_key['constrained_columns'] == ['category'] and foreign_key['referred_table'] == 'categories'
+               for foreign_key in inspector.get_foreign_keys('questions')):
+        orphans = connection.execute(text("""
+            UPDATE questions SET category = NULL
+            WHERE category IS NOT NULL AND NOT EXISTS (SELECT 1 FROM categories WHERE categories.id = questions.category)
+            """)).rowcount
+        if orphans:
+            logger.warning("Cleared the category of %d questions whose category does not exist.", orphans)
+        connection.execute(text("""
+            ALTER TABLE questions ADD CONSTRAINT questions_category_fkey
+            FOREIGN KEY (category) REFERENCES categories (id) ON UPDATE CASCADE ON DELETE SET NULL"""))
+    # Categories that were cleared no longer count towards their old keys.
+    _reconcile(connection)
+
+
+def _convert_question_stats_category(connection):
+    '''Turn question_stats.category into an integer foreign key to categories.id on databases that applied
+    0004_category_integer_fk before it covered question_stats.
+    '''
+    if not _category_is_integer(connection, 'question_stats'):
+        _make_question_stats_category_integer_fk(connection)
+        _reconcile(connection)
+
+
+def _add_category_indexes(connection):
+    '''Indexes for category pages (category, id) and for picking quiz questions by category and difficulty.'''
+    existing = { index['name'] for index in inspect(connection).get_indexes('questions') }
+    for index in Question.__table__.indexes:
+        if index.name not in existing:
+            index.create(connection)
+    if connection.dialect.name == "postgresql":
+        connection.execute(text("ANALYZE questions"))
+
+
+'''
+MIGRATIONS
+    every schema change, in the order they are applied, as (id, function) pairs. A function receives a connection
+    in the migration's own transaction. Migrations also run against databases whose tables were just created from
+    the current models (by init_db) or restored from trivia.psql, so each one checks what is already in place.
+    Append new migrations at the end and never change the id of one that has shipped.
+'''
+MIGRATIONS = [
+    ("0001_search_index", _add_search_index),
+    ("0002_content_version", _add_content_version),
+    ("0003_question_stats", _count_questions),
+    ("0004_category_integer_fk", _make_category_integer_fk),
+    ("0005_category_indexes", _add_category_indexes),
+    ("0006_content_changes", _add_content_changes),
+    ("0007_question_stats_category_fk", _convert_question_stats_category),
+]
+
+
+def applied_migrations(engine):
+    '''Return a dictionary of the ids of the applied migrations to when they were applied.'''
+    with engine.connect() as connection:
+        if not engine.dialect.has_table(connection, schema_migrations.name):
+            return {}
+        return dict(connection.execute(select([schema_migrations.c.id, schema_migrations.c.applied_at])).fetchall())
+
+
+def migrate(engine):
+    '''Apply the pending migrations in order, each in its own transaction, and return the ids of those applied.'''
+    schema_migrations.create(engine, checkfirst=True)
+    applied = []
+    for migration_id, apply in MIGRATIONS:
+        with engine.begin() as connection:
+            if connection.dialect.name == "postgresql":
+                connection.execute(text("SELECT pg_advisory_xact_lock(:id)"), id=MIGRATION_LOCK_ID)
+            done = connection.execute(select([schema_migrations.c.id])
+                                      .where(schema_migrations.c.id == migration_id)).first()
+            if done is not None:
+                continue
+            logger.info("Applying migration %s.", migration_id)
+            apply(connection)
+            connection.execute(schema_migrations.insert().values(id=migration_id, applied_at=datetime.utcnow()))
+            applied.append(migration_id)
+    return applied
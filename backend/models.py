@@ -1,24 +1,205 @@
+import logging
 import os
-from sqlalchemy import Column, String, Integer, create_engine
-from flask_sqlalchemy import SQLAlchemy
+import threading
+import time
+from collections import Counter
+from datetime import datetime
+from functools import wraps
+from itertools import chain
+from sqlalchemy import BigInteger, Column, String, Integer, DateTime, ForeignKey, Index, create_engine, event, func, select, text
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.orm import Session, attributes, sessionmaker
+from sqlalchemy.pool import NullPool
+from flask import g, has_request_context
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
 import json
 
 database_name = "trivia"
 database_path = "postgres://{}:{}@{}/{}".format(os.environ.get('MY_PG_USER'), os.environ.get('MY_PG_PWD'), 'localhost:5432', database_name)
+default_database_path = database_path
 
+logger = logging.getLogger(__name__)
 
-db = SQLAlchemy()
+'''
+ReplicaSet
+    read replicas of the database, handed out round robin. A replica is pinged at most every check_interval
+    seconds before use; one that fails is skipped for retry_interval seconds. choose returns None when no replica
+    is healthy, and the primary is used instead.
+'''
+class ReplicaSet:
+  def __init__(self, engines, check_interval=5, retry_interval=30):
+    self.engines = engines
+    self.check_interval = check_interval
+    self.retry_interval = retry_interval
+    self._next = 0
+    self._checked_at = [0] * len(engines)
+    self._down_until = [0] * len(engines)
+    self._lock = threading.Lock()
+
+  def _healthy(self, index):
+    now = time.monotonic()
+    if self._down_until[index] > now:
+      return False
+    if now - self._checked_at[index] >= self.check_interval:
+      self._checked_at[index] = now
+      try:
+        with self.engines[index].connect() as connection:
+          connection.execute(text("SELECT 1"))
+      except Exception as ex:
+        logger.warning("Replica %s is unavailable: %s", repr(self.engines[index].url), ex)
+        self._down_until[index] = now + self.retry_interval
+        return False
+    return True
+
+  def choose(self):
+    with self._lock:
+      start = self._next
+      self._next = (self._next + 1) % len(self.engines)
+    for offset in range(len(self.engines)):
+      index = (start + offset) % len(self.engines)
+      if self._healthy(index):
+        return self.engines[index]
+    return None
+
+  def dispose(self):
+    for engine in self.engines:
+      engine.dispose()
+
+
+'''
+RoutingSession
+    session that sends the reads of read-only requests (views decorated with read_only) to a replica of the app's
+    ReplicaSet. The replica is chosen on the first read and kept until the session is closed, so that all the
+    statements of a request see the same replica (totals and rows from different replicas may disagree). Everything
+    else goes to the primary: writes, requests not marked read-only, and every statement of a session once it has
+    flushed a change, so that a request reads its own writes (the session lasts one request).
+'''
+class RoutingSession(SignallingSession):
+  def get_bind(self, mapper=None, clause=None):
+    replicas = self.app.extensions.get('replicas')
+    if replicas is not None and not self._flushing and not self.info.get('wrote') and \
+        has_request_context() and g.get('read_only'):
+      if 'replica' not in self.info:
+        # None when no replica is healthy: the primary then serves the whole session.
+        self.info['replica'] = replicas.choose()
+      engine = self.info['replica']
+      if engine is not None:
+        return engine
+    return super().get_bind(mapper, clause)
+
+  def close(self):
+    super().close()
+    self.info.pop('replica', None)
+    self.info.pop('wrote', None)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+  def create_session(self, options):
+    return sessionmaker(class_=RoutingSession, db=self, **options)
+
+
+def read_only(view):
+  '''Mark a view as read-only, so that its queries may be answered by a read replica.'''
+  @wraps(view)
+  def read_only_view(*args, **kwargs):
+    g.read_only = True
+    return view(*args, **kwargs)
+  return read_only_view
+
+
+@event.listens_for(Session, 'after_flush')
+def _track_writes(session, flush_context):
+  session.info['wrote'] = True
+
+
+db = RoutingSQLAlchemy()
 
 '''
 setup_db(app)
-    binds a flask application and a SQLAlchemy service
+    binds a flask application and a SQLAlchemy service. The database is database_path if given, else the
+    SQLALCHEMY_DATABASE_URI of the app config, else the local trivia database. Engine and pool settings come from
+    the app config (see engine_options). SQLALCHEMY_REPLICA_URIS (a list, or a comma-separated string) names read
+    replicas for read-only views (see RoutingSession). The schema is not created here: run init_db (flask init-db) once instead.
 '''
-def setup_db(app, database_path=database_path):
-    app.config["SQLALCHEMY_DATABASE_URI"] = database_path
+def setup_db(app, database_path=None):
+    database_uri = database_path or app.config.get("SQLALCHEMY_DATABASE_URI") or default_database_path
+    app.config["SQLALCHEMY_DATABASE_URI"] = database_uri
     app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = engine_options(app.config, database_uri)
     db.app = app
     db.init_app(app)
+    engine = db.get_engine(app)
+    _listen_for_statement_timeout(app, engine)
+    if 'replicas' in app.extensions:
+        app.extensions.pop('replicas').dispose()
+    replica_uris = app.config.get("SQLALCHEMY_REPLICA_URIS") or []
+    if isinstance(replica_uris, str):
+        replica_uris = [uri.strip() for uri in replica_uris.split(",") if uri.strip()]
+    if replica_uris:
+        replica_engines = [create_engine(uri, **engine_options(app.config, uri)) for uri in replica_uris]
+        for replica_engine in replica_engines:
+            _listen_for_statement_timeout(app, replica_engine)
+        app.extensions['replicas'] = ReplicaSet(replica_engines, app.config.get("DB_REPLICA_CHECK_INTERVAL", 5),
+                                                app.config.get("DB_REPLICA_RETRY_INTERVAL", 30))
+    content_versions.ttl = app.config.get("CONTENT_VERSION_TTL", content_versions.ttl)
+    content_versions.invalidate()
+    notify_question_observers('reset', [])
+    category_registry.ttl = app.config.get("CATEGORY_CACHE_TTL", category_registry.ttl)
+    category_registry.invalidate()
+
+'''
+init_db()
+    creates the tables that are missing and applies the pending schema migrations (see migrations.py), which add
+    the full-text search index, the content version row, the question counts and the category indexes. Every step
+    is idempotent. Run it once per database (flask init-db) rather than on every start, so that workers don't query
+    the catalog at boot.
+'''
+def init_db():
+    from migrations import migrate
     db.create_all()
+    return migrate(db.engine)
+
+'''
+engine_options(config, database_uri)
+    SQLAlchemy engine options from the app config:
+    DB_POOL_SIZE, DB_MAX_OVERFLOW, DB_POOL_TIMEOUT and DB_POOL_RECYCLE size the connection pool of each process;
+    DB_POOL_PRE_PING checks connections before handing them out; DB_STATEMENT_TIMEOUT_MS makes PostgreSQL cancel
+    statements running longer. With DB_PGBOUNCER, connections are not pooled in the process (PgBouncer does the
+    pooling) and the statement timeout is set per transaction with SET LOCAL, since PgBouncer's transaction pooling
+    does not keep session settings. Pool settings do not apply to SQLite.
+'''
+def engine_options(config, database_uri):
+    backend = make_url(database_uri).get_backend_name()
+    if backend == "sqlite":
+        return {}
+    options = { "pool_pre_ping": config.get("DB_POOL_PRE_PING", False) }
+    if config.get("DB_PGBOUNCER"):
+        options["poolclass"] = NullPool
+    else:
+        options.update({
+            "pool_size": config.get("DB_POOL_SIZE", 5),
+            "max_overflow": config.get("DB_MAX_OVERFLOW", 10),
+            "pool_timeout": config.get("DB_POOL_TIMEOUT", 30),
+            "pool_recycle": config.get("DB_POOL_RECYCLE", -1),
+        })
+        if config.get("DB_STATEMENT_TIMEOUT_MS") and backend in ("postgresql", "postgres"):
+            options["connect_args"] = { "options": f"-c statement_timeout={int(config['DB_STATEMENT_TIMEOUT_MS'])}" }
+    return options
+
+def _listen_for_statement_timeout(app, engine):
+    if app.config.get("DB_PGBOUNCER") and app.config.get("DB_STATEMENT_TIMEOUT_MS") and \
+            engine.dialect.name == "postgresql" and not event.contains(engine, "begin", _set_local_statement_timeout):
+        event.listen(engine, "begin", _set_local_statement_timeout)
+
+def _set_local_statement_timeout(connection):
+    timeout = db.get_app().config["DB_STATEMENT_TIMEOUT_MS"]
+    connection.execute(text(f"SET LOCAL statement_timeout = {int(timeout)}"))
+
+# The full-text search column over question and answer text, and its configuration. PostgreSQL only; the column,
+# its GIN index and the trigger that keeps it current are added by a migration (see migrations.py).
+SEARCH_VECTOR_COLUMN = "search_vector"
+SEARCH_CONFIG = "pg_catalog.english"
 
 '''
 Question
@@ -30,9 +211,15 @@ class Question(db.Model):
   id = Column(Integer, primary_key=True)
   question = Column(String)
   answer = Column(String)
-  category = Column(String)
+  category = Column(Integer, ForeignKey('categories.id', onupdate='CASCADE', ondelete='SET NULL'))
   difficulty = Column(Integer)
 
+  __table_args__ = (
+    # Category pages are read in id order, and quizzes pick by category and difficulty.
+    Index('questions_category_id_idx', 'category', 'id'),
+    Index('questions_category_difficulty_idx', 'category', 'difficulty'),
+  )
+
   def __init__(self, question, answer, category, difficulty):
     self.question = question
     self.answer = answer
@@ -50,14 +237,22 @@ class Question(db.Model):
     db.session.delete(self)
     db.session.commit()
 
+  # Names and order of the fields of a formatted question, for Question instances and rows alike.
+  format_fields = ('id', 'question', 'answer', 'category', 'difficulty')
+
+  @classmethod
+  def rows(cls):
+    '''Return a query selecting the formatted columns of questions as plain named tuples, without building ORM
+      instances (no identity map or change tracking). Format the rows with format_row.
+    '''
+    return db.session.query(*(getattr(cls, field) for field in cls.format_fields))
+
+  @classmethod
+  def format_row(cls, row):
+    return dict(zip(cls.format_fields, row))
+
   def format(self):
-    return {
-      'id': self.id,
-      'question': self.question,
-      'answer': self.answer,
-      'category': self.category,
-      'difficulty': self.difficulty
-    }
+    return { field: getattr(self, field) for field in self.format_fields }
 
 '''
 Category
@@ -76,4 +271,460 @@ class Category(db.Model):
     return {
       'id': self.id,
       'type': self.type
-    }
\ No newline at end of file
+    }
+
+
+'''
+CategoryRegistry
+    in-process cache of the categories table. The table almost never changes, so it is loaded once (on first
+    use) and then served from memory. Commits that touch a Category invalidate it explicitly; the TTL only bounds
+    how long other processes' changes can go unnoticed.
+'''
+class CategoryRegistry:
+  def __init__(self, ttl=300):
+    self.ttl = ttl
+    self.hits = 0
+    self.misses = 0
+    self._types_by_id = None
+    self._loaded_at = 0
+    self._lock = threading.Lock()
+
+  def load(self):
+    return self.load_rows(db.session.query(Category.id, Category.type).order_by(Category.id).all())
+
+  def load_rows(self, rows):
+    '''Replace the registry's contents with (id, type) rows ordered by id, however they were read.'''
+    with self._lock:
+      self._types_by_id = { category_id: category_type for category_id, category_type in rows }
+      self._loaded_at = time.monotonic()
+    return self._types_by_id
+
+  def invalidate(self):
+    self._types_by_id = None
+
+  def stale(self):
+    '''Whether the next lookup will reload the categories.'''
+    return self._types_by_id is None or time.monotonic() - self._loaded_at > self.ttl
+
+  def _current(self):
+    types_by_id = self._types_by_id
+    if self.stale():
+      self.misses += 1
+      return self.load()
+    self.hits += 1
+    return types_by_id
+
+  def type_map(self):
+    '''Return a dictionary of category ids to category types. The ids are strings, the keys of the JSON objects the
+      map is sent as, so that every JSON backend sorts them alike.
+    '''
+    return { str(category_id): category_type for category_id, category_type in self._current().items() }
+
+  def types(self):
+    '''Return the list of category types ordered by id.'''
+    return list(self._current().values())
+
+  def get_type(self, category_id):
+    '''Return the type of the category with the given id, or None if there is no such category.'''
+    return self._current().get(int(category_id))
+
+  def stats(self):
+    return { 'hits': self.hits, 'misses': self.misses, 'size': len(self._types_by_id or {}) }
+
+
+category_registry = CategoryRegistry()
+
+
+'''
+Category change observers
+    callbacks run without arguments after a commit that added, changed or deleted categories, once the category
+    registry has been invalidated, so that caches holding category names can be dropped. Like the question change
+    observers, they must not use the session, and a callback that raises is logged and skipped.
+'''
+category_observers = []
+
+def observe_categories(callback):
+  category_observers.append(callback)
+  return callback
+
+
+@event.listens_for(Session, 'after_flush')
+def _track_category_changes(session, flush_context):
+  if any(isinstance(obj, Category) for obj in chain(session.new, session.dirty, session.deleted)):
+    session.info['categories_changed'] = True
+
+
+@event.listens_for(Session, 'after_commit')
+def _invalidate_category_registry(session):
+  if session.info.pop('categories_changed', False):
+    category_registry.invalidate()
+    for callback in category_observers:
+      try:
+        callback()
+      except Exception:
+        logger.exception("Category change observer %r failed", callback)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _discard_category_changes(session):
+  session.info.pop('categories_changed', None)
+
+
+'''
+ContentVersion
+    the version of the trivia content, which every process sharing the database agrees on (for ETags and
+    Last-Modified headers). Every transaction that changes the questions or categories tables adds a ContentChange
+    row, so the version is the ContentVersion row's count plus the number of committed changes. Writers only insert
+    rows of their own and never wait for each other; every CONTENT_CHANGES_COMPACT_EVERY changes, the older rows are
+    folded into the ContentVersion row. Bulk writes that bypass the ORM call bump_content_version themselves.
+'''
+CONTENT_VERSION_NAME = 'trivia'
+CONTENT_CHANGES_COMPACT_EVERY = 1000
+# Held shared by every writer and exclusively by reconcile_question_stats (an arbitrary advisory lock key).
+QUESTION_STATS_LOCK_ID = 7412
+
+class ContentVersion(db.Model):
+  __tablename__ = 'content_versions'
+
+  name = Column(String, primary_key=True)
+  version = Column(Integer, nullable=False)
+  updated_at = Column(DateTime, nullable=False)
+
+
+class ContentChange(db.Model):
+  __tablename__ = 'content_changes'
+
+  id = Column(BigInteger().with_variant(Integer, 'sqlite'), primary_key=True)
+  changed_at = Column(DateTime, nullable=False)
+
+
+def bump_content_version(session):
+  '''Increment the content version in the session's current transaction (once per transaction), by adding a
+    ContentChange row. Concurrent writers add rows of their own, so they do not block each other.
+  '''
+  if session.info.get('content_version_bumped'):
+    return
+  connection = session.connection()
+  if connection.dialect.name == 'postgresql':
+    connection.execute(text("SELECT pg_advisory_xact_lock_shared(:id)"), id=QUESTION_STATS_LOCK_ID)
+  changed_at = datetime.utcnow()
+  change_id, = connection.execute(ContentChange.__table__.insert().values(changed_at=changed_at)).inserted_primary_key
+  if change_id % CONTENT_CHANGES_COMPACT_EVERY == 0:
+    _compact_content_changes(connection, change_id, changed_at)
+  session.info['content_version_bumped'] = True
+
+
+def _compact_content_changes(connection, before_id, changed_at):
+  # Rows of transactions still in flight are not visible, so they are left for a later compaction.
+  changes = ContentChange.__table__
+  folded = connection.execute(changes.delete().where(changes.c.id < before_id)).rowcount
+  table = ContentVersion.__table__
+  connection.execute(table.update()
+                     .where(table.c.name == CONTENT_VERSION_NAME)
+                     .values(version=table.c.version + folded, updated_at=changed_at))
+
+
+def content_version_query():
+  '''The statement selecting (version, updated_at, last change) of the content, in one consistent snapshot. The
+    content was last modified at the later of updated_at and the last change, if any.
+  '''
+  table = ContentVersion.__table__
+  changes = ContentChange.__table__
+  return select([table.c.version + select([func.count()]).select_from(changes).as_scalar(), table.c.updated_at,
+                 select([func.max(changes.c.changed_at)]).as_scalar()]).where(table.c.name == CONTENT_VERSION_NAME)
+
+
+'''
+ContentVersionCache
+    in-process copy of the content version. Commits made by this process refresh it immediately; the TTL bounds how
+    long a change committed by another process can go unnoticed.
+'''
+class ContentVersionCache:
+  def __init__(self, ttl=1.0):
+    self.ttl = ttl
+    self._current = None
+    self._loaded_at = 0
+
+  def invalidate(self):
+    self._current = None
+
+  def fresh(self):
+    '''Return the loaded (version, updated_at) if it is still within its TTL, else None.'''
+    current = self._current
+    if current is None or time.monotonic() - self._loaded_at > self.ttl:
+      return None
+    return current
+
+  def load_row(self, row):
+    '''Keep the (version, updated_at, last change) row of content_version_query(), however it was read, and return
+      the content version it gives.
+    '''
+    version, updated_at, changed_at = row
+    current = self._current = (version, max(updated_at, changed_at or updated_at))
+    self._loaded_at = time.monotonic()
+    return current
+
+  def current(self):
+    '''Return a tuple (version, updated_at) of the content version.'''
+    return self.fresh() or self.load_row(db.session.execute(content_version_query()).first())
+
+
+content_versions = ContentVersionCache()
+
+
+@event.listens_for(Session, 'after_flush')
+def _bump_content_version(session, flush_context):
+  if any(isinstance(obj, (Question, Category)) and (obj not in session.dirty or session.is_modified(obj))
+         for obj in chain(session.new, session.dirty, session.deleted)):
+    bump_content_version(session)
+
+
+@event.listens_for(Session, 'after_commit')
+def _refresh_content_version(session):
+  if session.info.pop('content_version_bumped', False):
+    content_versions.invalidate()
+
+
+@event.listens_for(Session, 'after_rollback')
+def _discard_content_version(session):
+  session.info.pop('content_version_bumped', None)
+
+
+'''
+QuestionStat
+    the number of questions of one category and difficulty. The counts are adjusted in the same transaction as
+    every change to the questions table, so question totals (overall, per category or per difficulty) are sums over
+    a few dozen rows instead of counts over the whole table. Writes through the ORM are counted by a flush listener;
+    bulk writes that bypass the ORM call adjust_question_stats themselves. reconcile_question_stats recounts the
+    table and repairs any drift.
+
+    Questions without a category are counted in rows whose category is NULL, one per difficulty. Deleting a
+    category through the ORM moves its counts there, in the same transaction (see _uncategorize_questions).
+'''
+class QuestionStat(db.Model):
+  __tablename__ = 'question_stats'
+  __table_args__ = (
+    Index('question_stats_category_difficulty_key', 'category', 'difficulty', unique=True,
+          postgresql_where=text('category IS NOT NULL'), sqlite_where=text('category IS NOT NULL')),
+    Index('question_stats_no_category_difficulty_key', 'difficulty', unique=True,
+          postgresql_where=text('category IS NULL'), sqlite_where=text('category IS NULL')),
+  )
+
+  id = Column(Integer, primary_key=True)
+  category = Column(Integer, ForeignKey('categories.id', onupdate='CASCADE', ondelete='CASCADE'))
+  difficulty = Column(Integer, nullable=False)
+  count = Column(Integer, nullable=False)
+
+  @staticmethod
+  def key(category, difficulty):
+    '''The (category, difficulty) key of a question's count, with 0 for a question without a category (which is
+      stored as NULL), so that keys sort.
+    '''
+    return (0 if category is None else int(category), 0 if difficulty is None else int(difficulty))
+
+  @classmethod
+  def total_query(cls, query, category=None):
+    '''Turn query (such as db.session.query()) into one selecting the number of questions, of the given category
+      if any. The category may be given as it appears in a URL ("4" or "04").
+    '''
+    query = query.with_entities(func.coalesce(func.sum(cls.count), 0))
+    if category is not None:
+      query = query.filter(cls.category == int(category))
+    return query
+
+  @classmethod
+  def total(cls, category=None):
+    '''Return the number of questions, of the given category if any.'''
+    return cls.total_query(db.session.query(), category).scalar()
+
+
+def _add_question_stat(connection, key, delta):
+    table = QuestionStat.__table__
+    category, difficulty = key
+    category = category or None
+    if connection.dialect.name == 'postgresql':
+        statement = postgresql.insert(table).values(category=category, difficulty=difficulty, count=delta)
+        if category is None:
+            conflict = { 'index_elements': [table.c.difficulty], 'index_where': table.c.category.is_(None) }
+        else:
+            conflict = { 'index_elements': [table.c.category, table.c.difficulty],
+                         'index_where': table.c.category.isnot(None) }
+        connection.execute(statement.on_conflict_do_update(
+            set_={ 'count': table.c.count + statement.excluded.count }, **conflict))
+        return
+    updated = connection.execute(table.update()
+                                 .where((table.c.category == category) & (table.c.difficulty == difficulty))
+                                 .values(count=table.c.count + delta))
+    if updated.rowcount == 0:
+        connection.execute(table.insert().values(category=category, difficulty=difficulty, count=delta))
+
+
+def adjust_question_stats(session, deltas):
+    '''Add deltas (a mapping of QuestionStat.key values to changes in the number of questions) to the question
+    counts, in the session's current transaction. Keys are written in sorted order so that concurrent writers lock
+    the rows in the same order.
+    '''
+    connection = session.connection()
+    for key, delta in sorted(deltas.items()):
+        if delta:
+            _add_question_stat(connection, key, delta)
+
+
+def reconcile_question_stats(session):
+    '''Recount the questions table and make the question counts match it, in the session's current transaction.
+    Return a list of the keys whose counts had drifted, as (category, difficulty, stored count, actual count). On
+    PostgreSQL an exclusive lock is taken first, which waits for concurrent writers (they hold it shared from
+    bump_content_version on) to finish. The content version is bumped if any count was repaired so that cached
+    totals are refreshed.
+    '''
+    connection = session.connection()
+    if connection.dialect.name == 'postgresql':
+        connection.execute(text("SELECT pg_advisory_xact_lock(:id)"), id=QUESTION_STATS_LOCK_ID)
+    actual = Counter()
+    for category, difficulty, count in (session.query(Question.category, Question.difficulty, func.count(Question.id))
+                                        .group_by(Question.category, Question.difficulty)):
+        actual[QuestionStat.key(category, difficulty)] += count
+    stored = { QuestionStat.key(stat.category, stat.difficulty): stat.count for stat in session.query(QuestionStat) }
+
+    drift = []
+    table = QuestionStat.__table__
+    for key in sorted(set(actual) | set(stored)):
+        if actual.get(key, 0) == stored.get(key):
+            continue
+        drift.append((key[0], key[1], stored.get(key), actual.get(key, 0)))
+        where = (table.c.category == (key[0] or None)) & (table.c.difficulty == key[1])
+        if key not in actual:
+            connection.execute(table.delete().where(where))
+        elif key not in stored:
+            connection.execute(table.insert().values(category=key[0] or None, difficulty=key[1], count=actual[key]))
+        else:
+            connection.execute(table.update().where(where).values(count=actual[key]))
+    if drift:
+        bump_content_version(session)
+    return drift
+
+
+def question_stats():
+    '''Return the number of questions overall, per category (with a count per difficulty) and per difficulty. The
+      categories and difficulties are keyed by strings, as in the JSON responses.
+    '''
+    categories = {}
+    difficulties = Counter()
+    for stat in db.session.query(QuestionStat).filter(QuestionStat.count != 0).order_by(QuestionStat.category,
+                                                                                        QuestionStat.difficulty):
+        category = categories.setdefault('' if stat.category is None else str(stat.category),
+                                         { 'total_questions': 0, 'difficulties': {} })
+        category['total_questions'] += stat.count
+        category['difficulties'][str(stat.difficulty)] = stat.count
+        difficulties[stat.difficulty] += stat.count
+    return {
+        'total_questions': sum(difficulties.values()),
+        'categories': categories,
+        'difficulties': { str(difficulty): count for difficulty, count in sorted(difficulties.items()) },
+    }
+
+
+@event.listens_for(Session, 'after_flush')
+def _count_question_changes(session, flush_context):
+    deltas = Counter()
+    for obj in session.new:
+        if isinstance(obj, Question):
+            deltas[QuestionStat.key(obj.category, obj.difficulty)] += 1
+    for obj in session.deleted:
+        if isinstance(obj, Question):
+            deltas[QuestionStat.key(*_committed_values(obj, 'category', 'difficulty'))] -= 1
+    for obj in session.dirty:
+        if isinstance(obj, Question) and session.is_modified(obj):
+            deltas[QuestionStat.key(*_committed_values(obj, 'category', 'difficulty'))] -= 1
+            deltas[QuestionStat.key(obj.category, obj.difficulty)] += 1
+    if any(deltas.values()):
+        adjust_question_stats(session, deltas)
+
+
+def _committed_values(obj, *names):
+    '''The values the attributes of obj had in the database before the flush.'''
+    values = []
+    for name in names:
+        history = attributes.get_history(obj, name)
+        values.append(history.deleted[0] if history.deleted else getattr(obj, name))
+    return values
+
+
+'''
+Question change observers
+    callbacks run after a commit that inserted, updated or deleted questions, so that in-process indexes and caches
+    can follow the questions table. A callback receives an event name ('insert', 'update', 'delete' or 'reset') and
+    a list of formatted questions. 'reset' carries no questions: it means the table changed in bulk (or the database
+    was rebound) and anything derived from it should be rebuilt. Callbacks run after the commit, so they must not
+    use the session.
+'''
+question_observers = []
+# Past this many questions changed by one statement, observers get a 'reset' instead of the questions.
+MAX_NOTIFIED_CHANGES = 100
+
+def observe_questions(callback):
+  question_observers.append(callback)
+  return callback
+
+def notify_question_observers(event_name, records):
+  # The changes are already committed: an observer that fails is logged, and neither fails the request nor keeps
+  # the observers after it from following the change.
+  for callback in question_observers:
+    try:
+      callback(event_name, records)
+    except Exception:
+      logger.exception("Question change observer %r failed on %s", callback, event_name)
+
+
+@event.listens_for(Session, 'after_flush')
+def _track_question_changes(session, flush_context):
+  changes = session.info.setdefault('question_changes', [])
+  changes.extend(('insert', obj.format()) for obj in session.new if isinstance(obj, Question))
+  changes.extend(('update', obj.format()) for obj in session.dirty
+                 if isinstance(obj, Question) and session.is_modified(obj))
+  changes.extend(('delete', obj.format()) for obj in session.deleted if isinstance(obj, Question))
+
+
+@event.listens_for(Session, 'after_commit')
+def _notify_question_changes(session):
+  changes = session.info.pop('question_changes', [])
+  # Consecutive changes of the same kind are handed over together. A 'reset' carries no record.
+  start = 0
+  for end in range(1, len(changes) + 1):
+    if end == len(changes) or changes[end][0] != changes[start][0]:
+      notify_question_observers(changes[start][0],
+                                [record for _, record in changes[start:end] if record is not None])
+      start = end
+
+
+@event.listens_for(Session, 'after_rollback')
+def _discard_question_changes(session):
+  session.info.pop('question_changes', None)
+
+
+@event.listens_for(Session, 'before_flush')
+def _uncategorize_questions(session, flush_context, instances):
+  '''Before categories are deleted, clear the category of their questions and move their question counts to the
+  counts of questions without a category, in the flush's transaction. The foreign key would clear the questions on
+  PostgreSQL, but not the counts (whose rows it deletes), and SQLite does not enforce it by default.
+  '''
+  category_ids = sorted(obj.id for obj in session.deleted if isinstance(obj, Category) and obj.id is not None)
+  if not category_ids:
+    return
+  connection = session.connection()
+  questions = Question.__table__
+  stats = QuestionStat.__table__
+  deltas = Counter()
+  for category, difficulty, count in connection.execute(
+      select([stats.c.category, stats.c.difficulty, stats.c.count]).where(stats.c.category.in_(category_ids))):
+    deltas[QuestionStat.key(category, difficulty)] -= count
+    deltas[QuestionStat.key(None, difficulty)] += count
+  changes = session.info.setdefault('question_changes', [])
+  if sum(count for count in deltas.values() if count > 0) > MAX_NOTIFIED_CHANGES:
+    changes.append(('reset', None))
+  else:
+    rows = connection.execute(select([questions.c[field] for field in Question.format_fields])
+                              .where(questions.c.category.in_(category_ids)).order_by(questions.c.id))
+    changes.extend(('update', dict(Question.format_row(row), category=None)) for row in rows)
+  connection.execute(questions.update().where(questions.c.category.in_(category_ids)).values(category=None))
+  adjust_question_stats(session, deltas)
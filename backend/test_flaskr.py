@@ -1,10 +1,24 @@
+import gc
 import os
+import tempfile
+import threading
 import unittest
 import json
+from datetime import datetime
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import create_engine, event, inspect, text
+from sqlalchemy.orm import Session
 
 from flaskr import create_app
-from models import setup_db, Question, Category
+from flaskr.admission import admission_control
+from flaskr.autocomplete import autocomplete
+from flaskr.duplicates import BANDS, LSHIndex, MIN_MERGE_SIZE, near_duplicates, shingles, signature
+from flaskr.group_commit import group_commit
+from flaskr.quiz import quiz_pool
+from migrations import MIGRATIONS, migrate
+from models import (db, setup_db, init_db, engine_options, reconcile_question_stats, bump_content_version,
+                    content_version_query, _compact_content_changes, category_observers, question_observers, Question,
+                    Category)
 
 
 class TriviaTestCase(unittest.TestCase):
@@ -24,6 +38,7 @@ class TriviaTestCase(unittest.TestCase):
             self.db.init_app(self.app)
             # create all tables
             self.db.create_all()
+            init_db()
 
             q = Question("When is the best time to wear a striped sweater?", "All the time.", 4, 5)
             self.db.session.add(q)
@@ -39,6 +54,8 @@ class TriviaTestCase(unittest.TestCase):
         question_match_B = Question.query.filter(Question.question == "What color is grass?").first()
         if question_match_B:
             question_match_B.delete()
+        for imported_question in Question.query.filter(Question.question.like("Imported question%")).all():
+            imported_question.delete()
 
     """
     TODO
@@ -62,6 +79,30 @@ class TriviaTestCase(unittest.TestCase):
         self.assertEqual(data["message"], "HELLO WORLD")
 
 
+    def test_request_metrics(self):
+        """Test for the Server-Timing header and the Prometheus metrics of a question page"""
+        res = self.client().get('/questions?page=1')
+        self.assertRegex(res.headers.get("Server-Timing"), r'^db;dur=[0-9.]+;desc="[0-9]+ queries, [0-9]+ rows"')
+
+        metrics = self.client().get('/metrics').get_data(as_text=True)
+        self.assertIn('trivia_requests_total{endpoint="questions",method="GET",status="200"}', metrics)
+        self.assertIn('trivia_db_queries_total{endpoint="questions"}', metrics)
+
+
+    def test_request_metrics_after_failed_statement(self):
+        """Test that a statement that fails is not timed and leaves nothing behind for the next one"""
+        from flask import g
+        from flaskr.instrumentation import RequestTiming
+        with self.app.test_request_context('/questions'), db.engine.connect() as connection:
+            g.request_timing = timing = RequestTiming()
+            with self.assertRaises(Exception):
+                connection.execute(text("SELECT * FROM no_such_table"))
+            connection.execute(text("SELECT 1"))
+            self.assertEqual(1, timing.query_count)
+            self.assertEqual(["SELECT 1"], list(timing.statements))
+            self.assertNotIn('query_started', connection.info)
+
+
     def test_get_questions_page_success(self):
         """Test for retrieving a page of questions"""
         res = self.client().get('/questions?page=1')
@@ -93,6 +134,212 @@ class TriviaTestCase(unittest.TestCase):
         self.assertEqual(res.status_code, 422)
 
 
+    def test_get_questions_cursor_success(self):
+        """Test for walking every page of questions with the returned cursors"""
+        res = self.client().get('/questions?page=1')
+        data = json.loads(res.data)
+        seen_ids = [q["id"] for q in data["questions"]]
+
+        self.assertIn("next_cursor", data)
+        while data["next_cursor"] is not None:
+            res = self.client().get(f"/questions?cursor={data['next_cursor']}")
+            self.assertEqual(res.status_code, 200)
+            data = json.loads(res.data)
+            seen_ids.extend(q["id"] for q in data["questions"])
+
+        self.assertEqual(data["total_questions"], len(seen_ids))
+        self.assertEqual(sorted(seen_ids), seen_ids)
+        self.assertEqual(len(set(seen_ids)), len(seen_ids))
+
+
+    def test_get_questions_cursor_failure(self):
+        """Test for retrieving a page of questions with a malformed cursor"""
+        res = self.client().get('/questions?cursor=not-a-cursor')
+        self.assertEqual(res.status_code, 422)
+
+
+    def test_get_questions_stream_success(self):
+        """Test for streaming a large page of questions"""
+        res = self.client().get('/questions?page=1&per_page=15')
+        data = json.loads(res.data)
+
+        res = self.client().get('/questions?page=1&per_page=15&stream=true')
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(res.is_streamed)
+        streamed_data = json.loads(res.get_data(as_text=True))
+
+        self.assertEqual(15, len(streamed_data["questions"]))
+        self.assertEqual(data, streamed_data)
+
+
+    def test_get_questions_stream_failure(self):
+        """Test for requesting a page larger than allowed"""
+        res = self.client().get('/questions?per_page=1000')
+        self.assertEqual(res.status_code, 422)
+
+
+    def test_engine_options(self):
+        """Test for the engine options built from the pool configuration"""
+        options = engine_options({"DB_POOL_SIZE": 2, "DB_STATEMENT_TIMEOUT_MS": 500}, self.database_path)
+        self.assertEqual(2, options["pool_size"])
+        self.assertEqual({"options": "-c statement_timeout=500"}, options["connect_args"])
+
+        pgbouncer_options = engine_options({"DB_PGBOUNCER": True, "DB_STATEMENT_TIMEOUT_MS": 500}, self.database_path)
+        self.assertEqual("NullPool", pgbouncer_options["poolclass"].__name__)
+        self.assertNotIn("connect_args", pgbouncer_options)
+        self.assertEqual({}, engine_options({"DB_POOL_SIZE": 2}, "sqlite://"))
+
+
+    def test_question_rows_match_format(self):
+        """Test that questions read as rows are formatted like Question instances"""
+        with self.app.app_context():
+            expected = [question.format() for question in Question.query.order_by(Question.id).all()]
+            rows = Question.rows().order_by(Question.id).all()
+            self.assertEqual([Question.format_row(row) for row in rows], expected)
+            self.assertEqual(list(expected[0]), list(Question.format_fields))
+
+
+    def test_question_stats(self):
+        """Test that question counts follow writes, back the listing totals and are repaired by reconciliation"""
+        before = json.loads(self.client().get('/stats').data)
+        self.assertEqual(json.loads(self.client().get('/questions').data)["total_questions"], before["total_questions"])
+        self.assertEqual("History", before["categories"]["4"]["type"])
+        self.assertEqual(sum(before["difficulties"].values()), before["total_questions"])
+
+        res = self.client().put('/questions', json={"question": "What color is grass?", "answer": "Green", "category": 4, "difficulty": 1})
+        self.assertEqual(200, res.status_code)
+        after = json.loads(self.client().get('/stats').data)
+        self.assertEqual(before["total_questions"] + 1, after["total_questions"])
+        self.assertEqual(before["categories"]["4"]["total_questions"] + 1, after["categories"]["4"]["total_questions"])
+        self.assertEqual(before["difficulties"].get("1", 0) + 1, after["difficulties"]["1"])
+        self.assertEqual(after["categories"]["4"]["total_questions"],
+                         json.loads(self.client().get('/categories/4/questions').data)["totalQuestions"])
+        self.assertEqual(after["categories"]["4"]["total_questions"],
+                         json.loads(self.client().get('/categories/04/questions').data)["totalQuestions"])
+
+        with self.app.app_context():
+            # A write that bypasses the ORM leaves the counts behind until they are reconciled.
+            db.session.execute(Question.__table__.delete().where(Question.id == json.loads(res.data)["id"]))
+            db.session.commit()
+            count = before["categories"]["4"]["difficulties"].get("1", 0)
+            self.assertEqual([(4, 1, count + 1, count)], reconcile_question_stats(db.session))
+            db.session.commit()
+        self.assertEqual(before, json.loads(self.client().get('/stats').data))
+
+
+    def test_question_stats_after_category_delete(self):
+        """Test that deleting a category moves the counts of its questions to those without a category"""
+        with self.app.app_context():
+            category = Category("Geography")
+            db.session.add(category)
+            db.session.commit()
+            category_id = category.id
+        question_ids = [json.loads(self.client().put('/questions', json={
+            "question": f"Which river is the longest, {number}?", "answer": "The Nile", "category": category_id,
+            "difficulty": difficulty}).data)["id"] for number, difficulty in enumerate([1, 1, 2])]
+        before = json.loads(self.client().get('/stats').data)
+        self.assertEqual(3, before["categories"][str(category_id)]["total_questions"])
+
+        with self.app.app_context():
+            db.session.delete(Category.query.get(category_id))
+            db.session.commit()
+            self.assertEqual([None] * 3, [question.category for question in Question.query.filter(
+                Question.id.in_(question_ids)).order_by(Question.id)])
+            self.assertEqual([], reconcile_question_stats(db.session))
+            db.session.rollback()
+        after = json.loads(self.client().get('/stats').data)
+        self.assertNotIn(str(category_id), after["categories"])
+        self.assertEqual(before["total_questions"], after["total_questions"])
+        self.assertEqual(before["difficulties"], after["difficulties"])
+
+        self.client().delete('/questions', json={"ids": question_ids})
+        with self.app.app_context():
+            self.assertEqual([], reconcile_question_stats(db.session))
+
+
+    def test_migrate_legacy_category_column(self):
+        """Test that migrating turns string categories into integer foreign keys and adds the category indexes"""
+        engine = create_engine(self.database_path, connect_args={"options": "-c search_path=legacy_trivia"})
+        engine.execute("DROP SCHEMA IF EXISTS legacy_trivia CASCADE; CREATE SCHEMA legacy_trivia")
+        try:
+            engine.execute("CREATE TABLE categories (id serial PRIMARY KEY, type varchar)")
+            engine.execute("CREATE TABLE questions (id serial PRIMARY KEY, question varchar, answer varchar, "
+                           "category varchar, difficulty integer)")
+            engine.execute("INSERT INTO categories (type) VALUES ('Science'), ('Art')")
+            engine.execute("INSERT INTO questions (question, answer, category, difficulty) VALUES "
+                           "('A', 'a', '2', 1), ('B', 'b', 'science', 2), ('C', 'c', 'Poetry', 3), ('D', 'd', '9', 4)")
+            # question_stats as an older model created it, keyed by category strings.
+            engine.execute("CREATE TABLE question_stats (id serial PRIMARY KEY, category varchar, "
+                           "difficulty integer NOT NULL, count integer NOT NULL, UNIQUE (category, difficulty))")
+            engine.execute("INSERT INTO question_stats (category, difficulty, count) VALUES ('2', 1, 1)")
+
+            self.assertEqual([migration_id for migration_id, _ in MIGRATIONS], migrate(engine))
+            self.assertEqual([], migrate(engine))
+
+            inspector = inspect(engine)
+            self.assertEqual("INTEGER", str(next(column["type"] for column in inspector.get_columns("questions")
+                                                 if column["name"] == "category")))
+            self.assertEqual([["category"]], [foreign_key["constrained_columns"] for foreign_key in inspector.get_foreign_keys("questions")])
+            self.assertTrue({"questions_category_id_idx", "questions_category_difficulty_idx"} <=
+                            {index["name"] for index in inspector.get_indexes("questions")})
+            self.assertEqual([("A", 2), ("B", 1), ("C", None), ("D", None)],
+                             engine.execute("SELECT question, category FROM questions ORDER BY question").fetchall())
+            self.assertEqual([(1, 2, 1), (2, 1, 1), (None, 3, 1), (None, 4, 1)],
+                             engine.execute("SELECT category, difficulty, count FROM question_stats "
+                                            "ORDER BY category, difficulty").fetchall())
+        finally:
+            engine.execute("DROP SCHEMA legacy_trivia CASCADE")
+            engine.dispose()
+
+
+    def test_get_questions_not_modified(self):
+        """Test for conditional requests of a question page, before and after a change"""
+        res = self.client().get('/questions?page=1')
+        etag = res.headers.get("ETag")
+        self.assertIsNotNone(etag)
+        self.assertEqual(res.headers.get("Cache-Control"), "no-cache")
+
+        res_cached = self.client().get('/questions?page=1', headers={"If-None-Match": etag})
+        self.assertEqual(res_cached.status_code, 304)
+        self.assertEqual(res_cached.data, b"")
+
+        self.client().delete(f"/questions/{self.valid_delete_id}")
+        res_changed = self.client().get('/questions?page=1', headers={"If-None-Match": etag})
+        self.assertEqual(res_changed.status_code, 200)
+        self.assertNotEqual(res_changed.headers.get("ETag"), etag)
+
+
+    def test_content_version_concurrent_writers(self):
+        """Test that writers bump the content version without waiting for each other, and that compaction keeps it"""
+        with self.app.app_context():
+            engine = db.get_engine(self.app)
+            before, _, _ = engine.execute(content_version_query()).first()
+            first, second = Session(bind=engine.connect()), Session(bind=engine.connect())
+            try:
+                # Writers of different categories share no row; the content version no longer is one.
+                for category, session in ((1, first), (2, second)):
+                    session.execute(text("SET lock_timeout = '2s'"))
+                    session.add(Question("Concurrent writer question?", "Yes", category, 1))
+                    session.flush()
+                first.commit()
+                second.commit()
+                self.assertEqual(before + 2, engine.execute(content_version_query()).first()[0])
+
+                bump_content_version(first)
+                _compact_content_changes(first.connection(), 2 ** 62, datetime.utcnow())
+                first.commit()
+                version, updated_at, changed_at = engine.execute(content_version_query()).first()
+                self.assertEqual((before + 3, None), (version, changed_at))
+                for question in first.query(Question).filter(Question.question == "Concurrent writer question?"):
+                    first.delete(question)
+                first.commit()
+                self.assertEqual([], reconcile_question_stats(first))
+            finally:
+                first.rollback()
+                first.close()
+                second.close()
+
+
     def test_delete_question_success(self):
         """Test for deleting existent question by ID"""
         resBeforeDelete = self.client().get('/questions')
@@ -118,6 +365,104 @@ class TriviaTestCase(unittest.TestCase):
         self.assertEqual(res_delete.status_code, 404)
 
 
+    def test_bulk_update_and_delete_questions(self):
+        """Test for updating and deleting questions selected by ids or by filter, with the counts following"""
+        ids = [json.loads(self.client().put('/questions', json={"question": f"Bulk question {number}?", "answer": "Bulk",
+            "category": 6, "difficulty": 1 + number % 2, "allow_duplicates": True}).data)["id"] for number in range(4)]
+        before = json.loads(self.client().get('/stats').data)["categories"]["6"]
+
+        res = self.client().patch('/questions', json={"ids": ids[:2] + [1000000], "set": {"difficulty": 5}})
+        self.assertEqual({"success": True, "updated": 2}, json.loads(res.data))
+        self.assertEqual(5, Question.query.get(ids[0]).difficulty)
+        after = json.loads(self.client().get('/stats').data)["categories"]["6"]
+        self.assertEqual(before["difficulties"].get("5", 0) + 2, after["difficulties"]["5"])
+        self.assertEqual(before["total_questions"], after["total_questions"])
+
+        self.assertEqual(400, self.client().delete('/questions', json={}).status_code)
+        self.assertEqual(400, self.client().delete('/questions', json={"ids": ids, "category": 6}).status_code)
+        self.assertEqual(400, self.client().patch('/questions', json={"ids": ids, "set": {"answer": "No"}}).status_code)
+        self.assertEqual(422, self.client().patch('/questions', json={"ids": ids, "set": {"category": 1000000}}).status_code)
+
+        res = self.client().delete('/questions', json={"category": 6, "difficulty": 5})
+        self.assertEqual({"success": True, "deleted": 2}, json.loads(res.data))
+        res = self.client().delete('/questions', json={"ids": ids})
+        self.assertEqual({"success": True, "deleted": 2}, json.loads(res.data))
+        self.assertEqual(before["total_questions"] - 4, json.loads(self.client().get('/stats').data)["categories"]["6"]["total_questions"])
+        with self.app.app_context():
+            self.assertEqual([], reconcile_question_stats(db.session))
+            db.session.rollback()
+
+
+    def test_group_commit_concurrent_inserts(self):
+        """Test that concurrent question inserts share transactions and each get their own id or error"""
+        app = create_app({"SQLALCHEMY_DATABASE_URI": self.database_path, "GROUP_COMMIT": True})
+        commits, writes = group_commit.commits, group_commit.writes
+        results = {}
+
+        def create(number):
+            res = app.test_client().put('/questions', json={"question": f"Grouped question {number}?", "answer": "Grouped",
+                "category": 1000000 if number == 3 else 6, "difficulty": 1, "allow_duplicates": True})
+            results[number] = (res.status_code, json.loads(res.data).get("id"))
+
+        threads = [threading.Thread(target=create, args=(number,)) for number in range(20)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(400, results.pop(3)[0])
+        self.assertEqual({200}, { status for status, _ in results.values() })
+        ids = [question_id for _, question_id in results.values()]
+        self.assertEqual(19, len(set(ids)))
+        self.assertEqual(19, group_commit.writes - writes)
+        self.assertLessEqual(group_commit.commits - commits, 20)
+        res = self.client().delete('/questions', json={"ids": ids})
+        self.assertEqual({"success": True, "deleted": 19}, json.loads(res.data))
+
+
+    def test_admission_control(self):
+        """Test that clients over the rate limit get a 429 and requests over a full concurrency limit a 503"""
+        app = create_app({"SQLALCHEMY_DATABASE_URI": self.database_path, "RATE_LIMIT": 0.01, "RATE_LIMIT_BURST": 2})
+        client = app.test_client()
+        self.assertEqual(200, client.get('/categories').status_code)
+        self.assertEqual(200, client.get('/categories').status_code)
+        res = client.get('/categories')
+        self.assertEqual(429, res.status_code)
+        self.assertEqual("100", res.headers["Retry-After"])
+        self.assertEqual(429, json.loads(res.data)["error"])
+        self.assertEqual(200, client.get('/metrics').status_code)
+
+        app = create_app({"SQLALCHEMY_DATABASE_URI": self.database_path,
+            "ADMISSION_CONCURRENCY": {"retrieve_quiz_question": 1}, "ADMISSION_QUEUE_DEPTH": 0})
+        client = app.test_client()
+        quiz_info = {"quiz_category": {"id": 4}, "previous_questions": []}
+        self.assertEqual(200, client.post('/quizzes', json=quiz_info).status_code)
+        self.assertIsNone(admission_control.limits["retrieve_quiz_question"].acquire())
+        try:
+            res = client.post('/quizzes', json=quiz_info)
+        finally:
+            admission_control.release("retrieve_quiz_question")
+        self.assertEqual(503, res.status_code)
+        self.assertIn("Retry-After", res.headers)
+        self.assertEqual(200, client.post('/quizzes', json=quiz_info).status_code)
+        metrics = client.get('/metrics').data.decode()
+        self.assertIn('trivia_admission_rejected_total{endpoint="retrieve_quiz_question",reason="queue_full"} 1', metrics)
+
+
+    def test_preload(self):
+        """Test that PRELOAD fills the caches, closes the pooled connections and freezes the collector"""
+        try:
+            app = create_app({"SQLALCHEMY_DATABASE_URI": self.database_path, "PRELOAD": True})
+            self.assertGreater(gc.get_freeze_count(), 0)
+        finally:
+            gc.unfreeze()
+        self.assertFalse(quiz_pool.stale())
+        self.assertIsNotNone(autocomplete.index)
+        self.assertEqual(0, db.get_engine(app).pool.checkedin())
+        res = app.test_client().post('/quizzes', json={"quiz_category": {"id": 4}, "previous_questions": []})
+        self.assertEqual(200, res.status_code)
+
+
     def test_retrieve_category_map_success(self):
         """Test for retrieving map of categories"""
         res = self.client().get('/categories')
@@ -169,6 +514,130 @@ class TriviaTestCase(unittest.TestCase):
         self.assertEqual(400, res.status_code)
 
 
+    def test_near_duplicate_questions(self):
+        """Test for flagging and rejecting questions that nearly duplicate a stored one"""
+        question_info = {
+            "question": 'Which dung beetle was worshipped by ancient Egyptians?',
+            "answer": 'Scarab',
+            "category": 4,
+            "difficulty": 4,
+        }
+        flag_client = create_app({"SQLALCHEMY_DATABASE_URI": self.database_path, "DUPLICATE_POLICY": "flag"}).test_client
+        self.assertIsNotNone(near_duplicates.index)
+        res = flag_client().put('/questions', json=question_info)
+        self.assertEqual(200, res.status_code)
+        data = json.loads(res.data)
+        self.assertEqual([23], [duplicate["id"] for duplicate in data["duplicates"]])
+        self.assertGreaterEqual(data["duplicates"][0]["similarity"], 0.8)
+        self.client().delete(f'/questions/{data["id"]}')
+
+        reject_client = create_app({"SQLALCHEMY_DATABASE_URI": self.database_path, "DUPLICATE_POLICY": "reject"}).test_client
+        res = reject_client().put('/questions', json=question_info)
+        self.assertEqual(422, res.status_code)
+        res = reject_client().put('/questions', json=dict(question_info, allow_duplicates=True))
+        self.assertEqual(200, res.status_code)
+        self.client().delete(f'/questions/{json.loads(res.data)["id"]}')
+
+        res = reject_client().put('/questions', json=dict(question_info, question='Which beetle was sacred in Egypt?'))
+        self.assertEqual(200, res.status_code)
+        data = json.loads(res.data)
+        self.assertEqual([], data["duplicates"])
+        self.client().delete(f'/questions/{data["id"]}')
+
+
+    def test_import_near_duplicates(self):
+        """Test that rows that fail to be imported are not reported as near-duplicates of later rows"""
+        client = create_app({"SQLALCHEMY_DATABASE_URI": self.database_path, "DUPLICATE_POLICY": "flag"}).test_client
+        row = { "question": "Which planet of the solar system has the most moons?", "answer": "Saturn", "difficulty": 1 }
+        rows = [dict(row, category=1000000), dict(row, category=1), dict(row, category=1)]
+        body = "\n".join(json.dumps(row) for row in rows) + "\n"
+        res = client().post('/questions/import?batch_size=1', data=body, headers={'Content-Type': 'application/x-ndjson'})
+        data = json.loads(res.data)
+        self.assertEqual(2, data["inserted"])
+        self.assertEqual([1], [error["line"] for error in data["errors"]])
+        self.assertEqual([{ "line": 3, "questions": [], "lines": [2] }], data["duplicates"])
+        ids = [q.id for q in Question.query.filter(Question.question == row["question"])]
+        client().delete('/questions', json={"ids": ids})
+
+
+    def test_lsh_index_removal(self):
+        """Test that removed questions are no longer candidates, before and after the index is compacted"""
+        index = LSHIndex()
+        first, second = signature(shingles("Who painted the Mona Lisa?", "Leonardo")), signature(shingles("Who?", "Me"))
+        index.load(LSHIndex.entries_for(1, first) + LSHIndex.entries_for(2, first) + LSHIndex.entries_for(3, second))
+        index.add(4, first)
+        index.remove(1, first)
+        index.remove(4, first)
+        self.assertEqual({2}, index.candidates(first))
+        self.assertEqual(24, len(index.entries))
+        index.add(1, first)
+        self.assertEqual({1, 2}, index.candidates(first))
+
+        for question_id in range(5, 5 + MIN_MERGE_SIZE):
+            index.add(question_id, second)
+        for question_id in range(5, 5 + MIN_MERGE_SIZE):
+            index.remove(question_id, second)
+        self.assertEqual({3}, index.candidates(second))
+        self.assertLess(len(index.entries), BANDS * MIN_MERGE_SIZE)
+        self.assertIn([1, 2], list(index.buckets()))
+        self.assertEqual((set(), 24), (index.removed, len(index.entries)))
+
+
+    def test_import_questions_success(self):
+        """Test for importing NDJSON questions and reporting rejected rows"""
+        rows = [
+            { "question": "Imported question one?", "answer": "One", "category": 1, "difficulty": 1 },
+            { "question": "Imported question two?", "answer": "Two", "category": 2 },
+            { "question": "Imported question three?", "answer": "Three", "category": 3, "difficulty": 3 },
+        ]
+        body = "\n".join(json.dumps(row) for row in rows) + "\n"
+        res = self.client().post('/questions/import?batch_size=1', data=body, headers={'Content-Type': 'application/x-ndjson'})
+        self.assertEqual(200, res.status_code)
+        data = json.loads(res.data)
+        self.assertFalse(data["success"])
+        self.assertEqual(2, data["inserted"])
+        self.assertEqual(1, data["error_count"])
+        self.assertEqual(2, data["errors"][0]["line"])
+
+        imported = Question.query.filter(Question.question.like("Imported question%")).all()
+        self.assertEqual(["One", "Three"], sorted(q.answer for q in imported))
+
+
+    def test_import_questions_invalid_utf8(self):
+        """Test that lines that are not valid UTF-8 are reported like other invalid lines"""
+        body = ("question,answer,category,difficulty\n"
+                "Undecodable question one?,One,1,1\n").encode() + b"Undecodable \xff question?,Two,2,2\n" + \
+            "Undecodable question three?,Three,3,3\n".encode()
+        res = self.client().post('/questions/import', data=body, headers={'Content-Type': 'text/csv'})
+        self.assertEqual(200, res.status_code)
+        data = json.loads(res.data)
+        self.assertEqual(2, data["inserted"])
+        self.assertEqual([{"line": 3, "message": "The line is not valid UTF-8."}], data["errors"])
+
+        body = b'{"question": "Undecodable \xff?", "answer": "Four", "category": 4, "difficulty": 4}\n'
+        res = self.client().post('/questions/import', data=body, headers={'Content-Type': 'application/x-ndjson'})
+        self.assertEqual([{"line": 1, "message": "The line is not valid UTF-8."}], json.loads(res.data)["errors"])
+        ids = [q.id for q in Question.query.filter(Question.question.like("Undecodable question%"))]
+        res = self.client().delete('/questions', json={"ids": ids})
+        self.assertEqual({"success": True, "deleted": 2}, json.loads(res.data))
+
+
+    def test_import_questions_failure(self):
+        """Test for importing questions in an unsupported format"""
+        res = self.client().post('/questions/import', data="question", headers={'Content-Type': 'text/plain'})
+        self.assertEqual(400, res.status_code)
+
+
+    def test_export_questions_success(self):
+        """Test for exporting every question as CSV"""
+        res = self.client().get('/questions/export?format=csv')
+        self.assertEqual(200, res.status_code)
+        lines = res.get_data(as_text=True).splitlines()
+
+        self.assertEqual("id,question,answer,category,difficulty", lines[0])
+        self.assertEqual(Question.query.count(), len(lines) - 1)
+
+
     def test_retrieve_category_questions_success(self):
         """Test for successful retrieval of category questions"""
         res = self.client().get('/categories/4/questions')
@@ -193,12 +662,279 @@ class TriviaTestCase(unittest.TestCase):
         self.assertEqual(5, added_question[0]["difficulty"])
 
 
+    def test_read_replica_routing(self):
+        """Test that read-only endpoints read from a healthy replica while writes go to the primary"""
+        replica_path = os.path.join(tempfile.gettempdir(), "trivia_test_replica.sqlite")
+        if os.path.exists(replica_path):
+            os.remove(replica_path)
+        app = create_app({
+            "SQLALCHEMY_DATABASE_URI": self.database_path,
+            "SQLALCHEMY_REPLICA_URIS": [f"sqlite:///{replica_path}", "postgresql://nobody@localhost:1/unavailable"],
+            "RESPONSE_CACHE": "none",
+        })
+        replica = app.extensions["replicas"].engines[0]
+        db.metadata.create_all(replica)
+        replica.execute(Category.__table__.insert(), id=4, type="History")
+        replica.execute(Question.__table__.insert(), question="Replica question?", answer="Yes", category=4, difficulty=1)
+        replica.execute("INSERT INTO content_versions (name, version, updated_at) VALUES ('trivia', 1, ?)", datetime.utcnow())
+
+        client = app.test_client()
+        for _ in range(2):
+            data = json.loads(client.get('/categories/4/questions').data)
+            self.assertEqual(["Replica question?"], [q["question"] for q in data["questions"]])
+
+        res = client.put('/questions', json={"question": "What color is grass?", "answer": "Green", "category": 4, "difficulty": 1})
+        self.assertEqual(200, res.status_code)
+        with app.app_context():
+            self.assertIsNotNone(Question.query.get(json.loads(res.data)["id"]))
+
+
+    def test_read_replica_per_request(self):
+        """Test that every statement of a read-only request goes to the same replica"""
+        replica_paths = [os.path.join(tempfile.gettempdir(), f"trivia_test_replica_{name}.sqlite") for name in "ab"]
+        for replica_path in replica_paths:
+            if os.path.exists(replica_path):
+                os.remove(replica_path)
+        app = create_app({
+            "SQLALCHEMY_DATABASE_URI": self.database_path,
+            "SQLALCHEMY_REPLICA_URIS": [f"sqlite:///{replica_path}" for replica_path in replica_paths],
+            "RESPONSE_CACHE": "none",
+        })
+        statements = []
+        for replica in app.extensions["replicas"].engines:
+            db.metadata.create_all(replica)
+            replica.execute(Category.__table__.insert(), id=4, type="History")
+            replica.execute(Question.__table__.insert(), question="Replica question?", answer="Yes", category=4, difficulty=1)
+            replica.execute("INSERT INTO content_versions (name, version, updated_at) VALUES ('trivia', 1, ?)", datetime.utcnow())
+            event.listen(replica, "before_cursor_execute",
+                         lambda conn, cursor, statement, *args: statements.append((conn.engine, statement)))
+
+        client = app.test_client()
+        engines = []
+        for _ in range(4):
+            statements.clear()
+            self.assertEqual(200, client.get('/categories/4/questions').status_code)
+            used = { engine for engine, statement in statements if statement != "SELECT 1" }
+            self.assertEqual(1, len(used))
+            engines.append(used.pop())
+        self.assertEqual(2, len(set(engines)))
+
+
+    def test_asgi_app_matches_flask_app(self):
+        """Test that the async entry point answers reads with the same responses as the Flask app"""
+        try:
+            from starlette.testclient import TestClient
+            from flaskr.asgi import create_asgi_app
+        except ImportError as ex:
+            self.skipTest(f"The async entry point needs {ex.name}.")
+        asgi_app = create_asgi_app({"SQLALCHEMY_DATABASE_URI": self.database_path, "RESPONSE_CACHE": "none"})
+        flask_client = asgi_app.state.flask_app.test_client()
+        with TestClient(asgi_app) as client:
+            for method, path, body in [("GET", "/categories", None), ("GET", "/questions?page=2", None),
+                                       ("GET", "/categories/4/questions", None), ("GET", "/categories/8/questions", None),
+                                       ("POST", "/questions", {"searchTerm": "title"}), ("POST", "/questions", {"page": 1}),
+                                       ("POST", "/quizzes", {})]:
+                res = client.request(method, path, json=body)
+                expected = flask_client.open(path, method=method, json=body)
+                self.assertEqual((expected.status_code, expected.data), (res.status_code, res.content))
+
+            data = client.post('/quizzes', json={"quiz_category": {"id": 4}, "previous_questions": []}).json()
+            self.assertEqual(4, data["question"]["category"])
+            res = client.put('/questions', json={"question": "What color is grass?", "answer": "Green", "category": 4, "difficulty": 1})
+            self.assertEqual(200, res.status_code)
+
+
+    def test_asgi_app_quiz_pool(self):
+        """Test that the async quiz endpoints reload the quiz pool through asyncpg and pick questions like the Flask app"""
+        try:
+            from starlette.testclient import TestClient
+            from flaskr.asgi import create_asgi_app
+        except ImportError as ex:
+            self.skipTest(f"The async entry point needs {ex.name}.")
+        # With a TTL of 0 the pool is stale again right after every load.
+        self.addCleanup(setattr, quiz_pool, "ttl", quiz_pool.ttl)
+        asgi_app = create_asgi_app({"SQLALCHEMY_DATABASE_URI": self.database_path, "QUIZ_POOL_TTL": 0})
+        flask_app = asgi_app.state.flask_app
+        with flask_app.app_context():
+            category_ids = [question_id for question_id, in db.session.query(Question.id).filter(Question.category == 4)]
+            engine = db.get_engine(flask_app)
+        statements = []
+        record = lambda *args: statements.append(args[2])
+        quiz_info = { "quiz_category": { "id": 4 }, "previous_questions": category_ids[1:], "count": 3,
+                      "difficulty": [1, 2, 3, 4, 5] }
+        event.listen(engine, "before_cursor_execute", record)
+        try:
+            with TestClient(asgi_app) as client:
+                data = client.post('/quizzes', json=quiz_info).json()
+                self.assertEqual(200, client.post('/quizzes/sessions', json={ "quiz_category": { "id": 4 } }).status_code)
+        finally:
+            event.remove(engine, "before_cursor_execute", record)
+        self.assertEqual([], statements)
+        self.assertEqual([category_ids[0]], [question["id"] for question in data["questions"]])
+        self.assertEqual(data, json.loads(flask_app.test_client().post('/quizzes', json=quiz_info).data))
+
+
+    def test_asgi_app_http_caching(self):
+        """Test that the async entry point sends the Flask app's validators, answers 304 and shares its cached responses"""
+        try:
+            from starlette.testclient import TestClient
+            from flaskr.asgi import create_asgi_app
+        except ImportError as ex:
+            self.skipTest(f"The async entry point needs {ex.name}.")
+        from flaskr.response_cache import response_cache
+        asgi_app = create_asgi_app({"SQLALCHEMY_DATABASE_URI": self.database_path, "RESPONSE_CACHE": "memory"})
+        flask_client = asgi_app.state.flask_app.test_client()
+        with TestClient(asgi_app) as client:
+            for path in ["/categories", "/questions", "/categories/4/questions"]:
+                expected = flask_client.get(path)
+                res = client.get(path)
+                self.assertEqual(expected.data, res.content)
+                for header in ["ETag", "Last-Modified", "Cache-Control"]:
+                    self.assertEqual(expected.headers[header], res.headers[header])
+                self.assertEqual(304, client.get(path, headers={"If-None-Match": res.headers["ETag"]}).status_code)
+                self.assertEqual(304, client.get(path, headers={"If-Modified-Since": res.headers["Last-Modified"]}).status_code)
+            self.assertEqual(200, client.post('/questions', json={"searchTerm": "title"}).status_code)
+            self.assertEqual(200, client.post('/questions', json={"searchTerm": "Title"}).status_code)
+
+            endpoints = response_cache.stats()["endpoints"]
+            self.assertEqual({"hits": 1, "misses": 1, "hit_ratio": 0.5}, endpoints["questions"])
+            self.assertEqual({"hits": 1, "misses": 1, "hit_ratio": 0.5}, endpoints["retrieve_category_questions"])
+            self.assertEqual({"hits": 1, "misses": 1, "hit_ratio": 0.5}, endpoints["retrieve_question_search"])
+
+            etag = client.get("/questions").headers["ETag"]
+            res = client.put('/questions', json={"question": "What color is grass?", "answer": "Green", "category": 4, "difficulty": 1})
+            self.assertEqual(200, res.status_code)
+            res = client.get("/questions", headers={"If-None-Match": etag})
+            self.assertEqual(200, res.status_code)
+            self.assertNotEqual(etag, res.headers["ETag"])
+
+
+    def test_benchmark_drivers(self):
+        """Test that every benchmark driver gets through a scenario without errors"""
+        from benchmarks.drivers import DRIVERS
+        from benchmarks.run import main
+        driver_names = sorted(DRIVERS)
+        try:
+            import asyncpg, starlette, uvicorn  # noqa: F401
+        except ImportError:
+            driver_names.remove("asgi")
+        with self.app.app_context():
+            rows = Question.query.count()
+        with tempfile.TemporaryDirectory() as directory:
+            # The async entry point needs PostgreSQL. With as many rows as the test database holds, that database is
+            # not reseeded, and the scenario only reads.
+            databases = { "asgi": (self.database_path, rows) }
+            sqlite_database = (f"sqlite:///{os.path.join(directory, 'benchmark.db')}", 20)
+            try:
+                for driver_name in driver_names:
+                    database, count = databases.get(driver_name, sqlite_database)
+                    output = os.path.join(directory, f"{driver_name}.json")
+                    self.assertEqual(0, main(["--database", database, "--rows", str(count), "--driver", driver_name,
+                                              "--scenario", "get_questions_first_page", "--requests", "2",
+                                              "--warmup", "1", "--output", output]))
+                    with open(output, encoding="utf-8") as report:
+                        result = json.load(report)["results"][driver_name]["get_questions_first_page"]
+                    self.assertEqual(0, result["errors"], driver_name)
+            finally:
+                # The benchmark app rebound the models to its own database.
+                setup_db(self.app, self.database_path)
+
+
+    def test_json_backends_match_jsonify(self):
+        """Test that every JSON backend writes the same bytes as Flask's jsonify"""
+        import flask
+        from flaskr.json_backend import OrjsonJSONBackend, StdlibJSONBackend, jsonify
+        backends = [StdlibJSONBackend()]
+        try:
+            backends.append(OrjsonJSONBackend())
+        except ImportError:
+            pass
+        payloads = [
+            {"questions": [q.format() for q in Question.query.all()], "total_questions": 19},
+            {"ratio": 0.00001, "big": 1e16, "half": 0.5, "huge": 2 ** 70, "nested": [{"b": None, "a": True}]},
+            {"text": "café   \x7f \x00 \n \"quoted\" </script>", "when": datetime(2019, 6, 1, 12, 30)},
+            {3: "three", 10: "ten"},
+        ]
+        with self.app.app_context():
+            for payload in payloads:
+                expected = flask.jsonify(payload).get_data()
+                self.assertEqual(expected, jsonify(payload).get_data())
+                for backend in backends:
+                    self.assertEqual(expected, backend.dumps(payload) + b'\n', backend.name)
+
+
+    def test_orjson_backend_encodes_responses_itself(self):
+        """Test that the orjson backend does not hand the API's responses over to the json module"""
+        from unittest import mock
+        from flaskr.json_backend import OrjsonJSONBackend, StdlibJSONBackend
+        try:
+            backend = OrjsonJSONBackend()
+        except ImportError:
+            self.skipTest("orjson is not installed")
+        self.app.extensions["json_backend"] = recorder = mock.Mock(wraps=backend)
+        for path in ['/categories', '/questions', '/categories/4/questions', '/stats']:
+            self.assertEqual(200, self.client().get(path).status_code)
+        payloads = [call.args[0] for call in recorder.dumps.call_args_list]
+        self.assertEqual(4, len(payloads))
+        payloads.append({"question": "Which film of 1990. was directed by Tim Burton?", "year": 1990.5, "tiny": 0.0001})
+        with self.app.app_context(), mock.patch.object(StdlibJSONBackend, "dumps", side_effect=AssertionError):
+            for payload in payloads:
+                backend.dumps(payload)
+
+
     def test_retrieve_category_questions_failure(self):
         """Test for failing to retrieve category questions"""
         res = self.client().get('/categories/8/questions')
         self.assertEqual(404, res.status_code)
 
 
+    def test_category_questions_cache_invalidation(self):
+        """Test that cached category pages are served until a question of the category changes"""
+        first = json.loads(self.client().get('/categories/4/questions').data)
+        self.client().get('/categories/4/questions')
+        self.client().get('/categories/5/questions')
+        self.client().get('/categories/5/questions')
+
+        self.client().put('/questions', json={
+            "question": "What color is grass?", "answer": "Green", "category": 4, "difficulty": 1})
+        self.assertEqual(first["totalQuestions"] + 1,
+                         json.loads(self.client().get('/categories/4/questions').data)["totalQuestions"])
+        self.client().get('/categories/5/questions')
+
+        metrics = json.loads(self.client().get('/metrics/cache').data)["responses"]["endpoints"]
+        self.assertEqual({ "hits": 3, "misses": 3, "hit_ratio": 0.5 }, metrics["retrieve_category_questions"])
+
+
+    def test_category_change_cache_invalidation(self):
+        """Test that cached pages naming a category are dropped when the category is renamed or deleted"""
+        with self.app.app_context():
+            category = Category("Geography")
+            db.session.add(category)
+            db.session.commit()
+            category_id = str(category.id)
+        res = self.client().put('/questions', json={
+            "question": "What is the capital of Peru?", "answer": "Lima", "category": category_id, "difficulty": 1})
+        question_id = json.loads(res.data)["id"]
+        for _ in range(2):
+            self.assertEqual("Geography", json.loads(self.client().get('/questions').data)["categories"][category_id])
+            self.assertEqual("Geography", json.loads(
+                self.client().get(f'/categories/{category_id}/questions').data)["currentCategory"])
+
+        with self.app.app_context():
+            Category.query.get(int(category_id)).type = "Maps"
+            db.session.commit()
+        self.assertEqual("Maps", json.loads(self.client().get('/questions').data)["categories"][category_id])
+        self.assertEqual("Maps", json.loads(
+            self.client().get(f'/categories/{category_id}/questions').data)["currentCategory"])
+
+        self.client().delete(f'/questions/{question_id}')
+        with self.app.app_context():
+            db.session.delete(Category.query.get(int(category_id)))
+            db.session.commit()
+        self.assertNotIn(category_id, json.loads(self.client().get('/questions').data)["categories"])
+        self.assertEqual(404, self.client().get(f'/categories/{category_id}/questions').status_code)
+
+
     def test_retrieve_question_search_success(self):
         """Test for successful search of term 'title'"""
         search_info = { "page": 1, "searchTerm": 'title' }
@@ -209,20 +945,26 @@ class TriviaTestCase(unittest.TestCase):
         self.assertTrue("totalQuestions" in data)
         self.assertTrue("questions" in data)
 
-        self.assertEqual(2, data["totalQuestions"])
-        self.assertEqual(2, len(data["questions"]))
-
-        data["questions"].sort(key = lambda q: q["question"])
+        # Search matches whole words, so "entitled" no longer matches "title".
+        self.assertEqual(1, data["totalQuestions"])
+        self.assertEqual(1, len(data["questions"]))
 
         self.assertEqual("What was the title of the 1990 fantasy directed by Tim Burton about a young man with multi-bladed appendages?", data["questions"][0]["question"])
         self.assertEqual("Edward Scissorhands", data["questions"][0]["answer"])
         self.assertEqual(5, data["questions"][0]["category"])
         self.assertEqual(3, data["questions"][0]["difficulty"])
 
-        self.assertEqual("Whose autobiography is entitled 'I Know Why the Caged Bird Sings'?", data["questions"][1]["question"])
-        self.assertEqual("Maya Angelou", data["questions"][1]["answer"])
-        self.assertEqual(4, data["questions"][1]["category"])
-        self.assertEqual(2, data["questions"][1]["difficulty"])
+
+    def test_retrieve_question_search_answer_success(self):
+        """Test for successful case-insensitive search matching answer text"""
+        search_info = { "searchTerm": 'MAYA angelou' }
+        res = self.client().post('/questions', data=json.dumps(search_info), headers={'Content-Type': 'application/json' })
+        self.assertEqual(200, res.status_code)
+
+        data = json.loads(res.data)
+        self.assertEqual(1, data["totalQuestions"])
+        self.assertEqual("Whose autobiography is entitled 'I Know Why the Caged Bird Sings'?", data["questions"][0]["question"])
+        self.assertEqual("Maya Angelou", data["questions"][0]["answer"])
 
 
     def test_retrieve_question_search_failure(self):
@@ -232,6 +974,129 @@ class TriviaTestCase(unittest.TestCase):
         self.assertEqual(404, res.status_code)
 
 
+    def test_autocomplete_questions(self):
+        """Test for suggesting questions from an unfinished term, following added and deleted questions"""
+        res = self.client().get('/questions/autocomplete?term=who%20dis')
+        self.assertEqual(200, res.status_code)
+        self.assertEqual(["Who discovered penicillin?"], [s["question"] for s in json.loads(res.data)["suggestions"]])
+
+        res = self.client().put('/questions', data=json.dumps({"question": "Who discussed the autocomplete index?",
+            "answer": "Nobody", "category": 1, "difficulty": 1}), headers={'Content-Type': 'application/json'})
+        new_id = json.loads(res.data)["id"]
+        res = self.client().get('/questions/autocomplete?term=who%20dis&limit=1')
+        self.assertEqual(["Who discovered penicillin?"], [s["question"] for s in json.loads(res.data)["suggestions"]])
+        res = self.client().get('/questions/autocomplete?term=autocom')
+        self.assertEqual([new_id], [s["id"] for s in json.loads(res.data)["suggestions"]])
+
+        self.client().delete(f'/questions/{new_id}')
+        res = self.client().get('/questions/autocomplete?term=autocom')
+        self.assertEqual([], json.loads(res.data)["suggestions"])
+
+        res = self.client().get('/questions/autocomplete?term=who&limit=0')
+        self.assertEqual(400, res.status_code)
+
+
+    def test_autocomplete_category_types(self):
+        """Test that the index takes a category sent as a string and questions whose category was deleted"""
+        self.client().get('/questions/autocomplete?term=who')
+        res = self.client().put('/questions', json={"question": "Which stringly category is this?", "answer": "Three",
+                                                    "category": "3", "difficulty": 1})
+        self.assertEqual(200, res.status_code)
+        question_id = json.loads(res.data)["id"]
+        res = self.client().get('/questions/autocomplete?term=stringly')
+        self.assertEqual([{"id": question_id, "question": "Which stringly category is this?", "category": 3}],
+                         json.loads(res.data)["suggestions"])
+
+        with self.app.app_context():
+            category = Category("Geography")
+            db.session.add(category)
+            db.session.commit()
+            Question.query.get(question_id).category = category.id
+            db.session.commit()
+            db.session.delete(category)
+            db.session.commit()
+        res = self.client().get('/questions/autocomplete?term=stringly')
+        self.assertEqual(200, res.status_code)
+        self.assertEqual([None], [s["category"] for s in json.loads(res.data)["suggestions"]])
+        # A rebuilt index reads the question's NULL category from the table.
+        with self.app.app_context():
+            autocomplete.build()
+        res = self.client().get('/questions/autocomplete?term=stringly')
+        self.assertEqual([None], [s["category"] for s in json.loads(res.data)["suggestions"]])
+        self.client().delete(f'/questions/{question_id}')
+
+
+    def test_failing_change_observer(self):
+        """Test that an observer raising after a commit neither fails the request nor skips the other observers"""
+        def failing_observer(*args):
+            raise RuntimeError("observer failed")
+        question_observers.insert(0, failing_observer)
+        self.addCleanup(question_observers.remove, failing_observer)
+        category_observers.insert(0, failing_observer)
+        self.addCleanup(category_observers.remove, failing_observer)
+        self.client().get('/questions/autocomplete?term=who')
+
+        with self.assertLogs('models', 'ERROR'):
+            res = self.client().put('/questions', json={"question": "Who observed the failing observer?",
+                                                        "answer": "Nobody", "category": 1, "difficulty": 1})
+        self.assertEqual(200, res.status_code)
+        question_id = json.loads(res.data)["id"]
+        res = self.client().get('/questions/autocomplete?term=failing%20obs')
+        self.assertEqual([question_id], [s["id"] for s in json.loads(res.data)["suggestions"]])
+
+        # The response cache, notified after the failing observer, drops the listing naming the renamed category.
+        self.client().get('/questions')
+        with self.app.app_context(), self.assertLogs('models', 'ERROR'):
+            Category.query.get(1).type = "Sciences"
+            db.session.commit()
+        self.assertEqual("Sciences", json.loads(self.client().get('/questions').data)["categories"]["1"])
+        with self.app.app_context():
+            Category.query.get(1).type = "Science"
+            db.session.commit()
+        self.client().delete(f'/questions/{question_id}')
+
+
+    def test_autocomplete_index(self):
+        """Test that suggestions come from the index alone and that both lookup paths agree"""
+        from flaskr.autocomplete import PrefixIndex
+        statements = []
+        with self.app.app_context():
+            autocomplete.build()
+            listener = lambda conn, cursor, statement, *args: statements.append(statement)
+            event.listen(db.engine, "before_cursor_execute", listener)
+            try:
+                suggestions = autocomplete.suggest("who dis")
+            finally:
+                event.remove(db.engine, "before_cursor_execute", listener)
+        self.assertEqual([{"id": 21, "question": "Who discovered penicillin?", "category": 1}], suggestions)
+        self.assertEqual([], statements)
+
+        rows = [(question_id, f"Which {word} is the tallest?", question_id % 6 + 1)
+                for question_id, word in enumerate(["tree", "tower", "team", "town", "toy", "tent"] * 20, start=1)]
+        rows.append((500, "Which tea grows on the rarest mountain?", 2))
+        built = PrefixIndex()
+        built.extend(rows)
+        added = PrefixIndex()
+        for row in reversed(rows):
+            added.add(*row)
+        self.assertEqual(added.tokens, built.tokens)
+        self.assertEqual(list(built.postings["tree"]), list(added.postings["tree"]))
+
+        # A rare word goes through its own questions, a common one through the prefix: same order either way.
+        self.assertEqual([500, 3, 9], built.lookup(["rarest", "t"], 3) + built.lookup(["tallest", "te"], 2))
+        self.assertEqual([500], built._word_ids("t", {"rarest"}, built.postings["rarest"], 3))
+        self.assertEqual([3, 9], built._word_ids("te", {"tallest"}, built.postings["tallest"], 2))
+
+        built.add(500, "Which coffee grows on the rarest mountain?", 3)
+        self.assertEqual([], built.lookup(["mountain", "tea"], 5))
+        self.assertEqual([500], built.lookup(["rarest", "cof"], 5))
+        self.assertEqual(("Which coffee grows on the rarest mountain?", 3), built.entry(500))
+        built.remove(500)
+        self.assertIsNone(built.entry(500))
+        self.assertNotIn("rarest", built.postings)
+        self.assertNotIn("rarest", built.tokens)
+
+
     def test_retrieve_quiz_question_success(self):
         """Test for successful retrieval of multiple quiz questions"""
         previous_questions = []
@@ -255,9 +1120,110 @@ class TriviaTestCase(unittest.TestCase):
         data = json.loads(res.data)
         self.assertTrue(data["question"] is None)
 
+    def test_retrieve_quiz_question_all_categories_success(self):
+        """Test for successful retrieval of quiz questions from all categories"""
+        all_question_ids = [q.id for q in Question.query.all()]
+
+        quiz_info = { "previous_questions": all_question_ids[1:], "quiz_category": { "id": 0, "type": "click" } }
+        res = self.client().post('/quizzes', data=json.dumps(quiz_info), headers={'Content-Type': 'application/json' })
+        self.assertEqual(200, res.status_code)
+        data = json.loads(res.data)
+        self.assertEqual(all_question_ids[0], data["question"]["id"])
+
+        quiz_info["previous_questions"] = all_question_ids
+        res = self.client().post('/quizzes', data=json.dumps(quiz_info), headers={'Content-Type': 'application/json' })
+        self.assertEqual(200, res.status_code)
+        data = json.loads(res.data)
+        self.assertTrue(data["question"] is None)
+
+    def test_retrieve_quiz_question_by_difficulty(self):
+        """Test for drawing quiz questions of chosen difficulties, fixed and adaptive"""
+        questions = Question.query.all()
+        mixed_ids = [q.id for q in questions if q.difficulty in (2, 4)]
+
+        quiz_info = { "previous_questions": [], "quiz_category": { "id": 0 }, "difficulty": [2, 4] }
+        for _ in range(len(mixed_ids)):
+            res = self.client().post('/quizzes', data=json.dumps(quiz_info), headers={'Content-Type': 'application/json' })
+            data = json.loads(res.data)
+            self.assertTrue(data["question"]["difficulty"] in (2, 4))
+            quiz_info["previous_questions"].append(data["question"]["id"])
+        self.assertEqual(sorted(mixed_ids), sorted(quiz_info["previous_questions"]))
+        res = self.client().post('/quizzes', data=json.dumps(quiz_info), headers={'Content-Type': 'application/json' })
+        self.assertTrue(json.loads(res.data)["question"] is None)
+
+        # A correct answer at difficulty 2 moves up to 3; once level 3 runs out, the nearest level (easier first) follows.
+        level_3_ids = [q.id for q in questions if q.difficulty == 3]
+        quiz_info = { "previous_questions": [], "quiz_category": { "id": 0 }, "adaptive": True, "difficulty": 2,
+                      "correct": True }
+        res = self.client().post('/quizzes', data=json.dumps(quiz_info), headers={'Content-Type': 'application/json' })
+        self.assertEqual(3, json.loads(res.data)["question"]["difficulty"])
+        quiz_info["previous_questions"] = level_3_ids
+        res = self.client().post('/quizzes', data=json.dumps(quiz_info), headers={'Content-Type': 'application/json' })
+        self.assertEqual(2, json.loads(res.data)["question"]["difficulty"])
+
+        quiz_info["difficulty"] = 6
+        res = self.client().post('/quizzes', data=json.dumps(quiz_info), headers={'Content-Type': 'application/json' })
+        self.assertEqual(404, res.status_code)
+
+    def test_retrieve_quiz_questions_batch(self):
+        """Test for drawing several distinct quiz questions in one request"""
+        category_question_ids = [q.id for q in Question.query.filter(Question.category == 1).all()]
+
+        quiz_info = { "previous_questions": category_question_ids[:1], "quiz_category": { "id": 1 }, "count": 2 }
+        res = self.client().post('/quizzes', data=json.dumps(quiz_info), headers={'Content-Type': 'application/json' })
+        self.assertEqual(200, res.status_code)
+        first_ids = [question["id"] for question in json.loads(res.data)["questions"]]
+        self.assertEqual(2, len(set(first_ids)))
+
+        quiz_info["previous_questions"] += first_ids
+        quiz_info["count"] = len(category_question_ids)
+        res = self.client().post('/quizzes', data=json.dumps(quiz_info), headers={'Content-Type': 'application/json' })
+        rest_ids = [question["id"] for question in json.loads(res.data)["questions"]]
+        self.assertEqual(sorted(category_question_ids), sorted(quiz_info["previous_questions"] + rest_ids))
+
+        quiz_info["count"] = 0
+        res = self.client().post('/quizzes', data=json.dumps(quiz_info), headers={'Content-Type': 'application/json' })
+        self.assertEqual(404, res.status_code)
+
     # No failure test for retrieval of quiz questions seemed necessary; the above test seemed to encompass all cases
 
 
+    def test_quiz_session_success(self):
+        """Test for playing a whole category through a quiz session"""
+        category_question_ids = [q.id for q in Question.query.filter(Question.category == 4).all()]
+
+        session_info = { "quiz_category": { "id": 4, "type": "History" } }
+        res = self.client().post('/quizzes/sessions', data=json.dumps(session_info), headers={'Content-Type': 'application/json' })
+        self.assertEqual(200, res.status_code)
+        data = json.loads(res.data)
+        self.assertTrue(data["success"])
+        self.assertEqual(len(category_question_ids), data["total_questions"])
+        session_id = data["session_id"]
+
+        asked_ids = []
+        for remaining in reversed(range(len(category_question_ids))):
+            res = self.client().post(f"/quizzes/sessions/{session_id}/next")
+            self.assertEqual(200, res.status_code)
+            data = json.loads(res.data)
+            self.assertEqual(4, data["question"]["category"])
+            self.assertEqual(remaining, data["remaining"])
+            asked_ids.append(data["question"]["id"])
+        self.assertEqual(sorted(category_question_ids), sorted(asked_ids))
+
+        res = self.client().post(f"/quizzes/sessions/{session_id}/next")
+        self.assertEqual(200, res.status_code)
+        self.assertTrue(json.loads(res.data)["question"] is None)
+
+        res = self.client().delete(f"/quizzes/sessions/{session_id}")
+        self.assertEqual(200, res.status_code)
+
+
+    def test_quiz_session_failure(self):
+        """Test for asking an unknown quiz session for a question"""
+        res = self.client().post('/quizzes/sessions/not-a-session/next')
+        self.assertEqual(404, res.status_code)
+
+
 # Make the tests conveniently executable
 if __name__ == "__main__":
     unittest.main()
\ No newline at end of file